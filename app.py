@@ -1,13 +1,30 @@
+import os
+import tempfile
+
 import dash
 import dash_bootstrap_components as dbc
-from dash import html, dcc, Input, Output, State
-import plotly.express as px
+from dash import html, dcc, Input, Output, State, ClientsideFunction
 import pandas as pd
 
 from mysql_utils import MySQL
-from mongodb_utils import MongoDB
+from mongodb_utils import MongoDB, encode_id, decode_id
 from neo4j_utils import Neo4j
 from neo4j import exceptions
+from cache_utils import ResultCache, keyword_key
+from keyword_index import KeywordIndex
+from krc_aggregates import KrcAggregates
+from columnar_snapshot import ColumnarSnapshot
+from query_executor import QueryExecutor, Branch
+from jobs_utils import JobQueue
+from metrics_utils import Metrics, instrument
+from http_utils import ResponseCompressor, compress_responses
+from photo_utils import PhotoCache, serve_photos
+from export_utils import Export, ExportError, export_url, serve_exports
+from search_index import SearchIndex
+from index_utils import ensure_indexes, report
+from lock_utils import process_lock
+from queries import Queries
+import figures
 
 app = dash.Dash(
     __name__,
@@ -15,6 +32,10 @@ app = dash.Dash(
     external_stylesheets=[dbc.themes.DARKLY],
 )
 
+# The Flask server, for WSGI servers such as `gunicorn -w 4 app:server`. State of
+# a user is kept in their browser, so any worker process can answer any request.
+server = app.server
+
 # Create a simple style for each widget box container
 widget_box_style = {
     "border": "2px solid white",
@@ -25,50 +46,240 @@ widget_box_style = {
     "display": "inline-block",
 }
 
+# Number of pooled MySQL connections, so that concurrent callbacks do not queue
+# behind a single socket. Set to 0 to use one shared connection instead.
+MYSQL_POOL_SIZE = 8
+
+# Callback and query latencies, row counts and response sizes are served in the
+# Prometheus text format on /metrics. Queries slower than SLOW_QUERY_SECONDS are
+# logged with their parameters to SLOW_QUERY_LOG, or to stderr when it is None.
+SLOW_QUERY_SECONDS = 0.5
+SLOW_QUERY_LOG = None
+metrics = Metrics(slow_query_seconds=SLOW_QUERY_SECONDS, slow_query_log=SLOW_QUERY_LOG)
+instrument(app, metrics)
+
+# With COMPRESS_RESPONSES, responses of COMPRESS_MIN_BYTES or more are sent gzip
+# compressed, or brotli compressed when the brotli package is installed. The page,
+# its layout and the component bundles carry an ETag, so that a reload is answered
+# with 304 Not Modified instead of sending them again.
+COMPRESS_RESPONSES = False
+COMPRESS_MIN_BYTES = 1024
+if COMPRESS_RESPONSES:
+    compress_responses(app, ResponseCompressor(min_bytes=COMPRESS_MIN_BYTES))
+
+# University and faculty photos are fetched once by the server and kept in
+# PHOTO_CACHE_PATH, with copies PHOTO_WIDTH pixels wide, then served from /photo
+# with ETag and Cache-Control headers. The photo URLs are signed with the
+# PHOTO_SECRET environment variable, or else with a secret kept in PHOTO_CACHE_PATH
+# that the worker processes sharing it read.
+PHOTO_CACHE_PATH = "photo_cache"
+PHOTO_WIDTH = 400
+photos = PhotoCache(PHOTO_CACHE_PATH, widths=(PHOTO_WIDTH,))
+serve_photos(app, photos)
+
 # Initialize our database connections
-mysql = MySQL()
+mysql = MySQL(pool_size=MYSQL_POOL_SIZE, metrics=metrics)
 mysql.connect()
 
-mongo = MongoDB()
+mongo = MongoDB(metrics=metrics)
 mongo.connect()
 
-neo = Neo4j()
+neo = Neo4j(metrics=metrics)
+
+# Answer the Top Universities and Top Faculty widgets from an in-memory index of
+# the keyword, publication and faculty tables instead of querying MySQL. The
+# index is loaded once at startup.
+USE_KEYWORD_INDEX = False
+keyword_index = KeywordIndex().load(mysql) if USE_KEYWORD_INDEX else None
+
+# Answer the Highest Impact widget from KRC sums per faculty member, keyword and
+# year that are precomputed in Neo4j (krc_aggregates.py), instead of walking every
+# publication of the selected keywords. They are built on the first start. Run
+# `python3 krc_aggregates.py refresh PUBLICATION_ID...` after publications or
+# their keywords change. With several worker processes, only the first one to take
+# the lock builds them, as concurrent rebuilds of the same faculty member could
+# each create its relationships.
+USE_KRC_AGGREGATES = False
+krc_aggregates = KrcAggregates(neo) if USE_KRC_AGGREGATES else None
+if krc_aggregates:
+    with process_lock(f"{neo.database}.krc_aggregates"):
+        if krc_aggregates.is_empty():
+            krc_aggregates.rebuild()
+
+# Answer the Top Universities, Top Faculty and Total Research widgets from a local
+# columnar snapshot of their MySQL tables and of university_stats
+# (columnar_snapshot.py), queried by an embedded engine, "duckdb" or "parquet",
+# instead of the stores that also take the writes. The engine has to be installed.
+# The snapshot is exported on the first start and again once it is older than
+# SNAPSHOT_MAX_AGE seconds. Run `python3 columnar_snapshot.py PATH ENGINE` to
+# refresh it by hand.
+USE_SNAPSHOT = False
+SNAPSHOT_ENGINE = "duckdb"
+SNAPSHOT_PATH = "analytics.duckdb"
+SNAPSHOT_MAX_AGE = 3600
+snapshot = (
+    ColumnarSnapshot(SNAPSHOT_PATH, mysql, mongo, SNAPSHOT_ENGINE)
+    if USE_SNAPSHOT
+    else None
+)
 
-# Query for the list of keywords that the user can select from
-options = sorted([item[0] for item in mysql.execute_query("SELECT name FROM keyword")])
+# The reads and writes behind the callbacks. An export that is downloaded for
+# longer than EXPORT_TIMEOUT seconds is cut off, to free its MySQL connection.
+EXPORT_TIMEOUT = 300
+queries = Queries(
+    mysql,
+    mongo,
+    neo,
+    keyword_index,
+    krc_aggregates,
+    snapshot,
+    export_timeout=EXPORT_TIMEOUT,
+)
 
-# Query for the list of faculty that the user can select from
-faculty_options = sorted(
-    [item[0] for item in mysql.execute_query("SELECT name FROM faculty")]
+# Results of the read-only widgets are cached in memory with LRU and TTL eviction,
+# and in the SQLite file RESULT_CACHE_PATH that the worker processes on this host
+# share, so that a write answered by one worker invalidates the results of all of
+# them. Expired results are kept for another hour, to be shown by the background
+# jobs while they compute a fresh one. With RESULT_CACHE_PATH set to None the cache
+# is per process, and the widgets that show the app's own writes are not cached.
+RESULT_CACHE_PATH = os.path.join(
+    tempfile.gettempdir(), f"{mongo.database}.result_cache.sqlite"
+)
+result_cache = ResultCache(
+    max_entries=1024,
+    ttl=600,
+    path=RESULT_CACHE_PATH,
+    stale_ttl=3600,
+    shared_widgets=("faculty-reviews", "university-info"),
 )
 
-# Query for list of univeristy that the user can select from
-university_options = sorted(
-    [item[0] for item in mysql.execute_query("SELECT name FROM university")]
+# With BACKGROUND_JOBS, the queries of the Total Research widget and of keyword
+# selections of BACKGROUND_MIN_KEYWORDS or more run as jobs in BACKGROUND_WORKERS
+# forked processes, so that they do not hold a request thread. The widget shows a
+# progress bar, and a recently expired result if there is one, while the browser
+# polls every JOB_POLL_MS milliseconds for the result. The processes are forked
+# here, before the app starts threads of its own.
+BACKGROUND_JOBS = False
+BACKGROUND_WORKERS = 2
+BACKGROUND_MIN_KEYWORDS = 3
+JOB_POLL_MS = 500
+jobs = (
+    JobQueue(queries, result_cache, max_workers=BACKGROUND_WORKERS)
+    if BACKGROUND_JOBS
+    else None
 )
 
-# Query for the min and max years of publications.
-# Note that this is removing publications with a missing year.
-min_year, max_year = mysql.execute_query(
-    "SELECT MIN(year), MAX(year) FROM publication WHERE year > 0"
-)[0]
-min_year, max_year = int(min_year), int(max_year)
-
-# This stores the selected faculty, so that we can access easily if the reviews are opened
-selected_faculty = None
-
-# Prepare a statement in MySQL
-mysql.execute_query(
-    "PREPARE stmt FROM "
-    '"SELECT p.title, p.num_citations '
-    "FROM publication p "
-    "JOIN faculty_publication fp ON p.id = fp.publication_id "
-    "JOIN faculty f ON f.id = fp.faculty_id "
-    "WHERE f.name = ? "
-    "AND p.title != 'A shape-based approach to the segmentation of medical imagery using level sets'"
-    'ORDER BY p.num_citations DESC LIMIT 10"'
+# Per university summary used by the Total Research widget. It is built on the
+# first start, and when UNIVERSITY_STATS_WATCH is set it follows the faculty change
+# stream to stay current. Run `python3 university_stats.py` to rebuild it by hand.
+# With several worker processes, only the first one to take the lock builds it.
+UNIVERSITY_STATS_WATCH = False
+university_stats = queries.university_stats
+with process_lock(f"{mongo.database}.university_stats"):
+    if university_stats.is_empty():
+        university_stats.rebuild()
+if UNIVERSITY_STATS_WATCH:
+    university_stats.watch()
+
+# The snapshot copies university_stats, so it is exported once that is built
+if snapshot:
+    snapshot.refresh_every(SNAPSHOT_MAX_AGE)
+
+# Faculty reviews, stored in their own collection with a rating summary. Reviews
+# from older versions that are embedded in the faculty documents can be moved
+# there with `python3 reviews.py migrate`.
+reviews = queries.reviews
+with process_lock(f"{mongo.database}.reviews"):
+    reviews.ensure_indexes()
+
+# Create any missing index that the hot lookups depend on, then check with each
+# store's query planner that they are used. With REQUIRE_INDEXES the app refuses
+# to start while a lookup still scans, otherwise it only warns. With several
+# worker processes, the first one to take the lock creates them.
+REQUIRE_INDEXES = False
+with process_lock(f"{mysql.database}.indexes"):
+    index_problems = ensure_indexes(mysql, mongo, neo)
+report(index_problems)
+if index_problems and REQUIRE_INDEXES:
+    raise SystemExit("Refusing to start without the required indexes.")
+
+# Details of each faculty member from all three stores, joined into one document
+# per faculty member that the Faculty Information and Most Cited Publications
+# widgets read. It is built on the first start, and when FACULTY_PROFILES_WATCH is
+# set it follows the faculty change stream. Run `python3 faculty_profiles.py` to
+# rebuild it after MySQL or Neo4j changed. With several worker processes, the
+# first one builds it while the others wait for the lock and then find it built.
+FACULTY_PROFILES_WATCH = False
+faculty_profiles = queries.faculty_profiles
+with process_lock(f"{mongo.database}.faculty_profiles"):
+    if faculty_profiles.is_empty():
+        faculty_profiles.rebuild()
+if FACULTY_PROFILES_WATCH:
+    faculty_profiles.watch()
+
+# The queries behind the keyword widgets run in parallel on this pool, and each is
+# given up on after QUERY_TIMEOUT seconds. The stores are given the same limit, so
+# that they stop a query that was given up on.
+QUERY_TIMEOUT = 10
+query_executor = QueryExecutor(
+    max_workers=16, limits=(mysql.time_limit, mongo.time_limit, neo.time_limit)
 )
 
+# Number of bars in the Top Faculty widget
+TOP_FACULTY_LIMIT = 100
+
+
+def query_names(table):
+    return lambda: queries.names(table)
+
+
+# Dropdown options are not shipped with the layout. Each dropdown asks for matches
+# as the user types, which are looked up in these indexes. An index loads its
+# names from MySQL the first time it is searched.
+keyword_search = SearchIndex(query_names("keyword"))
+faculty_search = SearchIndex(query_names("faculty"))
+university_search = SearchIndex(query_names("university"))
+
+# Min and max years of publications, used as the bounds of the year slider
+min_year, max_year = queries.year_range()
+
+
+def keyword_export(stream):
+    def rows(args):
+        selection = args.getlist("keyword")
+        if not selection:
+            raise ExportError("Select at least one keyword to export")
+        years = (
+            args.get("from", min_year, type=int),
+            args.get("to", max_year, type=int),
+        )
+        return stream(selection, years)
+
+    return rows
+
+
+# The full results behind the Top Universities, Top Faculty and Total Research
+# widgets can be downloaded from /export/<name>.csv, or .parquet when pyarrow is
+# installed, with the selection as keyword=...&from=...&to=... or university=...
+exports = {
+    "top-universities": Export(
+        [("university", "string"), ("publications", "int64")],
+        keyword_export(queries.stream_university_counts),
+    ),
+    "top-faculty": Export(
+        [("faculty", "string"), ("publications", "int64")],
+        keyword_export(queries.stream_faculty_counts),
+    ),
+    "total-research": Export(
+        [("university", "string")]
+        + [(column, "int64") for column in figures.COUNT_COLUMNS],
+        lambda args: queries.stream_university_summary(
+            args.getlist("university") or None
+        ),
+    ),
+}
+serve_exports(app, exports)
+
 
 app.layout = html.Div(
     [
@@ -78,7 +289,7 @@ app.layout = html.Div(
                 html.H1("Matching Your Academic Interests With Universities"),
                 dcc.Dropdown(
                     id="keywords-dropdown",
-                    options=options,
+                    options=[],
                     multi=True,
                     placeholder="Search for keywords...",
                     style={"color": "blue"},
@@ -95,6 +306,17 @@ app.layout = html.Div(
                         "style": {"color": "LightSteelBlue", "fontSize": "20px"},
                     },
                 ),
+                dbc.Progress(
+                    id="keyword-progress",
+                    value=0,
+                    striped=True,
+                    animated=True,
+                    style={"display": "none"},
+                ),
+                dcc.Store(id="keyword-jobs"),
+                dcc.Interval(
+                    id="keyword-job-poll", interval=JOB_POLL_MS, disabled=True
+                ),
             ],
         ),
         html.Div(
@@ -102,15 +324,29 @@ app.layout = html.Div(
                 html.Div(
                     [
                         html.H1("Top Universities"),
+                        dcc.Dropdown(
+                            id="uni-top-k",
+                            options=[
+                                {"label": f"Top {k}", "value": k}
+                                for k in (10, 25, 50, 100)
+                            ]
+                            + [{"label": "All", "value": 0}],
+                            value=25,
+                            clearable=False,
+                            style={"color": "blue"},
+                        ),
+                        html.A("Download CSV", id="uni-keyword-export"),
                         html.Div(
                             id="keyword-graph-container",
-                            children=html.Div(  # This is an empty placeholder, since Dash gives an error for a nonexistent input without this.
+                            children=[
+                                html.P(id="uni-keyword-message"),
+                                dcc.Store(id="uni-year-counts"),
                                 dcc.Graph(
-                                    figure=px.bar(),
+                                    figure=figures.empty_bar("University"),
                                     id="uni-keyword-graph",
                                     style={"display": "none"},
-                                )
-                            ),
+                                ),
+                            ],
                         ),
                     ],
                     style=widget_box_style,
@@ -118,15 +354,18 @@ app.layout = html.Div(
                 html.Div(
                     [
                         html.H1("Top Faculty"),
+                        html.A("Download CSV", id="faculty-keyword-export"),
                         html.Div(
                             id="keyword-graph-faculty-container",
-                            children=html.Div(  # This is an empty placeholder, since Dash gives an error for a nonexistent input without this.
+                            children=[
+                                html.P(id="faculty-keyword-message"),
+                                dcc.Store(id="faculty-year-counts"),
                                 dcc.Graph(
-                                    figure=px.bar(),
+                                    figure=figures.empty_bar("Faculty"),
                                     id="faculty-keyword-graph",
                                     style={"display": "none"},
-                                )
-                            ),
+                                ),
+                            ],
                         ),
                     ],
                     style=widget_box_style,
@@ -134,7 +373,17 @@ app.layout = html.Div(
                 html.Div(
                     [
                         html.H1("Highest Impact"),
-                        html.Div(id="top-ranking-faculty-keyword-container"),
+                        html.Div(
+                            id="top-ranking-faculty-keyword-container",
+                            children=[
+                                html.P(id="impact-message"),
+                                dcc.Graph(
+                                    figure=figures.empty_pie(),
+                                    id="impact-graph",
+                                    style={"display": "none"},
+                                ),
+                            ],
+                        ),
                     ],
                     style=widget_box_style,
                 ),
@@ -148,7 +397,7 @@ app.layout = html.Div(
                         html.H1("University Information"),
                         dcc.Dropdown(
                             id="university-dropdown",
-                            options=university_options,
+                            options=[],
                             multi=False,
                             placeholder="Search for universities...",
                             style={"color": "blue"},
@@ -165,7 +414,7 @@ app.layout = html.Div(
                         html.H1("Faculty Information"),
                         dcc.Dropdown(
                             id="faculty-dropdown",
-                            options=faculty_options,
+                            options=[],
                             multi=False,
                             placeholder="Search for faculty...",
                             style={"color": "blue"},
@@ -174,6 +423,8 @@ app.layout = html.Div(
                             id="selected-faculty-info",
                             children="Select or search for a Faculty Member for more information.",
                         ),
+                        # The id of the selected faculty, used by the reviews popup
+                        dcc.Store(id="selected-faculty"),
                     ],
                     style=widget_box_style,
                 ),
@@ -208,12 +459,44 @@ app.layout = html.Div(
                         html.H1("Total Research"),
                         dcc.Dropdown(
                             id="top-uni-dropdown",
-                            options=university_options,
+                            options=[],
                             multi=True,
                             placeholder="Filter universities...",
                             style={"color": "blue"},
                         ),
-                        html.Div(id="top-uni-container"),
+                        html.A(
+                            "Download CSV",
+                            id="top-uni-export",
+                            href=export_url("total-research"),
+                        ),
+                        html.Div(
+                            id="top-uni-container",
+                            children=[
+                                dcc.Graph(
+                                    figure=figures.research_scatter(
+                                        pd.DataFrame(
+                                            columns=["university"]
+                                            + figures.COUNT_COLUMNS
+                                        )
+                                    ),
+                                    id="top-uni-graph",
+                                ),
+                                dcc.Store(id="top-uni-render-mode", data="svg"),
+                                dbc.Progress(
+                                    id="top-uni-progress",
+                                    value=0,
+                                    striped=True,
+                                    animated=True,
+                                    style={"display": "none"},
+                                ),
+                                dcc.Store(id="top-uni-jobs"),
+                                dcc.Interval(
+                                    id="top-uni-job-poll",
+                                    interval=JOB_POLL_MS,
+                                    disabled=True,
+                                ),
+                            ],
+                        ),
                     ],
                     style=widget_box_style,
                 ),
@@ -245,204 +528,387 @@ app.layout = html.Div(
 )
 
 
+def register_typeahead(dropdown_id, index):
+    @app.callback(
+        Output(dropdown_id, "options"),
+        Input(dropdown_id, "search_value"),
+        State(dropdown_id, "value"),
+    )
+    def update_options(search_value, value):
+        # The selected values have to stay in the options to be displayed
+        if isinstance(value, list):
+            selected = value
+        else:
+            selected = [value] if value else []
+
+        if not search_value:
+            return selected
+
+        return selected + [
+            name for name in index.search(search_value) if name not in selected
+        ]
+
+
+register_typeahead("keywords-dropdown", keyword_search)
+register_typeahead("university-dropdown", university_search)
+register_typeahead("faculty-dropdown", faculty_search)
+register_typeahead("top-uni-dropdown", university_search)
+
+
+def widget_update(branch, patch):
+    # Returns the figure (or data), style and message outputs of one keyword
+    # widget. A widget still waiting for its background job is left as it is.
+    if branch is None:
+        return dash.no_update, dash.no_update, dash.no_update
+    if branch.error:
+        return (
+            dash.no_update,
+            {"display": "none"},
+            "This widget could not be loaded, please try again.",
+        )
+    return patch(branch.value), {}, None
+
+
+def keyword_widget_queries(selection, slider_value):
+    # The result cache key, Queries method and arguments of each keyword widget.
+    # The bar charts get the publication counts of every year, and are ranked and
+    # drawn for the selected year range in the browser, so moving the slider or
+    # changing the number of universities needs no query.
+    return {
+        "top-universities": (
+            keyword_key("university-years", selection, ()),
+            "university_year_counts",
+            (selection,),
+        ),
+        "top-faculty": (
+            keyword_key("faculty-years", selection, ()),
+            "faculty_year_counts",
+            (selection,),
+        ),
+        "highest-impact": (
+            keyword_key("highest-impact", selection, slider_value),
+            "highest_impact",
+            (selection, slider_value),
+        ),
+    }
+
+
+def keyword_widget_outputs(branches):
+    # Only the data arrays of the pie are sent back
+    return (
+        *widget_update(branches["top-universities"], figures.year_histogram),
+        *widget_update(
+            branches["top-faculty"],
+            lambda rows: figures.year_histogram(rows, limit=TOP_FACULTY_LIMIT),
+        ),
+        *widget_update(branches["highest-impact"], figures.patch_pie),
+    )
+
+
+def submit_job(key, method, args):
+    # Starts (or joins) the background job of a widget whose result is not
+    # cached. Returns a Branch with the cached or recently expired result, or
+    # None when there is nothing to show yet, and whether the widget has to wait.
+    found, value = result_cache.get(key)
+    if found:
+        return Branch(value, None, 0), False
+
+    jobs.submit(key, method, *args)
+    found, value = result_cache.get_stale(key)
+    return (Branch(value, None, 0) if found else None), True
+
+
+def poll_job(key, method, args):
+    # The Branch of a background job once its result is cached or it failed, or
+    # None and the job's status while it is queued or running
+    found, value = result_cache.get(key)
+    if found:
+        return Branch(value, None, 0), None
+
+    status = jobs.status(key)
+    if status.state == "failed":
+        return Branch(None, status.error, 0), None
+    if status.state == "unknown":
+        # The job ran in another worker process, which does not share this
+        # one's result cache, or its result was already evicted
+        jobs.submit(key, method, *args)
+        status = jobs.status(key)
+    return None, status
+
+
+def job_outputs(job, statuses):
+    # The job store, poll interval and progress bar outputs of a widget, which
+    # waits for the jobs in job["waiting"]
+    if not job or not job["waiting"]:
+        return None, True, 0, {"display": "none"}
+
+    estimates = [status.progress for status in statuses]
+    # Without an estimate yet the bar is full, and only its stripes move
+    progress = 100 if None in estimates else min(estimates)
+    return job, False, progress, {}
+
+
+KEYWORD_JOB_OUTPUTS = [
+    Output("keyword-jobs", "data"),
+    Output("keyword-job-poll", "disabled"),
+    Output("keyword-progress", "value"),
+    Output("keyword-progress", "style"),
+]
+
+
+def release_keyword_jobs(job):
+    # The jobs of a superseded selection are no longer waited for
+    if jobs and job:
+        widget_queries = keyword_widget_queries(job["selection"], job["years"])
+        for name in job["waiting"]:
+            jobs.release(widget_queries[name][0])
+
+
 @app.callback(
     [
-        Output("keyword-graph-container", "children"),
-        Output("keyword-graph-faculty-container", "children"),
-    ],
-    [Input("keywords-dropdown", "value")],
-    [State("year-range-slider", "value")],
+        Output("uni-year-counts", "data"),
+        Output("uni-keyword-graph", "style"),
+        Output("uni-keyword-message", "children"),
+        Output("faculty-year-counts", "data"),
+        Output("faculty-keyword-graph", "style"),
+        Output("faculty-keyword-message", "children"),
+        Output("impact-graph", "figure"),
+        Output("impact-graph", "style"),
+        Output("impact-message", "children"),
+    ]
+    + KEYWORD_JOB_OUTPUTS,
+    Input("keywords-dropdown", "value"),
+    [State("year-range-slider", "value"), State("keyword-jobs", "data")],
 )
-def update_keyword_widgets(selection, slider_value):
-    if selection:
-        search_min, search_max = slider_value
+def update_keyword_widgets(selection, slider_value, pending):
+    if not selection:
+        return dash.no_update
 
-        keyword_str = ", ".join([f'"{keyword}"' for keyword in selection])
+    widget_queries = keyword_widget_queries(selection, slider_value)
 
-        # Query for university publication count
-        query_university = " ".join(
-            [
-                "SELECT u.name, COUNT(DISTINCT p.id) c",
-                "FROM university u",
-                "JOIN faculty f on f.university_id = u.id",
-                "JOIN faculty_publication fp on f.id = fp.faculty_id",
-                "JOIN publication p ON p.id = fp.publication_id",
-                "JOIN publication_keyword pk ON pk.publication_id = p.id",
-                "JOIN keyword k ON k.id = pk.keyword_id",
-                f"WHERE k.name IN ({keyword_str})",
-                f"AND p.year >= {search_min} AND p.year <= {search_max}",
-                "GROUP BY u.id",
-                "ORDER BY c DESC",
-            ]
-        )
-        res_university = mysql.execute_query(query_university)
+    if jobs and len(selection) >= BACKGROUND_MIN_KEYWORDS:
+        branches = {}
+        job = {"selection": selection, "years": slider_value, "waiting": []}
+        for name, (key, method, args) in widget_queries.items():
+            branches[name], waiting = submit_job(key, method, args)
+            if waiting:
+                job["waiting"].append(name)
+        # Released after submitting, so that a job of the new selection that
+        # was also pending for the old one keeps running
+        release_keyword_jobs(pending)
 
-        df_university = pd.DataFrame(
-            res_university, columns=["University", "Publication Count"]
-        )
-        fig_university = px.bar(
-            df_university,
-            x="University",
-            y="Publication Count",
-            labels={
-                "Publication Count": "Publication Count",
-                "University": "University",
-            },
-            template="plotly_dark",
-        )
-        fig_university.update_layout(
-            plot_bgcolor="rgba(0,0,0,0)",
-            paper_bgcolor="#222",
-        )
-        graph_university = dcc.Graph(figure=fig_university, id="uni-keyword-graph")
+        statuses = [jobs.status(widget_queries[name][0]) for name in job["waiting"]]
+        return (*keyword_widget_outputs(branches), *job_outputs(job, statuses))
 
-        # Query for faculty publication count
-        query_faculty = " ".join(
-            [
-                "SELECT f.name, COUNT(DISTINCT p.id) c",
-                "FROM faculty f",
-                "JOIN faculty_publication fp ON f.id = fp.faculty_id",
-                "JOIN publication p ON p.id = fp.publication_id",
-                "JOIN publication_keyword pk ON pk.publication_id = p.id",
-                "JOIN keyword k ON k.id = pk.keyword_id",
-                f"WHERE k.name IN ({keyword_str})",
-                f"AND p.year >= {search_min} AND p.year <= {search_max}",
-                "GROUP BY f.id",
-                "ORDER BY c DESC",
-                "LIMIT 100",
-            ]
-        )
-        res_faculty = mysql.execute_query(query_faculty)
-
-        df_faculty = pd.DataFrame(res_faculty, columns=["Faculty", "Publication Count"])
-        fig_faculty = px.bar(
-            df_faculty,
-            x="Faculty",
-            y="Publication Count",
-            labels={"Publication Count": "Publication Count", "Faculty": "Faculty"},
-            template="plotly_dark",
-        )
-        fig_faculty.update_layout(
-            plot_bgcolor="rgba(0,0,0,0)",
-            paper_bgcolor="#222",
+    release_keyword_jobs(pending)
+
+    def cached(key, method, args):
+        return lambda: result_cache.get_or_compute(
+            key, lambda: getattr(queries, method)(*args)
         )
-        graph_faculty = dcc.Graph(figure=fig_faculty, id="faculty-keyword-graph")
 
-        return graph_university, graph_faculty
-    else:
+    # The widgets query different tables and stores independently, so they run
+    # in parallel and the callback only waits for the slowest of them
+    branches = query_executor.run(
+        {name: cached(*query) for name, query in widget_queries.items()},
+        timeout=QUERY_TIMEOUT,
+    )
+
+    app.logger.info(
+        "update_keyword_widgets: %s",
+        ", ".join(
+            f"{name} {branch.seconds * 1000:.1f}ms"
+            + (f" ({branch.error!r})" if branch.error else "")
+            for name, branch in branches.items()
+        ),
+    )
+
+    return (*keyword_widget_outputs(branches), *job_outputs(None, []))
+
+
+@app.callback(
+    [
+        Output("uni-year-counts", "data", allow_duplicate=True),
+        Output("uni-keyword-graph", "style", allow_duplicate=True),
+        Output("uni-keyword-message", "children", allow_duplicate=True),
+        Output("faculty-year-counts", "data", allow_duplicate=True),
+        Output("faculty-keyword-graph", "style", allow_duplicate=True),
+        Output("faculty-keyword-message", "children", allow_duplicate=True),
+        Output("impact-graph", "figure", allow_duplicate=True),
+        Output("impact-graph", "style", allow_duplicate=True),
+        Output("impact-message", "children", allow_duplicate=True),
+    ]
+    + [
+        Output(output.component_id, output.component_property, allow_duplicate=True)
+        for output in KEYWORD_JOB_OUTPUTS
+    ],
+    Input("keyword-job-poll", "n_intervals"),
+    State("keyword-jobs", "data"),
+    prevent_initial_call=True,
+)
+def poll_keyword_widgets(n_intervals, job):
+    if not job or not job["waiting"]:
         return dash.no_update
 
+    widget_queries = keyword_widget_queries(job["selection"], job["years"])
+    branches = {name: None for name in widget_queries}
+    statuses = []
+    waiting = []
+    for name in job["waiting"]:
+        branches[name], status = poll_job(*widget_queries[name])
+        if status:
+            statuses.append(status)
+            waiting.append(name)
+
+    job = dict(job, waiting=waiting)
+    return (*keyword_widget_outputs(branches), *job_outputs(job, statuses))
+
+
+app.clientside_callback(
+    ClientsideFunction(namespace="year_histogram", function_name="top_universities"),
+    Output("uni-keyword-graph", "figure"),
+    [
+        Input("uni-year-counts", "data"),
+        Input("year-range-slider", "value"),
+        Input("uni-top-k", "value"),
+    ],
+    State("uni-keyword-graph", "figure"),
+)
+
+app.clientside_callback(
+    ClientsideFunction(namespace="year_histogram", function_name="top_faculty"),
+    Output("faculty-keyword-graph", "figure"),
+    [Input("faculty-year-counts", "data"), Input("year-range-slider", "value")],
+    State("faculty-keyword-graph", "figure"),
+)
+
+
+@app.callback(
+    [
+        Output("uni-keyword-export", "href"),
+        Output("faculty-keyword-export", "href"),
+    ],
+    [Input("keywords-dropdown", "value"), Input("year-range-slider", "value")],
+)
+def update_keyword_exports(selection, slider_value):
+    # The export links follow the selection, which the exports read from their
+    # URL instead of from the widgets
+    if not selection:
+        return None, None
+    params = {"keyword": selection, "from": slider_value[0], "to": slider_value[1]}
+    return (
+        export_url("top-universities", **params),
+        export_url("top-faculty", **params),
+    )
+
+
+@app.callback(Output("top-uni-export", "href"), Input("top-uni-dropdown", "value"))
+def update_top_uni_export(selection):
+    return export_url("total-research", university=selection)
+
 
 @app.callback(
     Output("faculty-most-cited-table", "children"), Input("faculty-dropdown", "value")
 )
 def update_cited_table(value):
     if value:
-        mysql.execute_query(f'SET @fac = "{value}"')
-        result = mysql.execute_query("EXECUTE stmt USING @fac")
-        df = pd.DataFrame(result, columns=["Publication", "Times Cited"])
+        # Read from the faculty profile, which holds the most cited publications
+        profile = queries.faculty_profile(value)
+        df = pd.DataFrame(
+            (
+                [(p["title"], p["numCitations"]) for p in profile["topCited"]]
+                if profile
+                else []
+            ),
+            columns=["Publication", "Times Cited"],
+        )
         return dbc.Table.from_dataframe(df, striped=True, bordered=True, hover=True)
 
     return dash.no_update
 
 
-@app.callback(
-    Output("top-uni-container", "children"), Input("top-uni-dropdown", "value")
-)
-def update_top_uni(selection):
-    pipeline = [
-        {"$unwind": "$keywords"},
-        {
-            "$group": {
-                "_id": {"university": "$affiliation.name", "faculty_id": "$_id"},
-                "uniqueKeywords": {"$addToSet": "$keywords.name"},
-                "publications": {"$first": "$publications"},
-            }
-        },
-        {
-            "$group": {
-                "_id": "$_id.university",
-                "facultyCount": {"$sum": 1},
-                "uniqueKeywordsCount": {"$sum": {"$size": "$uniqueKeywords"}},
-                "distinctPublicationsCount": {"$sum": {"$size": "$publications"}},
-            }
-        },
-        {
-            "$project": {
-                "_id": 0,
-                "university": "$_id",
-                "uniqueKeywordsCount": 1,
-                "facultyCount": 1,
-                "distinctPublicationsCount": 1,
-            }
-        },
-        {"$sort": {"uniqueKeywordsCount": -1}},
-    ]
+def top_uni_key(selection):
+    return ("university-summary", tuple(sorted(selection or [])))
 
-    if selection:
-        pipeline.insert(0, {"$match": {"affiliation.name": {"$in": selection}}})
-
-    result = list(mongo.db["faculty"].aggregate(pipeline))
-    df = pd.DataFrame(result)
-    scatter = px.scatter(
-        df,
-        x="distinctPublicationsCount",
-        y="facultyCount",
-        size="uniqueKeywordsCount",
-        hover_data=["university"],
-        log_x=True,
-        template="plotly_dark",
-    )
-    scatter.update_xaxes(title_text="Total Publications")
-    scatter.update_yaxes(title_text="Faculty Members")
-    scatter.update_layout(
-        plot_bgcolor="rgba(0,0,0,0)",
-        paper_bgcolor="#222",
-    )
 
-    return dcc.Graph(figure=scatter)
+def top_uni_update(df, current_mode):
+    # Only the data arrays are sent, unless the number of points crossed the
+    # WebGL threshold and the trace type has to change
+    if df is None:
+        return dash.no_update, dash.no_update
+
+    mode = figures.render_mode(df)
+    if mode != current_mode:
+        return figures.research_scatter(df), mode
+
+    return figures.patch_research_scatter(df), dash.no_update
+
+
+TOP_UNI_JOB_OUTPUTS = [
+    Output("top-uni-jobs", "data"),
+    Output("top-uni-job-poll", "disabled"),
+    Output("top-uni-progress", "value"),
+    Output("top-uni-progress", "style"),
+]
 
 
 @app.callback(
-    Output("top-ranking-faculty-keyword-container", "children"),
-    Input("keywords-dropdown", "value"),
-    State("year-range-slider", "value"),
+    [Output("top-uni-graph", "figure"), Output("top-uni-render-mode", "data")]
+    + TOP_UNI_JOB_OUTPUTS,
+    Input("top-uni-dropdown", "value"),
+    [State("top-uni-render-mode", "data"), State("top-uni-jobs", "data")],
 )
-def update_top_faculty(selection, year_range):
-    if selection:
-        records, _, _ = neo.driver.execute_query(
-            "WITH $selected_keywords AS keywords "
-            "MATCH (f:FACULTY)--(p:PUBLICATION)-[l:LABEL_BY]-(k:KEYWORD) "
-            "WHERE k.name IN keywords "
-            "AND p.year >= $min_year AND p.year <= $max_year "
-            "RETURN f.name, SUM(DISTINCT p.numCitations * l.score) as KRC "
-            "ORDER BY KRC DESC "
-            "LIMIT 10",
-            selected_keywords=selection,
-            min_year=year_range[0],
-            max_year=year_range[1],
-            database_="academicworld",
-        )
+def update_top_uni(selection, current_mode, pending):
+    if not jobs:
+        df = queries.university_summary(selection)
+        return (*top_uni_update(df, current_mode), *job_outputs(None, []))
+
+    key = top_uni_key(selection)
+    branch, waiting = submit_job(key, "university_summary", (selection,))
+    if pending:
+        jobs.release(top_uni_key(pending["selection"]))
+
+    job = {"selection": selection, "waiting": ["top-uni"] if waiting else []}
+    statuses = [jobs.status(key)] if waiting else []
+    return (
+        *top_uni_update(branch.value if branch else None, current_mode),
+        *job_outputs(job, statuses),
+    )
 
-        labels = []
-        values = []
 
-        for r in records:
-            if r["KRC"] > 0:
-                labels.append(r["f.name"])
-                values.append(r["KRC"])
+@app.callback(
+    [
+        Output("top-uni-graph", "figure", allow_duplicate=True),
+        Output("top-uni-render-mode", "data", allow_duplicate=True),
+    ]
+    + [
+        Output(output.component_id, output.component_property, allow_duplicate=True)
+        for output in TOP_UNI_JOB_OUTPUTS
+    ],
+    Input("top-uni-job-poll", "n_intervals"),
+    [State("top-uni-render-mode", "data"), State("top-uni-jobs", "data")],
+    prevent_initial_call=True,
+)
+def poll_top_uni(n_intervals, current_mode, job):
+    if not job or not job["waiting"]:
+        return dash.no_update
 
-        fig = px.pie(names=labels, values=values, template="plotly_dark")
-        fig.update_traces(
-            textposition="inside", textinfo="percent+label", hoverinfo="value"
-        )
-        fig.update_layout(
-            plot_bgcolor="rgba(0,0,0,0)",
-            paper_bgcolor="#222",
+    selection = job["selection"]
+    branch, status = poll_job(
+        top_uni_key(selection), "university_summary", (selection,)
+    )
+    if status:
+        return (
+            dash.no_update,
+            dash.no_update,
+            *job_outputs(job, [status]),
         )
-        return dcc.Graph(figure=fig)
 
-    return dash.no_update
+    if branch.error:
+        app.logger.warning("update_top_uni: %r", branch.error)
+        return (dash.no_update, dash.no_update, *job_outputs(None, []))
+
+    return (*top_uni_update(branch.value, current_mode), *job_outputs(None, []))
 
 
 @app.callback(
@@ -457,7 +923,7 @@ def uni_display_click_data(clickData, dropdown_val):
     triggered_id = ctx.triggered[0]["prop_id"].split(".")[0]
 
     if triggered_id == "uni-keyword-graph":
-        if clickData:
+        if clickData and clickData["points"][0]["x"] != figures.OTHERS_LABEL:
             name = clickData["points"][0]["x"]
         else:
             return dash.no_update
@@ -468,31 +934,29 @@ def uni_display_click_data(clickData, dropdown_val):
     else:
         return dash.no_update
 
-    records, _, _ = neo.driver.execute_query(
-        "MATCH (i:INSTITUTE {name: $name}) RETURN i",
-        name=name,
-        database_="academicworld",
+    university = result_cache.get_or_compute(
+        ("university-info", name), lambda: queries.university_info(name)
     )
 
-    imgURL = records[0].data()["i"]["photoUrl"]
-
-    records, _, _ = neo.driver.execute_query(
-        "MATCH (f:FACULTY)--(i:INSTITUTE {name: $name}) RETURN count(f)",
-        name=name,
-        database_="academicworld",
-    )
+    if university is None:
+        return html.P(
+            "There was an error finding this university. This is likely due to a discrepancy between the data in each database."
+        )
 
-    total_fac = records[0].data()["count(f)"]
+    imgURL, total_fac = university
 
     return [
         html.H3(name),
-        html.Img(src=imgURL, style={"max-width": "100%", "height": "auto"}),
+        html.Img(
+            src=photos.src(imgURL, PHOTO_WIDTH),
+            style={"max-width": "100%", "height": "auto"},
+        ),
         html.P(f"Total published faculty members: {total_fac}"),
     ]
 
 
 @app.callback(
-    [Output("update-uni-result", "children"), Output("university-dropdown", "options")],
+    Output("update-uni-result", "children"),
     [Input("update-uni-button", "n_clicks"), Input("create-uni-button", "n_clicks")],
     [State("update-uni-name", "value"), State("update-uni-url", "value")],
 )
@@ -504,34 +968,33 @@ def update_uni_button(n_clicks_1, n_clicks_2, name, url):
     triggered_id = ctx.triggered[0]["prop_id"].split(".")[0]
 
     if n_clicks_1 and triggered_id == "update-uni-button":
-        neo.driver.execute_query(
-            "MATCH (i:INSTITUTE {name: $name}) " "SET i.photoUrl = $url " "RETURN i",
-            name=name,
-            url=url,
-            database_="academicworld",
-        )
+        previous = queries.university_info(name)
+        queries.update_university(name, url)
+        result_cache.invalidate("university-info")
 
-        return [html.P(name), html.P(url)], dash.no_update
+        # The old photo is not shown anymore, and the new URL may have been
+        # cached before the image behind it changed
+        if previous:
+            photos.invalidate(previous[0])
+        photos.invalidate(url)
+
+        return [html.P(name), html.P(url)]
     elif n_clicks_2 and triggered_id == "create-uni-button":
         try:
-            neo.driver.execute_query(
-                "CREATE (i:INSTITUTE {name: $name, photoUrl: $url}) RETURN i",
-                name=name,
-                url=url,
-                database_="academicworld",
-            )
+            queries.create_university(name, url)
         except exceptions.ConstraintError as _:
-            return [html.P("Creation failed, constraint violated.")], dash.no_update
+            return [html.P("Creation failed, constraint violated.")]
+        result_cache.invalidate("university-info")
 
-        new_university_options = sorted(university_options + [name])
+        university_search.add(name)
 
-        return [html.P("Created")], new_university_options
+        return [html.P("Created")]
 
-    return [], dash.no_update
+    return []
 
 
 @app.callback(
-    Output("selected-faculty-info", "children"),
+    [Output("selected-faculty-info", "children"), Output("selected-faculty", "data")],
     [Input("faculty-keyword-graph", "clickData"), Input("faculty-dropdown", "value")],
 )
 def faculty_display_click_data(clickData, dropdown_val):
@@ -553,39 +1016,53 @@ def faculty_display_click_data(clickData, dropdown_val):
     else:
         return dash.no_update
 
-    result = mongo.execute_query("faculty", {"name": name})
-    result = list(result)
+    faculty = queries.faculty_profile(name)
 
-    if not list(result):
-        return html.P(
-            "There was an error finding this faculty member. This is likely due to a discrepancy between the data in each database."
+    if faculty is None:
+        return (
+            html.P("There was an error finding this faculty member."),
+            None,
         )
 
-    imgURL = result[0]["photoUrl"]
-    position = result[0]["position"]
-    interest = result[0]["researchInterest"]
-    email = result[0]["email"]
-    phone = result[0]["phone"]
-    uni = result[0]["affiliation"]["name"]
-
-    global selected_faculty
-    selected_faculty = result[0]["_id"]
+    imgURL = faculty.get("photoUrl")
+    position = faculty.get("position")
+    interest = faculty.get("researchInterest")
+    email = faculty.get("email")
+    phone = faculty.get("phone")
+    uni = faculty.get("university")
+    keywords = ", ".join(
+        f"{k['keyword']} ({k['krc']:.0f})" for k in faculty["keywordKrc"][:5]
+    )
 
-    return [
+    info = [
         html.H3(name),
-        html.Img(src=imgURL, style={"max-width": "100%", "height": "auto"}),
+        html.Img(
+            src=photos.src(imgURL, PHOTO_WIDTH),
+            style={"max-width": "100%", "height": "auto"},
+        ),
         html.P(f"Position: {position}"),
         html.P(f"Interest: {interest}"),
         html.P(f"Email: {email}"),
         html.P(f"Phone: {phone}"),
         html.P(f"University: {uni}"),
+    ]
+    if keywords:
+        info.append(html.P(f"Top keywords by KRC: {keywords}"))
+
+    # Reviews are kept by the id of the MongoDB document, which a faculty member
+    # only found in the other stores does not have
+    if faculty["mongoId"] is None:
+        return info, None
+
+    info.append(
         dbc.Button(
             "Open Popup",
             id="open-faculty-review",
             n_clicks=0,
             style={"display": "block", "margin": "auto"},
-        ),
-    ]
+        )
+    )
+    return info, encode_id(faculty["mongoId"])
 
 
 @app.callback(
@@ -594,9 +1071,9 @@ def faculty_display_click_data(clickData, dropdown_val):
         Output("popup-modal", "children"),
     ],
     [Input("open-faculty-review", "n_clicks")],
-    [State("popup-modal", "is_open")],
+    [State("popup-modal", "is_open"), State("selected-faculty", "data")],
 )
-def toggle_modal(n1, is_open):
+def toggle_modal(n1, is_open, selected_faculty):
     default_children = [
         dbc.ModalHeader(dbc.ModalTitle("Faculty Reviews")),
         dbc.Button("Leave a review", id="collapse-review", n_clicks=0),
@@ -624,29 +1101,74 @@ def toggle_modal(n1, is_open):
         ),
     ]
 
-    update = {"$set": {"reviews": []}}
+    if n1 and selected_faculty:
+        review_list, summary, has_next = build_review_page(selected_faculty, 0)
+        default_children += [
+            dbc.ModalBody(summary, id="review-summary"),
+            dbc.ModalBody(review_list, id="review-list"),
+            dbc.ModalFooter(
+                [
+                    dbc.Button(
+                        "Previous", id="reviews-prev", n_clicks=0, disabled=True
+                    ),
+                    dbc.Button(
+                        "Next", id="reviews-next", n_clicks=0, disabled=not has_next
+                    ),
+                ]
+            ),
+            dcc.Store(id="reviews-page", data=0),
+        ]
 
-    if n1:
-        global selected_faculty
+        return not is_open, default_children
 
-        mongo.collection.update_one(
-            {"_id": selected_faculty, "reviews": {"$exists": False}}, update
-        )
+    return is_open, default_children
 
-        result = mongo.execute_query("faculty", {"_id": selected_faculty})
 
-        if len(result[0]["reviews"]) == 0:
-            default_children.append(dbc.ModalBody("No reviews!"))
-        else:
-            default_children.append(dbc.ModalBody(html.H5("Reviews:")))
-            for r in result[0]["reviews"]:
-                default_children.append(
-                    dbc.ModalBody(f"{r['review-text']}, {r['review-rating']}/5")
-                )
+def build_review_page(faculty_id, page):
+    _id = decode_id(faculty_id)
+    if _id is None:
+        return [html.P("No reviews!")], "", False
 
-        return not is_open, default_children
+    result = result_cache.get_or_compute(
+        ("faculty-reviews", encode_id(_id), page),
+        lambda: queries.review_page(_id, page),
+    )
 
-    return is_open, default_children
+    if result["count"] == 0:
+        return [html.P("No reviews!")], "", False
+
+    review_list = [html.H5("Reviews:")] + [
+        html.P(f"{r['text']}, {r['rating']}/5") for r in result["reviews"]
+    ]
+    summary = (
+        f"Average rating: {result['average']:.1f}/5 from {result['count']} reviews"
+    )
+    return review_list, summary, result["has_next"]
+
+
+@app.callback(
+    [
+        Output("review-list", "children"),
+        Output("reviews-page", "data"),
+        Output("reviews-prev", "disabled"),
+        Output("reviews-next", "disabled"),
+    ],
+    [Input("reviews-prev", "n_clicks"), Input("reviews-next", "n_clicks")],
+    [State("reviews-page", "data"), State("selected-faculty", "data")],
+    prevent_initial_call=True,
+)
+def page_reviews(n_prev, n_next, page, selected_faculty):
+    ctx = dash.callback_context
+    triggered_id = ctx.triggered[0]["prop_id"].split(".")[0]
+
+    if triggered_id == "reviews-next":
+        page += 1
+    elif triggered_id == "reviews-prev":
+        page = max(page - 1, 0)
+
+    review_list, _, has_next = build_review_page(selected_faculty, page)
+
+    return review_list, page, page == 0, not has_next
 
 
 @app.callback(
@@ -666,14 +1188,14 @@ def toggle_collapse(n, is_open):
     [
         State("review-text", "value"),
         State("review-rating", "value"),
+        State("selected-faculty", "data"),
     ],
 )
-def submit_review(n1, text, rating):
-    if n1:
-        mongo.collection.update_one(
-            {"_id": selected_faculty},
-            {"$push": {"reviews": {"review-text": text, "review-rating": rating}}},
-        )
+def submit_review(n1, text, rating, selected_faculty):
+    faculty_id = decode_id(selected_faculty)
+    if n1 and faculty_id is not None:
+        reviews.add(faculty_id, text, rating)
+        result_cache.invalidate("faculty-reviews")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,90 @@
+// Draws the Top Universities and Top Faculty bars in the browser from the
+// per-year counts built by figures.year_histogram(), so that moving the year
+// slider or changing the number of universities does not call the server.
+(function () {
+    // Same label as figures.OTHERS_LABEL
+    var OTHERS_LABEL = "Others";
+
+    // Running count of entries [start, end) up to and including year, found
+    // with a binary search over the sorted years
+    function countUpTo(histogram, start, end, year) {
+        var lo = start;
+        var hi = end;
+        while (lo < hi) {
+            var mid = (lo + hi) >> 1;
+            if (histogram.years[mid] <= year) {
+                lo = mid + 1;
+            } else {
+                hi = mid;
+            }
+        }
+        return lo > start ? histogram.cumulative[lo - 1] : 0;
+    }
+
+    // [name, count] of every name with publications in the range, largest
+    // count first. Names with equal counts keep the server's order.
+    function rank(histogram, yearRange) {
+        var rows = [];
+        for (var i = 0; i < histogram.names.length; i++) {
+            var start = histogram.ptr[i];
+            var end = histogram.ptr[i + 1];
+            var count =
+                countUpTo(histogram, start, end, yearRange[1]) -
+                countUpTo(histogram, start, end, yearRange[0] - 1);
+            if (count > 0) {
+                rows.push([histogram.names[i], count]);
+            }
+        }
+        rows.sort(function (a, b) {
+            return b[1] - a[1];
+        });
+        if (histogram.limit) {
+            rows = rows.slice(0, histogram.limit);
+        }
+        return rows;
+    }
+
+    // Keeps the first k rows and sums the rest into a single "Others" bar. A k
+    // of 0 keeps every row.
+    function topK(rows, k) {
+        if (!k || rows.length <= k) {
+            return rows;
+        }
+        var others = 0;
+        for (var i = k; i < rows.length; i++) {
+            others += rows[i][1];
+        }
+        return rows.slice(0, k).concat([[OTHERS_LABEL, others]]);
+    }
+
+    // Copy of the figure with new bars, which keeps its layout and template
+    function withBars(figure, rows) {
+        var data = figure.data.slice();
+        data[0] = Object.assign({}, data[0], {
+            x: rows.map(function (row) {
+                return row[0];
+            }),
+            y: rows.map(function (row) {
+                return row[1];
+            }),
+        });
+        return Object.assign({}, figure, { data: data });
+    }
+
+    window.dash_clientside = Object.assign({}, window.dash_clientside, {
+        year_histogram: {
+            top_universities: function (histogram, yearRange, k, figure) {
+                if (!histogram) {
+                    return window.dash_clientside.no_update;
+                }
+                return withBars(figure, topK(rank(histogram, yearRange), k));
+            },
+            top_faculty: function (histogram, yearRange, figure) {
+                if (!histogram) {
+                    return window.dash_clientside.no_update;
+                }
+                return withBars(figure, rank(histogram, yearRange));
+            },
+        },
+    });
+})();
@@ -0,0 +1,324 @@
+import argparse
+import os
+import json
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import dash
+import dash_bootstrap_components as dbc
+import pandas as pd
+import plotly.utils
+
+from queries import Queries
+from columnar_snapshot import ENGINES, ColumnarSnapshot
+from query_executor import QueryExecutor
+from photo_utils import PhotoCache, serve_photos
+from benchmarks import dataset as ds
+from benchmarks.standins import SQLiteMySQL, GraphFake, PhotoServer, mongo_store
+import figures
+
+# Times the query and figure building path of each callback against the local
+# stand-in stores, without the result cache, at one or more scale factors of
+# the synthetic dataset. Run from the repository root:
+#
+#   python3 -m benchmarks.bench_callbacks --scale 1 10 100 --output results.json
+#   python3 -m benchmarks.bench_callbacks --baseline results.json
+#
+# The JSON has p50/p95/p99 latency in milliseconds and the peak memory allocated
+# during one call, per callback and scale factor.
+
+
+def serialize(value):
+    # The callbacks' return values are serialized to JSON by Dash, which is
+    # counted as part of the callback
+    return json.dumps(value, cls=plotly.utils.PlotlyJSONEncoder)
+
+
+class Inputs:
+    # Random but repeatable callback inputs drawn from the dataset, weighted
+    # like the dataset itself towards the popular keywords
+    def __init__(self, data, seed=1):
+        self.rng = random.Random(seed)
+        keyword_names = dict(data.keywords)
+        self.keywords = [keyword_names[k] for _, k, _ in data.publication_keyword]
+        self.faculty = [f[1] for f in data.faculty]
+        self.faculty_ids = [f[0] for f in data.faculty]
+        self.universities = [u[1] for u in data.universities]
+
+    def keyword_selection(self):
+        selection = {
+            self.rng.choice(self.keywords) for _ in range(self.rng.randint(1, 5))
+        }
+        return sorted(selection)
+
+    def year_range(self):
+        start = self.rng.randint(ds.MIN_YEAR, ds.MAX_YEAR)
+        return [start, self.rng.randint(start, ds.MAX_YEAR)]
+
+    def university_selection(self):
+        count = self.rng.randint(1, len(self.universities))
+        return self.rng.sample(self.universities, count)
+
+
+class Photos:
+    # The /photo route of the app on a fresh cache, fetching from a PhotoServer
+    def __init__(self):
+        self.server = PhotoServer().start()
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = PhotoCache(self.directory.name, widths=(400,), allow_private=True)
+        app = dash.Dash(__name__)
+        app.layout = dash.html.Div()
+        serve_photos(app, self.cache)
+        self.client = app.server.test_client()
+
+    def get(self, path):
+        src = self.cache.src(self.server.url(path), 400)
+        response = self.client.get(src)
+        response.close()
+        if response.status_code != 200:
+            raise RuntimeError(f"{src} returned {response.status_code}")
+
+    def close(self):
+        self.server.close()
+        self.directory.cleanup()
+
+
+def callbacks(queries, inputs, executor, photos):
+    # name -> function running one call with fresh inputs. The names are those
+    # of the callbacks in app.py, with the branches of update_keyword_widgets
+    # also timed on their own.
+    def keyword_widgets():
+        selection, years = inputs.keyword_selection(), inputs.year_range()
+        branches = executor.run(
+            {
+                "top-universities": lambda: queries.university_year_counts(selection),
+                "top-faculty": lambda: queries.faculty_year_counts(selection),
+                "highest-impact": lambda: queries.highest_impact(selection, years),
+            }
+        )
+        serialize(
+            [
+                figures.year_histogram(branches["top-universities"].value),
+                figures.year_histogram(branches["top-faculty"].value, limit=100),
+                figures.patch_pie(branches["highest-impact"].value),
+            ]
+        )
+
+    def top_universities():
+        rows = queries.university_year_counts(inputs.keyword_selection())
+        serialize(figures.year_histogram(rows))
+
+    def top_faculty():
+        rows = queries.faculty_year_counts(inputs.keyword_selection())
+        serialize(figures.year_histogram(rows, limit=100))
+
+    def highest_impact():
+        records = queries.highest_impact(
+            inputs.keyword_selection(), inputs.year_range()
+        )
+        serialize(figures.patch_pie(records))
+
+    def top_uni():
+        df = queries.university_summary(inputs.university_selection())
+        serialize(figures.patch_research_scatter(df))
+
+    def top_uni_full():
+        df = queries.university_summary(inputs.university_selection())
+        serialize(figures.research_scatter(df))
+
+    def cited_table():
+        profile = queries.faculty_profile(inputs.rng.choice(inputs.faculty))
+        df = pd.DataFrame(
+            [(p["title"], p["numCitations"]) for p in profile["topCited"]],
+            columns=["Publication", "Times Cited"],
+        )
+        serialize(dbc.Table.from_dataframe(df, striped=True, bordered=True, hover=True))
+
+    def university_info():
+        serialize(queries.university_info(inputs.rng.choice(inputs.universities)))
+
+    def faculty_info():
+        serialize(queries.faculty_profile(inputs.rng.choice(inputs.faculty)))
+
+    def university_photo():
+        # The photos are fetched from the server the first time only, so the
+        # median is a cached photo and the tail includes fetches
+        photos.get(f"/university/{inputs.rng.randrange(len(inputs.universities))}.png")
+
+    def review_page():
+        serialize(queries.review_page(inputs.rng.choice(inputs.faculty_ids), 0))
+
+    return {
+        "update_keyword_widgets": keyword_widgets,
+        "update_keyword_widgets.top_universities": top_universities,
+        "update_keyword_widgets.top_faculty": top_faculty,
+        "update_keyword_widgets.highest_impact": highest_impact,
+        "update_top_uni": top_uni,
+        "update_top_uni.full_figure": top_uni_full,
+        "update_cited_table": cited_table,
+        "uni_display_click_data": university_info,
+        "uni_display_click_data.photo": university_photo,
+        "faculty_display_click_data": faculty_info,
+        "toggle_modal": review_page,
+    }
+
+
+def measure(call, iterations, warmup, memory_iterations):
+    for _ in range(warmup):
+        call()
+
+    times = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        call()
+        times.append((time.perf_counter() - start) * 1000)
+
+    # Memory is traced in a separate pass, since tracing slows every allocation
+    # down and would distort the timings
+    peak = 0
+    tracemalloc.start()
+    for _ in range(memory_iterations):
+        tracemalloc.reset_peak()
+        start, _ = tracemalloc.get_traced_memory()
+        call()
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - start)
+    tracemalloc.stop()
+
+    percentiles = statistics.quantiles(times, n=100, method="inclusive")
+    return {
+        "iterations": iterations,
+        "mean_ms": round(statistics.fmean(times), 3),
+        "p50_ms": round(percentiles[49], 3),
+        "p95_ms": round(percentiles[94], 3),
+        "p99_ms": round(percentiles[98], 3),
+        "peak_memory_kib": round(peak / 1024, 1),
+    }
+
+
+def run_scale(scale, args):
+    start = time.perf_counter()
+    data = ds.generate(scale, seed=args.seed)
+    mysql = SQLiteMySQL().load(data)
+    mongo = mongo_store(data, uri=args.mongo_uri)
+    neo = GraphFake(data)
+
+    # With --snapshot, the keyword and summary widgets are answered by that
+    # engine from a snapshot in a temporary directory
+    snapshot = None
+    if args.snapshot:
+        snapshot_dir = tempfile.TemporaryDirectory()
+        snapshot = ColumnarSnapshot(
+            os.path.join(snapshot_dir.name, "analytics"), mysql, mongo, args.snapshot
+        )
+
+    queries = Queries(mysql, mongo, neo, snapshot=snapshot)
+    queries.university_stats.rebuild()
+    queries.reviews.ensure_indexes()
+    queries.faculty_profiles.rebuild()
+    if snapshot:
+        snapshot.refresh()
+    load_seconds = time.perf_counter() - start
+
+    inputs = Inputs(data, seed=args.seed + 1)
+    executor = QueryExecutor(max_workers=4)
+    photos = Photos()
+    results = {}
+    for name, call in callbacks(queries, inputs, executor, photos).items():
+        if args.only and not any(name.startswith(only) for only in args.only):
+            continue
+        results[name] = measure(
+            call, args.iterations, args.warmup, args.memory_iterations
+        )
+        print(
+            f"scale {scale:>3}  {name:<42} p50 {results[name]['p50_ms']:>9.3f}ms"
+            f"  p99 {results[name]['p99_ms']:>9.3f}ms"
+            f"  peak {results[name]['peak_memory_kib']:>9.1f}KiB",
+            file=sys.stderr,
+        )
+
+    photos.close()
+    if snapshot:
+        snapshot_dir.cleanup()
+    mysql.close()
+    mongo.close()
+    return {
+        "rows": {table: len(rows) for table, rows in data._asdict().items()},
+        "load_seconds": round(load_seconds, 3),
+        "callbacks": results,
+    }
+
+
+def commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline, report):
+    # Prints the change of each p50 and p99 against an earlier report
+    for scale, result in report["scales"].items():
+        before = baseline["scales"].get(scale, {}).get("callbacks", {})
+        for name, after in result["callbacks"].items():
+            if name not in before:
+                continue
+            changes = "  ".join(
+                f"{key[:3]} {after[key] / before[name][key] - 1:+7.1%}"
+                for key in ("p50_ms", "p99_ms")
+                if before[name][key]
+            )
+            print(f"scale {scale:>3}  {name:<42} {changes}", file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the callbacks' data paths against stand-in stores"
+    )
+    parser.add_argument("--scale", type=int, nargs="+", default=[1])
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--memory-iterations", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--only", nargs="+", help="callback name prefixes to run")
+    parser.add_argument("--mongo-uri", help="use this mongod instead of mongomock")
+    parser.add_argument(
+        "--snapshot", choices=ENGINES, help="use a columnar snapshot with this engine"
+    )
+    parser.add_argument("--output", help="write the JSON report to this file")
+    parser.add_argument("--baseline", help="compare with an earlier JSON report")
+    args = parser.parse_args(argv)
+
+    report = {
+        "commit": commit(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "mongo": args.mongo_uri or "mongomock",
+        "mysql": "sqlite",
+        "neo4j": "graph fake",
+        "snapshot": args.snapshot,
+        "seed": args.seed,
+        "scales": {str(scale): run_scale(scale, args) for scale in args.scale},
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+import argparse
+import importlib.util
+import os
+import random
+import sys
+import tempfile
+import threading
+
+from queries import Queries
+from keyword_index import KeywordIndex
+from krc_aggregates import KrcAggregates
+from columnar_snapshot import ColumnarSnapshot
+from benchmarks import dataset as ds
+from benchmarks.standins import SQLiteMySQL, GraphFake, mongo_store
+
+# Checks that the alternate engines of app.py answer the widgets with the same
+# results as the store queries they replace, on the stand-in stores and random
+# but repeatable selections. Run from the repository root:
+#
+#   python3 -m benchmarks.check_engines --scale 1 --selections 200
+#
+# Every difference is printed, and the exit status is 1 if there was any.
+
+
+def edge_cases(data):
+    # The dataset with the cases where the engines are easiest to get wrong: a
+    # publication labelled with two keywords at the same score, and another
+    # publication of the same author with the same numCitations * score, so that
+    # the KRC query's DISTINCT drops values, and a faculty member without a
+    # university, who counts for Top Faculty but not for Top Universities
+    keywords = [k for k, _ in data.keywords[:2]]
+    author = data.faculty[0][0]
+    unaffiliated = (len(data.faculty) + 1, "Unaffiliated faculty", None)
+    unaffiliated += data.faculty[0][3:]
+    first = len(data.publications) + 1
+    publications = [
+        (first, "Edge case 1", ds.MAX_YEAR, 10),
+        (first + 1, "Edge case 2", ds.MAX_YEAR - 1, 10),
+    ]
+    return data._replace(
+        faculty=data.faculty + [unaffiliated],
+        publications=data.publications + publications,
+        faculty_publication=data.faculty_publication
+        + [(author, first), (author, first + 1)]
+        + [(unaffiliated[0], pub) for pub in (first, first + 1, 1, 2, 3)],
+        publication_keyword=data.publication_keyword
+        + [(first, keywords[0], 0.5), (first, keywords[1], 0.5)]
+        + [(first + 1, keywords[0], 0.5)],
+    )
+
+
+def top_ten(records):
+    # The top ten as {name: KRC}, without the names tied with the tenth, which
+    # either query may cut off
+    if len(records) < 10:
+        return {name: round(krc, 6) for name, krc in records}
+    last = round(records[-1][1], 6)
+    return {name: round(krc, 6) for name, krc in records if round(krc, 6) > last}
+
+
+def check_krc_aggregates(queries, aggregated, inputs, selections):
+    # USE_KRC_AGGREGATES against KRC_QUERY for the Highest Impact widget
+    differences = 0
+    for _ in range(selections):
+        selection, years = inputs.keyword_selection(), inputs.year_range()
+        expected = queries.highest_impact(selection, years)
+        actual = aggregated.highest_impact(selection, years)
+        if top_ten(expected) != top_ten(actual):
+            differences += 1
+            print(f"highest_impact {selection} {years}:", file=sys.stderr)
+            print(f"  KRC_QUERY      {expected}", file=sys.stderr)
+            print(f"  krc_aggregates {actual}", file=sys.stderr)
+    return differences
+
+
+def check_year_counts(queries, engine, inputs, selections):
+    # An engine against MySQL for the Top Universities and Top Faculty widgets
+    differences = 0
+    for _ in range(selections):
+        selection = inputs.keyword_selection()
+        for name in ("university_year_counts", "faculty_year_counts"):
+            expected = sorted(getattr(queries, name)(selection))
+            actual = sorted(map(tuple, getattr(engine, name)(selection)))
+            if expected != actual:
+                differences += 1
+                print(
+                    f"{name} {selection}: {len(expected)} rows in MySQL, "
+                    f"{len(actual)} from the engine",
+                    file=sys.stderr,
+                )
+    return differences
+
+
+def check_snapshot(queries, snapshot, inputs, selections):
+    # USE_SNAPSHOT against MySQL and university_stats for the Top Universities,
+    # Top Faculty and Total Research widgets
+    differences = check_year_counts(queries, snapshot, inputs, selections)
+    for _ in range(selections):
+        universities = inputs.university_selection()
+        expected = queries.university_summary(universities)
+        actual = snapshot.university_summary(universities)
+        if not expected.sort_values("university", ignore_index=True).equals(
+            actual.sort_values("university", ignore_index=True)
+        ):
+            differences += 1
+            print(f"university_summary {universities} differs", file=sys.stderr)
+    return differences
+
+
+def check_swap(snapshot, reader, selections):
+    # Reads through reader, a second ColumnarSnapshot of the same path as
+    # another worker process would have, while snapshot is refreshed over and
+    # over. A read that fails or sees other rows than before counts as one.
+    expected = sorted(reader.university_summary())
+    done = threading.Event()
+
+    def refresh():
+        while not done.is_set():
+            snapshot.refresh()
+
+    refresher = threading.Thread(target=refresh)
+    refresher.start()
+    differences = 0
+    try:
+        for _ in range(selections):
+            try:
+                if sorted(reader.university_summary()) != expected:
+                    differences += 1
+                    print(
+                        "university_summary changed during a refresh", file=sys.stderr
+                    )
+            except Exception as err:
+                differences += 1
+                print(
+                    f"university_summary failed during a refresh: {err!r}",
+                    file=sys.stderr,
+                )
+    finally:
+        done.set()
+        refresher.join()
+    return differences
+
+
+class Inputs:
+    # Keyword selections weighted towards the popular keywords, always with the
+    # keywords of the edge cases among the choices
+    def __init__(self, data, seed):
+        self.rng = random.Random(seed)
+        keyword_names = dict(data.keywords)
+        self.keywords = [keyword_names[k] for _, k, _ in data.publication_keyword]
+        self.edge_keywords = [name for _, name in data.keywords[:2]]
+        self.universities = [u[1] for u in data.universities]
+
+    def keyword_selection(self):
+        selection = {
+            self.rng.choice(self.keywords) for _ in range(self.rng.randint(1, 5))
+        }
+        if self.rng.random() < 0.25:
+            selection.update(self.edge_keywords)
+        return sorted(selection)
+
+    def university_selection(self):
+        count = self.rng.randint(1, len(self.universities))
+        return self.rng.sample(self.universities, count)
+
+    def year_range(self):
+        start = self.rng.randint(ds.MIN_YEAR, ds.MAX_YEAR)
+        return [start, self.rng.randint(start, ds.MAX_YEAR)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Check the alternate engines against the store queries"
+    )
+    parser.add_argument("--scale", type=int, default=1)
+    parser.add_argument("--selections", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    # The faculty documents in MongoDB all have an affiliation, so they are
+    # loaded without the edge cases, which no check reads from MongoDB
+    generated = ds.generate(args.scale, seed=args.seed)
+    data = edge_cases(generated)
+    mysql = SQLiteMySQL().load(data)
+    mongo = mongo_store(generated)
+    neo = GraphFake(data)
+
+    krc_aggregates = KrcAggregates(neo)
+    krc_aggregates.rebuild()
+
+    queries = Queries(mysql, mongo, neo)
+    aggregated = Queries(mysql, mongo, neo, krc_aggregates=krc_aggregates)
+
+    keyword_index = Queries(mysql, mongo, neo, KeywordIndex().load(mysql))
+
+    checks = {
+        "keyword_index": lambda inputs: check_year_counts(
+            queries, keyword_index, inputs, args.selections
+        ),
+        "krc_aggregates": lambda inputs: check_krc_aggregates(
+            queries, aggregated, inputs, args.selections
+        ),
+    }
+
+    # The snapshot engines are optional dependencies, and only checked when
+    # installed
+    directory = tempfile.TemporaryDirectory()
+    queries.university_stats.rebuild()
+    for engine, module in (("duckdb", "duckdb"), ("parquet", "pyarrow")):
+        if importlib.util.find_spec(module) is None:
+            print(f"snapshot {engine:<7} skipped, {module} is not installed")
+            continue
+        snapshot = ColumnarSnapshot(
+            os.path.join(directory.name, engine), mysql, mongo, engine
+        )
+        snapshot.refresh()
+        from_snapshot = Queries(mysql, mongo, neo, snapshot=snapshot)
+        checks[f"snapshot {engine}"] = lambda inputs, q=from_snapshot: check_snapshot(
+            queries, q, inputs, args.selections
+        )
+
+        # The same snapshot as opened by another worker process
+        reader = ColumnarSnapshot(snapshot.path, mysql, mongo, engine)
+        checks[f"swap {engine}"] = lambda inputs, s=snapshot, r=reader: check_swap(
+            s, r, args.selections
+        )
+
+    failed = False
+    for name, check in checks.items():
+        differences = check(Inputs(data, args.seed + 1))
+        print(f"{name:<16} {differences} of {args.selections} selections differ")
+        failed = failed or differences > 0
+
+    directory.cleanup()
+    mysql.close()
+    mongo.close()
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,153 @@
+import random
+from collections import namedtuple
+
+# Size of the synthetic Academic World dataset at scale factor 1. Every count is
+# multiplied by the scale factor, except the keywords which stay a fixed
+# vocabulary as in the real data.
+BASE_UNIVERSITIES = 40
+BASE_FACULTY = 400
+BASE_PUBLICATIONS = 4000
+KEYWORDS = 500
+
+MIN_YEAR = 1980
+MAX_YEAR = 2023
+
+Dataset = namedtuple(
+    "Dataset",
+    [
+        "universities",  # (id, name, photo url)
+        "faculty",  # (id, name, university id, position, interest, email, phone, photo url)
+        "keywords",  # (id, name)
+        "publications",  # (id, title, year, citations)
+        "faculty_publication",  # (faculty id, publication id)
+        "publication_keyword",  # (publication id, keyword id, score)
+    ],
+)
+
+POSITIONS = ["Professor", "Associate Professor", "Assistant Professor", "Lecturer"]
+
+
+def generate(scale=1, seed=0):
+    # Builds a dataset with the shape of Academic World: a few very popular
+    # keywords and many rare ones, a handful of large universities, and most
+    # publications written by one to three faculty members
+    rng = random.Random(seed)
+
+    universities = [
+        (i, f"University {i}", f"https://example.org/university/{i}.png")
+        for i in range(1, BASE_UNIVERSITIES * scale + 1)
+    ]
+
+    faculty = []
+    for i in range(1, BASE_FACULTY * scale + 1):
+        university = int(rng.paretovariate(1.2)) % len(universities) + 1
+        faculty.append(
+            (
+                i,
+                f"Faculty {i}",
+                university,
+                rng.choice(POSITIONS),
+                f"Interest {rng.randint(1, KEYWORDS)}",
+                f"faculty{i}@example.org",
+                f"555-{i:07d}",
+                f"https://example.org/faculty/{i}.png",
+            )
+        )
+
+    keywords = [(i, f"keyword {i}") for i in range(1, KEYWORDS + 1)]
+
+    publications = []
+    faculty_publication = []
+    publication_keyword = []
+    for i in range(1, BASE_PUBLICATIONS * scale + 1):
+        publications.append(
+            (
+                i,
+                f"Publication {i}",
+                rng.randint(MIN_YEAR, MAX_YEAR),
+                int(rng.expovariate(1 / 30)),
+            )
+        )
+        for author in rng.sample(range(1, len(faculty) + 1), rng.randint(1, 3)):
+            faculty_publication.append((author, i))
+        count = rng.randint(1, 5)
+        picked = set()
+        while len(picked) < count:
+            picked.add(int(rng.paretovariate(0.8)) % KEYWORDS + 1)
+        for keyword in picked:
+            publication_keyword.append((i, keyword, round(rng.random(), 4)))
+
+    return Dataset(
+        universities,
+        faculty,
+        keywords,
+        publications,
+        faculty_publication,
+        publication_keyword,
+    )
+
+
+def faculty_documents(dataset):
+    # The faculty collection of MongoDB, with the affiliation, keywords and
+    # publication ids embedded in each document
+    universities = {u[0]: u for u in dataset.universities}
+    keyword_names = dict(dataset.keywords)
+
+    pub_keywords = {}
+    for pub, keyword, score in dataset.publication_keyword:
+        pub_keywords.setdefault(pub, []).append((keyword, score))
+
+    publications = {}
+    for fac, pub in dataset.faculty_publication:
+        publications.setdefault(fac, []).append(pub)
+
+    docs = []
+    for (
+        fac_id,
+        name,
+        uni_id,
+        position,
+        interest,
+        email,
+        phone,
+        photo,
+    ) in dataset.faculty:
+        scores = {}
+        for pub in publications.get(fac_id, []):
+            for keyword, score in pub_keywords.get(pub, []):
+                scores[keyword] = max(score, scores.get(keyword, 0))
+
+        university = universities[uni_id]
+        docs.append(
+            {
+                "_id": fac_id,
+                "id": fac_id,
+                "name": name,
+                "position": position,
+                "researchInterest": interest,
+                "email": email,
+                "phone": phone,
+                "photoUrl": photo,
+                "affiliation": {
+                    "id": university[0],
+                    "name": university[1],
+                    "photoUrl": university[2],
+                },
+                "keywords": [
+                    {"id": k, "name": keyword_names[k], "score": s}
+                    for k, s in scores.items()
+                ],
+                "publications": publications.get(fac_id, []),
+            }
+        )
+    return docs
+
+
+def reviews(dataset, per_faculty=3, seed=0):
+    # (faculty id, text, rating) for a few reviews of every faculty member
+    rng = random.Random(seed)
+    return [
+        (fac[0], f"Review {n} of {fac[1]}", rng.randint(1, 5))
+        for fac in dataset.faculty
+        for n in range(rng.randint(0, per_faculty * 2))
+    ]
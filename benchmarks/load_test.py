@@ -0,0 +1,456 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import platform
+import random
+import re
+import statistics
+import sys
+import threading
+import time
+from collections import defaultdict
+
+import requests
+
+import mongodb_utils
+import mysql_utils
+import neo4j_utils
+from benchmarks import dataset as ds
+from benchmarks.bench_callbacks import commit
+from benchmarks.standins import SQLiteMySQL, GraphFake, mongo_store
+
+# Replays user sessions against app.py as HTTP requests, the way the browser
+# sends them, with a number of simultaneous users that is ramped up and then held.
+# By default the app is served from a separate process on the stand-in stores of
+# the synthetic dataset. Run from the repository root:
+#
+#   python3 -m benchmarks.load_test --users 10 50 100 --output load.json
+#   python3 -m benchmarks.load_test --url http://localhost:8050 --users 20
+#
+# Each user loads the page, types and picks keywords, moves the year slider,
+# picks a faculty member, opens their reviews and sometimes submits one, with a
+# think time between the steps. The JSON has the throughput, latency percentiles
+# and error rates per step, and the saturation of each store: how many of its
+# queries were in flight on average, from the /metrics of the app.
+
+# Line of a query latency sum or count on /metrics
+_QUERY_METRIC = re.compile(
+    r'^\w+_query_seconds_(sum|count)\{store="(\w+)",operation="(\w+)"\} (\S+)$'
+)
+
+
+class DashClient:
+    # One browser tab of a user. It keeps the props of the components on the
+    # page, from the layout and the callback responses, and runs the server
+    # callbacks whose inputs changed, as the Dash renderer does. Clientside
+    # callbacks are skipped.
+    def __init__(self, url, timings, timeout=60):
+        self.url = url.rstrip("/")
+        self.timings = timings
+        self.timeout = timeout
+        self.http = requests.Session()
+        self.props = {}
+        self.dependencies = []
+
+    def load(self):
+        # The page, the layout and the callback list, then the callbacks that run
+        # when the page is loaded
+        self.request("page", "GET", "/")
+        layout = self.request("page", "GET", "/_dash-layout")
+        self.dependencies = [
+            dependency
+            for dependency in self.request("page", "GET", "/_dash-dependencies")
+            if not dependency.get("clientside_function")
+        ]
+        self.props = {}
+        self._collect(layout)
+        updated = []
+        for dependency in self.dependencies:
+            if not dependency.get("prevent_initial_call"):
+                updated += self._run(dependency, [], "page")
+        self._trigger(updated, "page")
+
+    def set(self, prop, value, step):
+        # Sets "id.property" as the user would, and runs what it triggers
+        self.props[prop] = value
+        self._trigger([prop], step)
+
+    def click(self, component_id, step):
+        clicks = self.props.get(f"{component_id}.n_clicks") or 0
+        self.set(f"{component_id}.n_clicks", clicks + 1, step)
+
+    def options(self, dropdown_id, text, step):
+        # Types text in a dropdown and returns the options it is offered
+        self.set(f"{dropdown_id}.search_value", text, step)
+        return [
+            option["value"] if isinstance(option, dict) else option
+            for option in self.props.get(f"{dropdown_id}.options") or []
+        ]
+
+    def request(self, step, method, path, **kwargs):
+        start = time.perf_counter()
+        error = False
+        try:
+            response = self.http.request(
+                method, self.url + path, timeout=self.timeout, **kwargs
+            )
+            error = response.status_code >= 400
+            if response.status_code == 200 and response.headers.get(
+                "Content-Type", ""
+            ).startswith("application/json"):
+                return response.json()
+            return None
+        except requests.RequestException:
+            error = True
+            return None
+        finally:
+            self.timings.add(step, start, time.perf_counter() - start, error)
+
+    def _trigger(self, changed, step, rounds=10):
+        # Runs the callbacks with a changed input, and then the ones that their
+        # outputs trigger in turn
+        for _ in range(rounds):
+            if not changed:
+                break
+            changed_now, changed = set(changed), []
+            for dependency in self.dependencies:
+                inputs = {_prop(i) for i in dependency["inputs"]}
+                if inputs & changed_now:
+                    changed += self._run(dependency, sorted(inputs & changed_now), step)
+
+    def _run(self, dependency, changed, step):
+        outputs = _outputs(dependency["output"])
+        body = {
+            "output": dependency["output"],
+            "outputs": outputs if dependency["output"].startswith("..") else outputs[0],
+            "inputs": [self._value(i) for i in dependency["inputs"]],
+            "state": [self._value(s) for s in dependency["state"]],
+            "changedPropIds": changed,
+        }
+        reply = self.request(step, "POST", "/_dash-update-component", json=body)
+        if reply is None:
+            return []
+
+        updated = []
+        for component_id, props in reply.get("response", {}).items():
+            for name, value in props.items():
+                self.props[f"{component_id}.{name}"] = value
+                self._collect(value)
+                updated.append(f"{component_id}.{name}")
+        return updated
+
+    def _value(self, dependency):
+        value = {"id": dependency["id"], "property": dependency["property"]}
+        value["value"] = self.props.get(_prop(dependency))
+        return value
+
+    def _collect(self, value):
+        # Records the props of the components in a layout or a children prop
+        if isinstance(value, list):
+            for item in value:
+                self._collect(item)
+        elif isinstance(value, dict) and "props" in value and "type" in value:
+            props = value["props"]
+            if isinstance(props.get("id"), str):
+                for name, prop in props.items():
+                    self.props[f"{props['id']}.{name}"] = prop
+            for prop in props.values():
+                self._collect(prop)
+
+    def poll(self, interval_id, step, limit=120):
+        # Fires an enabled dcc.Interval until its callback disables it, as with
+        # the background jobs
+        while limit and self.props.get(f"{interval_id}.disabled") is False:
+            time.sleep((self.props.get(f"{interval_id}.interval") or 1000) / 1000)
+            intervals = self.props.get(f"{interval_id}.n_intervals") or 0
+            self.set(f"{interval_id}.n_intervals", intervals + 1, step)
+            limit -= 1
+
+
+def _prop(dependency):
+    return f"{dependency['id']}.{dependency['property']}"
+
+
+def _outputs(output):
+    # "id.property" or "..id.property...id.property..", where a property may end
+    # in "@hash" when it is an allow_duplicate output
+    specs = output[2:-2].split("...") if output.startswith("..") else [output]
+    outputs = []
+    for spec in specs:
+        component_id, prop = spec.rsplit(".", 1)
+        outputs.append({"id": component_id, "property": prop.split("@")[0]})
+    return outputs
+
+
+class Timings:
+    # Latency and errors of every request by session step, with its start time so
+    # that the ramp-up can be left out
+    def __init__(self):
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def add(self, step, start, seconds, error):
+        with self._lock:
+            self.requests.append((step, start, seconds, error))
+
+
+class User:
+    # Plays sessions in a loop until stopped. Most of the time of a user is spent
+    # thinking, exponentially distributed around think_time seconds.
+    def __init__(self, url, timings, rng, think_time, submit_rate):
+        self.client = DashClient(url, timings)
+        self.rng = rng
+        self.think_time = think_time
+        self.submit_rate = submit_rate
+
+    def run(self, stop):
+        while not stop.is_set():
+            self.session(stop)
+
+    def think(self, stop):
+        if self.think_time:
+            stop.wait(self.rng.expovariate(1 / self.think_time))
+
+    def pick(self, dropdown_id, step):
+        # Types a letter and then the start of one of the names it finds, and
+        # returns that name
+        letters = "abcdefghijklmnopqrstuvwxyz"
+        for letter in self.rng.sample(letters, len(letters)):
+            options = self.client.options(dropdown_id, letter, step)
+            if options:
+                name = self.rng.choice(options)
+                return self.rng.choice(
+                    self.client.options(dropdown_id, name[:3], step) or [name]
+                )
+        return None
+
+    def session(self, stop):
+        client = self.client
+        client.load()
+        self.think(stop)
+
+        keywords = []
+        for _ in range(self.rng.randint(1, 3)):
+            keyword = self.pick("keywords-dropdown", "keyword")
+            if keyword is None or stop.is_set():
+                break
+            keywords.append(keyword)
+            client.set("keywords-dropdown.value", list(keywords), "keyword")
+            client.poll("keyword-job-poll", "keyword")
+            self.think(stop)
+
+        low = client.props.get("year-range-slider.min") or ds.MIN_YEAR
+        high = client.props.get("year-range-slider.max") or ds.MAX_YEAR
+        for _ in range(self.rng.randint(0, 2)):
+            years = sorted(self.rng.randint(low, high) for _ in range(2))
+            client.set("year-range-slider.value", years, "slider")
+            self.think(stop)
+
+        faculty = self.pick("faculty-dropdown", "faculty")
+        if faculty is None or stop.is_set():
+            return
+        client.set("faculty-dropdown.value", faculty, "faculty")
+        self.think(stop)
+
+        # The reviews button is only shown for faculty members with a document
+        if "open-faculty-review.n_clicks" not in client.props:
+            return
+        client.click("open-faculty-review", "reviews")
+        self.think(stop)
+
+        if self.rng.random() < self.submit_rate and not stop.is_set():
+            client.click("collapse-review", "review_submit")
+            client.props["review-text.value"] = "Load test review"
+            client.props["review-rating.value"] = self.rng.randint(1, 5)
+            client.click("submit-review", "review_submit")
+            self.think(stop)
+
+
+def store_seconds(url):
+    # (store, "sum" or "count") -> total over the operations, from /metrics
+    totals = defaultdict(float)
+    try:
+        text = requests.get(url.rstrip("/") + "/metrics", timeout=10).text
+    except requests.RequestException:
+        return totals
+    for line in text.splitlines():
+        match = _QUERY_METRIC.match(line)
+        if match:
+            kind, store, _, value = match.groups()
+            totals[(store, kind)] += float(value)
+    return totals
+
+
+def percentiles(values):
+    if len(values) < 2:
+        values = values * 2 or [0.0, 0.0]
+    cuts = statistics.quantiles(values, n=100, method="inclusive")
+    return {
+        "p50_ms": round(cuts[49] * 1000, 3),
+        "p95_ms": round(cuts[94] * 1000, 3),
+        "p99_ms": round(cuts[98] * 1000, 3),
+    }
+
+
+def run_level(url, users, args):
+    # Starts the users evenly over the ramp-up, holds them for the duration, and
+    # reports the requests that started after the ramp-up
+    timings = Timings()
+    stop = threading.Event()
+    threads = []
+
+    ramp_start = time.perf_counter()
+    for i in range(users):
+        rng = random.Random(args.seed * 100003 + i)
+        user = User(url, timings, rng, args.think_time, args.submit_rate)
+        thread = threading.Thread(target=user.run, args=(stop,), daemon=True)
+        thread.start()
+        threads.append(thread)
+        stop.wait(args.ramp_up / users)
+
+    before = store_seconds(url)
+    hold_start = time.perf_counter()
+    stop.wait(args.duration)
+    hold_seconds = time.perf_counter() - hold_start
+    after = store_seconds(url)
+
+    stop.set()
+    for thread in threads:
+        thread.join(timeout=args.timeout)
+
+    held = [r for r in timings.requests if r[1] >= hold_start]
+    steps = defaultdict(list)
+    for step, _, seconds, error in held:
+        steps[step].append((seconds, error))
+
+    result = {
+        "users": users,
+        "ramp_up_seconds": round(hold_start - ramp_start, 3),
+        "seconds": round(hold_seconds, 3),
+        "requests": len(held),
+        "requests_per_second": round(len(held) / hold_seconds, 3),
+        "error_rate": round(sum(r[3] for r in held) / len(held), 4) if held else 0,
+        **percentiles([r[2] for r in held]),
+        "steps": {},
+        "stores": {},
+    }
+    for step, values in sorted(steps.items()):
+        result["steps"][step] = {
+            "requests": len(values),
+            "requests_per_second": round(len(values) / hold_seconds, 3),
+            "error_rate": round(sum(e for _, e in values) / len(values), 4),
+            **percentiles([s for s, _ in values]),
+        }
+
+    # The seconds spent in the queries of a store per second is the number of
+    # its queries in flight on average. One shared connection, or lock, is
+    # saturated as it gets close to 1.
+    for store in sorted({store for store, _ in after}):
+        seconds = after[(store, "sum")] - before.get((store, "sum"), 0)
+        count = after[(store, "count")] - before.get((store, "count"), 0)
+        result["stores"][store] = {
+            "queries_per_second": round(count / hold_seconds, 3),
+            "mean_query_ms": round(1000 * seconds / count, 3) if count else 0,
+            "queries_in_flight": round(seconds / hold_seconds, 3),
+        }
+
+    print(
+        f"users {users:>4}  {result['requests_per_second']:>8.1f} req/s"
+        f"  p50 {result['p50_ms']:>9.1f}ms  p99 {result['p99_ms']:>9.1f}ms"
+        f"  errors {result['error_rate']:>6.1%}  "
+        + "  ".join(
+            f"{store} {values['queries_in_flight']:.2f}"
+            for store, values in result["stores"].items()
+        ),
+        file=sys.stderr,
+    )
+    return result
+
+
+def serve(scale, seed, mongo_uri, ports):
+    # Serves app.py on the stand-in stores in this process, and puts the port it
+    # listens on in ports
+    from werkzeug.serving import make_server
+
+    data = ds.generate(scale, seed=seed)
+    mysql = SQLiteMySQL().load(data)
+    mongo = mongo_store(data, uri=mongo_uri)
+    neo = GraphFake(data)
+
+    # app.py opens its stores when it is imported, which then get the stand-ins
+    mysql_utils.MySQL = lambda *args, **kwargs: mysql
+    mongodb_utils.MongoDB = lambda *args, **kwargs: mongo
+    neo4j_utils.Neo4j = lambda *args, **kwargs: neo
+    import app
+
+    for store in (mysql, mongo, neo):
+        store.metrics = app.metrics
+    if mongo_uri:
+        # Registers the command listener on a new client
+        mongo.connect()
+
+    # Each request would be logged otherwise
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    server = make_server("127.0.0.1", 0, app.server, threaded=True)
+    ports.put(server.server_port)
+    server.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Load test the Dash callbacks with simultaneous user sessions"
+    )
+    parser.add_argument("--users", type=int, nargs="+", default=[10])
+    parser.add_argument("--ramp-up", type=float, default=10)
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--think-time", type=float, default=1)
+    parser.add_argument("--submit-rate", type=float, default=0.1)
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--scale", type=int, default=1)
+    parser.add_argument("--mongo-uri", help="use this mongod instead of mongomock")
+    parser.add_argument("--url", help="load test this running app instead")
+    parser.add_argument("--output", help="write the JSON report to this file")
+    args = parser.parse_args(argv)
+
+    server = None
+    url = args.url
+    if url is None:
+        # The app gets a process of its own, so that the users do not compete
+        # with it for the interpreter
+        ports = multiprocessing.get_context("fork").Queue()
+        server = multiprocessing.get_context("fork").Process(
+            target=serve,
+            args=(args.scale, args.seed, args.mongo_uri, ports),
+            daemon=True,
+        )
+        server.start()
+        url = f"http://127.0.0.1:{ports.get(timeout=600)}"
+
+    try:
+        report = {
+            "commit": commit(),
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "url": args.url,
+            "stores": None if args.url else "stand-ins",
+            "scale": None if args.url else args.scale,
+            "think_time": args.think_time,
+            "seed": args.seed,
+            "levels": [run_level(url, users, args) for users in args.users],
+        }
+    finally:
+        if server is not None:
+            server.terminate()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,593 @@
+import sqlite3
+import struct
+import threading
+import time
+import zlib
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import bson
+from bson.raw_bson import RawBSONDocument
+
+from mongodb_utils import MongoDB
+from metrics_utils import TimedCursor, query_timer
+from index_utils import MYSQL_INDEXES, MONGO_INDEXES
+from faculty_profiles import KEYWORD_KRC_QUERY
+from krc_aggregates import (
+    REBUILD_QUERY,
+    TOP_FACULTY_QUERY,
+    FACULTY_QUERY,
+    PUBLICATION_FACULTY_QUERY,
+    IS_EMPTY_QUERY,
+)
+from queries import (
+    KRC_QUERY,
+    UNIVERSITY_INFO_QUERY,
+    UPDATE_UNIVERSITY_QUERY,
+    CREATE_UNIVERSITY_QUERY,
+)
+from benchmarks import dataset as ds
+
+# Local stores with the interfaces of MySQL, MongoDB and Neo4j in this app, so the
+# callbacks' data paths can be timed without any database server:
+#   MySQL   -> SQLite in memory, with the same tables and indexes
+#   MongoDB -> mongomock, or a local mongod when a URI is given
+#   Neo4j   -> GraphFake, which answers the Cypher queries of queries.py in Python
+#   Photos  -> PhotoServer, a local HTTP server for the photo cache to fetch from
+
+MYSQL_SCHEMA = [
+    "CREATE TABLE university (id INTEGER PRIMARY KEY, name TEXT, photo_url TEXT)",
+    "CREATE TABLE faculty (id INTEGER PRIMARY KEY, name TEXT, university_id INTEGER, "
+    "position TEXT, research_interest TEXT, email TEXT, phone TEXT, photo_url TEXT)",
+    "CREATE TABLE keyword (id INTEGER PRIMARY KEY, name TEXT)",
+    "CREATE TABLE publication (id INTEGER PRIMARY KEY, title TEXT, year INTEGER, "
+    "num_citations INTEGER)",
+    "CREATE TABLE faculty_publication (faculty_id INTEGER, publication_id INTEGER)",
+    "CREATE TABLE publication_keyword (publication_id INTEGER, keyword_id INTEGER, "
+    "score REAL)",
+]
+
+
+class SQLiteMySQL:
+    # Same interface as mysql_utils.MySQL on an in-memory SQLite database. The
+    # %s placeholders are rewritten for SQLite. Queries are timed in metrics
+    # when it is set, as in mysql_utils.MySQL.
+    def __init__(self, path=":memory:", metrics=None):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.metrics = metrics
+        self._lock = threading.Lock()
+        self._limits = threading.local()
+
+    def connect(self):
+        return True
+
+    @contextmanager
+    def time_limit(self, seconds):
+        # Statements run by this thread in the block are interrupted after
+        # seconds, as MAX_EXECUTION_TIME does in MySQL
+        previous = getattr(self._limits, "deadline", None)
+        self._limits.deadline = time.monotonic() + seconds
+        try:
+            yield
+        finally:
+            self._limits.deadline = previous
+
+    def load(self, data):
+        with self._lock:
+            for statement in MYSQL_SCHEMA:
+                self.connection.execute(statement)
+            for table, rows in [
+                ("university", data.universities),
+                ("faculty", data.faculty),
+                ("keyword", data.keywords),
+                ("publication", data.publications),
+                ("faculty_publication", data.faculty_publication),
+                ("publication_keyword", data.publication_keyword),
+            ]:
+                marks = ", ".join("?" * len(rows[0]))
+                self.connection.executemany(
+                    f"INSERT INTO {table} VALUES ({marks})", rows
+                )
+            for table, column in MYSQL_INDEXES:
+                self.connection.execute(
+                    f"CREATE INDEX idx_{table}_{column} ON {table} ({column})"
+                )
+            self.connection.commit()
+        return self
+
+    @contextmanager
+    def session(self):
+        with self._session() as cursor:
+            if self.metrics is None:
+                yield cursor
+            else:
+                yield TimedCursor(cursor, self.metrics, "mysql")
+
+    def execute_query(self, query, params=None, operation="execute_query"):
+        with query_timer(self.metrics, "mysql", operation, query, params) as t:
+            with self._session() as cursor:
+                cursor.execute(query, params)
+                rows = cursor.fetchall()
+            t.rows = len(rows)
+        return rows
+
+    def execute_prepared(self, query, params):
+        return self.execute_query(query, params, "execute_prepared")
+
+    def stream(self, query, params=None, batch_size=1000, timeout=None):
+        with query_timer(self.metrics, "mysql", "stream", query, params) as t:
+            with self._session() as cursor:
+                cursor.execute(query, params)
+                while rows := cursor.fetchmany(batch_size):
+                    t.rows += len(rows)
+                    yield from rows
+
+    @contextmanager
+    def _session(self):
+        with self._lock:
+            deadline = getattr(self._limits, "deadline", None)
+            if deadline is not None:
+                self.connection.set_progress_handler(
+                    lambda: time.monotonic() > deadline, 10000
+                )
+            try:
+                yield _Cursor(self.connection.cursor())
+            finally:
+                if deadline is not None:
+                    self.connection.set_progress_handler(None, 0)
+
+    def close(self):
+        self.connection.close()
+
+
+class _Cursor:
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    @property
+    def description(self):
+        return self.cursor.description
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+    def execute(self, query, params=None):
+        self.cursor.execute(query.replace("%s", "?"), params or ())
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def fetchmany(self, size):
+        return self.cursor.fetchmany(size)
+
+
+def mongo_store(data, uri=None, database="academicworld_bench"):
+    # Returns a MongoDB loaded with the faculty documents and reviews of the
+    # dataset. Without a URI the data lives in mongomock. With one, the given
+    # database on that server is dropped and loaded again.
+    mongo = MongoDB(database=database)
+    if uri:
+        mongo.host = uri
+        mongo.connect()
+        mongo.client.drop_database(database)
+    else:
+        import mongomock
+
+        mongo.client = mongomock.MongoClient()
+        mongo.db = _LookupDatabase(mongo.client[database], mongo)
+
+    mongo.db["faculty"].insert_many(ds.faculty_documents(data))
+
+    reviews = ds.reviews(data)
+    if reviews:
+        mongo.db["reviews"].insert_many(
+            [
+                {"faculty_id": fac, "text": text, "rating": rating, "created": i}
+                for i, (fac, text, rating) in enumerate(reviews)
+            ]
+        )
+        summaries = defaultdict(lambda: {"count": 0, "total": 0})
+        for fac, _, rating in reviews:
+            summaries[fac]["count"] += 1
+            summaries[fac]["total"] += rating
+        mongo.db["review_summary"].insert_many(
+            [{"_id": fac, **summary} for fac, summary in summaries.items()]
+        )
+
+    for collection, field in MONGO_INDEXES:
+        if collection != "university_stats":
+            mongo.db[collection].create_index(field)
+    return mongo
+
+
+# mongomock collection methods, and the command that MongoListener would time
+# them as on a server
+_MONGO_COMMANDS = {
+    "find_one": "find",
+    "insert_one": "insert",
+    "insert_many": "insert",
+    "update_one": "update",
+    "update_many": "update",
+    "replace_one": "update",
+    "bulk_write": "update",
+    "delete_many": "delete",
+    "count_documents": "aggregate",
+    "distinct": "distinct",
+}
+
+
+class _LookupDatabase:
+    # mongomock does not run $lookup stages with a sub-pipeline, which
+    # Reviews.page() uses, nor the final $merge of Reviews.add(). Its
+    # collections are wrapped to run those stages here.
+    # mongomock does not send commands either, so the collections time their
+    # calls in the metrics of the MongoDB, when it has them.
+    def __init__(self, db, mongo):
+        self._db = db
+        self._mongo = mongo
+
+    def __getitem__(self, name):
+        return _LookupCollection(self._db[name], self)
+
+    def __getattr__(self, name):
+        return getattr(self._db, name)
+
+
+class _LookupCollection:
+    def __init__(self, collection, db):
+        self._collection = collection
+        self._lookup_db = db
+
+    def __getattr__(self, name):
+        attribute = getattr(self._collection, name)
+        metrics = self._lookup_db._mongo.metrics
+        if name not in _MONGO_COMMANDS or metrics is None:
+            return attribute
+
+        def timed(*args, **kwargs):
+            with metrics.query("mongodb", _MONGO_COMMANDS[name], name):
+                return attribute(*args, **kwargs)
+
+        return timed
+
+    def find(self, *args, **kwargs):
+        return _TimedCursor(
+            self._collection.find(*args, **kwargs), self._lookup_db._mongo.metrics
+        )
+
+    def aggregate(self, pipeline, **kwargs):
+        metrics = self._lookup_db._mongo.metrics
+        if metrics is None:
+            return self._aggregate(pipeline, **kwargs)
+        with metrics.query("mongodb", "aggregate", pipeline) as t:
+            docs = list(self._aggregate(pipeline, **kwargs))
+            t.rows = len(docs)
+        return iter(docs)
+
+    def _aggregate(self, pipeline, **kwargs):
+        merge = pipeline[-1].get("$merge") if pipeline else None
+        if merge:
+            # Only replacing or inserting documents by _id is supported
+            target = self._lookup_db._db[merge["into"]]
+            for doc in self._aggregate(pipeline[:-1], **kwargs):
+                target.replace_one({"_id": doc["_id"]}, doc, upsert=True)
+            return iter([])
+
+        for i, stage in enumerate(pipeline):
+            lookup = stage.get("$lookup", {})
+            if "pipeline" not in lookup:
+                continue
+
+            docs = list(self._aggregate(pipeline[:i], **kwargs))
+            foreign = self._lookup_db[lookup["from"]]
+            for doc in docs:
+                # Only uncorrelated sub-pipelines, without "let", are supported
+                doc[lookup["as"]] = list(foreign._aggregate(lookup["pipeline"]))
+
+            rest = pipeline[i + 1 :]
+            if not rest:
+                return iter(docs)
+
+            scratch = self._lookup_db._db["_lookup_scratch"]
+            scratch.drop()
+            if docs:
+                scratch.insert_many(docs)
+            return _LookupCollection(scratch, self._lookup_db)._aggregate(rest)
+
+        return self._collection.aggregate(pipeline, **kwargs)
+
+    def with_options(self, codec_options=None, **kwargs):
+        # mongomock only returns dicts, which are encoded here for the
+        # RawBSONDocument reads of MongoDB.find_records()
+        if (
+            codec_options is not None
+            and codec_options.document_class is RawBSONDocument
+        ):
+            return _RawCollection(self._collection, self._lookup_db._mongo.metrics)
+        return _LookupCollection(
+            self._collection.with_options(codec_options=codec_options, **kwargs),
+            self._lookup_db,
+        )
+
+
+class _RawCollection:
+    def __init__(self, collection, metrics):
+        self._collection = collection
+        self._metrics = metrics
+
+    def find(self, *args, **kwargs):
+        return _TimedCursor(
+            self._collection.find(*args, **kwargs), self._metrics, raw=True
+        )
+
+
+class _TimedCursor:
+    # mongomock finds the documents when the cursor is first iterated, which is
+    # when the find is timed
+    def __init__(self, cursor, metrics, raw=False):
+        self._cursor = cursor
+        self._metrics = metrics
+        self._raw = raw
+
+    def __getattr__(self, name):
+        attribute = getattr(self._cursor, name)
+        if name not in ("sort", "skip", "limit", "batch_size"):
+            return attribute
+
+        def chained(*args, **kwargs):
+            attribute(*args, **kwargs)
+            return self
+
+        return chained
+
+    def __iter__(self):
+        if self._metrics is None:
+            docs = list(self._cursor)
+        else:
+            with self._metrics.query("mongodb", "find", "find") as t:
+                docs = list(self._cursor)
+                t.rows = len(docs)
+        if self._raw:
+            docs = [RawBSONDocument(bson.encode(doc)) for doc in docs]
+        return iter(docs)
+
+    def close(self):
+        self._cursor.close()
+
+
+class GraphFake:
+    # In-process stand-in for neo4j_utils.Neo4j. It only knows the Cypher
+    # queries of queries.py, which it answers from the dataset in Python with
+    # the same results Neo4j would return. Other queries raise
+    # NotImplementedError, so a new query has to be added here as well. Queries
+    # are timed in metrics when it is set, as in neo4j_utils.Neo4j.
+    def __init__(self, data, metrics=None):
+        self.database = "academicworld"
+        self.driver = None
+        self.metrics = metrics
+
+        self.keyword_publications = defaultdict(list)
+        keyword_names = dict(data.keywords)
+        for pub, keyword, score in data.publication_keyword:
+            self.keyword_publications[keyword_names[keyword]].append((pub, score))
+
+        self.publications = {p[0]: (p[2], p[3]) for p in data.publications}
+        self.faculty_publications = defaultdict(list)
+        for fac, pub in data.faculty_publication:
+            self.faculty_publications[fac].append(pub)
+        self.publication_keywords = defaultdict(list)
+        for pub, keyword, score in data.publication_keyword:
+            self.publication_keywords[pub].append((keyword_names[keyword], score))
+
+        self.faculty_names = {f[0]: f[1] for f in data.faculty}
+
+        self.authors = defaultdict(list)
+        for fac, pub in data.faculty_publication:
+            self.authors[pub].append(fac)
+
+        university_names = {u[0]: u[1] for u in data.universities}
+        self.institutes = {u[1]: u[2] for u in data.universities}
+        self.institute_faculty = defaultdict(int)
+        for fac in data.faculty:
+            if fac[2] in university_names:
+                self.institute_faculty[university_names[fac[2]]] += 1
+
+        # The KRC relationships of krc_aggregates.py, by faculty id and keyword
+        self.krc_aggregates = {}
+
+        self._reads = {
+            KRC_QUERY: self._krc,
+            KEYWORD_KRC_QUERY: self._keyword_krc,
+            UNIVERSITY_INFO_QUERY: self._university_info,
+            TOP_FACULTY_QUERY: self._top_faculty,
+            FACULTY_QUERY: self._faculty_ids,
+            PUBLICATION_FACULTY_QUERY: self._publication_faculty,
+            IS_EMPTY_QUERY: self._aggregates_built,
+        }
+        self._writes = {
+            REBUILD_QUERY: self._rebuild_krc,
+            UPDATE_UNIVERSITY_QUERY: self._update_university,
+            CREATE_UNIVERSITY_QUERY: self._create_university,
+        }
+
+    def read(self, query, **params):
+        return self.read_many([(query, params)])[0]
+
+    def read_many(self, queries):
+        return [self._run(self._reads, "read", q, p) for q, p in queries]
+
+    def write(self, query, **params):
+        return self._run(self._writes, "write", query, params)
+
+    def time_limit(self, seconds):
+        # The queries are answered in Python and can not be stopped
+        return nullcontext()
+
+    def close(self):
+        pass
+
+    def _run(self, handlers, operation, query, params):
+        if query not in handlers:
+            raise NotImplementedError(f"GraphFake can not run: {query}")
+        with query_timer(self.metrics, "neo4j", operation, query, params) as t:
+            records = handlers[query](**params)
+            t.rows = len(records)
+        return records
+
+    def _krc(self, selected_keywords, min_year, max_year):
+        # SUM(DISTINCT p.numCitations * l.score) per faculty name, which is what
+        # the query groups by
+        values = defaultdict(set)
+        for keyword in selected_keywords:
+            for pub, score in self.keyword_publications.get(keyword, ()):
+                year, citations = self.publications[pub]
+                if min_year <= year <= max_year:
+                    for fac in self.authors[pub]:
+                        values[self.faculty_names[fac]].add(citations * score)
+
+        records = [{"f.name": name, "KRC": sum(v)} for name, v in values.items()]
+        records.sort(key=lambda r: r["KRC"], reverse=True)
+        return records[:10]
+
+    def _keyword_krc(self, ids, limit):
+        # SUM(DISTINCT p.numCitations * l.score) per faculty member and keyword.
+        # Only the plain ids match, as the graph is built with the MySQL ids.
+        records = []
+        for fac in ids:
+            if fac not in self.faculty_names:
+                continue
+            values = defaultdict(set)
+            for pub in self.faculty_publications[fac]:
+                for keyword, score in self.publication_keywords[pub]:
+                    values[keyword].add(self.publications[pub][1] * score)
+            if not values:
+                continue
+            keywords = [{"keyword": k, "krc": sum(v)} for k, v in values.items()]
+            keywords.sort(key=lambda k: k["krc"], reverse=True)
+            records.append({"id": fac, "keywords": keywords[:limit]})
+        return records
+
+    def _rebuild_krc(self, ids, version):
+        # The distinct (year, numCitations * score) of each faculty member and
+        # keyword, in year order
+        for fac in ids:
+            values = defaultdict(set)
+            for pub in self.faculty_publications[fac]:
+                year, citations = self.publications[pub]
+                for keyword, score in self.publication_keywords[pub]:
+                    values[keyword].add((year, citations * score))
+            self.krc_aggregates[fac] = {
+                keyword: (version, sorted(pairs)) for keyword, pairs in values.items()
+            }
+        return []
+
+    def _top_faculty(self, selected_keywords, min_year, max_year):
+        # SUM(DISTINCT r.krc[i]) over the years in range, per faculty name
+        values = defaultdict(set)
+        for fac, keywords in self.krc_aggregates.items():
+            for keyword in selected_keywords:
+                _, pairs = keywords.get(keyword, (None, ()))
+                for year, value in pairs:
+                    if min_year <= year <= max_year:
+                        values[self.faculty_names[fac]].add(value)
+
+        records = [{"f.name": name, "KRC": sum(v)} for name, v in values.items()]
+        records.sort(key=lambda r: r["KRC"], reverse=True)
+        return records[:10]
+
+    def _faculty_ids(self):
+        return [{"id": fac} for fac in self.faculty_names]
+
+    def _publication_faculty(self, ids):
+        return [
+            {"id": fac} for fac in {fac for pub in ids for fac in self.authors[pub]}
+        ]
+
+    def _aggregates_built(self, version):
+        built = any(
+            v == version
+            for keywords in self.krc_aggregates.values()
+            for v, _ in keywords.values()
+        )
+        return [{"built": built}]
+
+    def _university_info(self, name):
+        if name not in self.institutes:
+            return []
+        return [
+            {
+                "photoUrl": self.institutes[name],
+                "facultyCount": self.institute_faculty[name],
+            }
+        ]
+
+    def _update_university(self, name, url):
+        if name in self.institutes:
+            self.institutes[name] = url
+        return []
+
+    def _create_university(self, name, url):
+        self.institutes[name] = url
+        return []
+
+
+class PhotoServer:
+    # Local HTTP server with a generated PNG photo at every path ending in .png,
+    # and a 404 for every other path
+    def __init__(self, width=800, height=600):
+        self.photo = png(width, height)
+        self.requests = 0
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.requests += 1
+                if not self.path.endswith(".png"):
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "image/png")
+                self.send_header("Content-Length", str(len(server.photo)))
+                self.end_headers()
+                self.wfile.write(server.photo)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def url(self, path):
+        return f"http://127.0.0.1:{self.httpd.server_port}{path}"
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def png(width, height):
+    # An RGB gradient as a PNG, written without an imaging library
+    def chunk(kind, data):
+        body = kind + data
+        return struct.pack(">I", len(data)) + body + struct.pack(">I", zlib.crc32(body))
+
+    rows = b"".join(
+        b"\0"
+        + b"".join(
+            bytes((x * 255 // width, y * 255 // height, 128)) for x in range(width)
+        )
+        for y in range(height)
+    )
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", header)
+        + chunk(b"IDAT", zlib.compress(rows))
+        + chunk(b"IEND", b"")
+    )
@@ -0,0 +1,181 @@
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def keyword_key(widget, keywords, year_range):
+    # Selections that only differ in order or duplicates share one entry
+    return (widget, tuple(sorted(set(keywords))), tuple(year_range))
+
+
+class ResultCache:
+    # Keys are tuples whose first item is the widget name, which is what the
+    # invalidation hooks work on. Entries live in an in-process LRU, and when a
+    # path is given they are also written to a SQLite file so that several
+    # worker processes can share results and invalidations. Expired entries are
+    # kept for stale_ttl more seconds, for get_stale().
+    def __init__(
+        self, max_entries=1024, ttl=600, path=None, stale_ttl=0, shared_widgets=()
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.path = path
+
+        # Widgets whose results change with the app's own writes. Without a path,
+        # the invalidations would not reach the other worker processes, which
+        # would show the old results until they expire, so these are not cached.
+        self.shared_widgets = set(shared_widgets)
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+        if self.path:
+            with self._db() as db:
+                db.execute(
+                    "CREATE TABLE IF NOT EXISTS entries ("
+                    "key TEXT PRIMARY KEY, widget TEXT, generation INTEGER, "
+                    "expires REAL, value BLOB)"
+                )
+                db.execute(
+                    "CREATE TABLE IF NOT EXISTS generations ("
+                    "widget TEXT PRIMARY KEY, generation INTEGER)"
+                )
+
+    def get_or_compute(self, key, compute):
+        found, value = self.get(key)
+        if found:
+            return value
+
+        value = compute()
+        self.put(key, value)
+        return value
+
+    def get(self, key):
+        found, value = self._find(key, time.time())
+        with self._lock:
+            self._stats["hits" if found else "misses"] += 1
+        return found, value
+
+    def get_stale(self, key):
+        # Like get(), but also finds entries that expired less than stale_ttl
+        # seconds ago, to be shown while a fresh result is computed. Entries
+        # from before an invalidation are never returned.
+        return self._find(key, time.time() - self.stale_ttl)
+
+    def _find(self, key, expired_before):
+        generation = self._generation(key[0])
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > expired_before and entry[1] == generation:
+                self._entries.move_to_end(key)
+                return True, entry[2]
+            if entry and (
+                entry[0] + self.stale_ttl <= time.time() or entry[1] != generation
+            ):
+                del self._entries[key]
+
+        if self.path:
+            row = (
+                self._db()
+                .execute(
+                    "SELECT expires, generation, value FROM entries WHERE key = ?",
+                    (repr(key),),
+                )
+                .fetchone()
+            )
+            if row and row[0] > expired_before and row[1] == generation:
+                value = pickle.loads(row[2])
+                self._remember(key, row[0], generation, value)
+                return True, value
+
+        return False, None
+
+    def put(self, key, value):
+        if not self.path and key[0] in self.shared_widgets:
+            return
+
+        expires = time.time() + self.ttl
+        generation = self._generation(key[0])
+        self._remember(key, expires, generation, value)
+
+        if self.path:
+            with self._db() as db:
+                db.execute(
+                    "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                    (repr(key), key[0], generation, expires, pickle.dumps(value)),
+                )
+                db.execute(
+                    "DELETE FROM entries WHERE expires < ?",
+                    (time.time() - self.stale_ttl,),
+                )
+                db.execute(
+                    "DELETE FROM entries WHERE key NOT IN "
+                    "(SELECT key FROM entries ORDER BY expires DESC LIMIT ?)",
+                    (self.max_entries,),
+                )
+
+    def invalidate(self, widget):
+        # Called by the write paths. Bumping the widget's generation also makes
+        # the copies held in memory by other worker processes stale.
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == widget]:
+                del self._entries[key]
+            self._stats["invalidations"] += 1
+
+        if self.path:
+            with self._db() as db:
+                db.execute(
+                    "INSERT INTO generations VALUES (?, 1) ON CONFLICT(widget) "
+                    "DO UPDATE SET generation = generation + 1",
+                    (widget,),
+                )
+                db.execute("DELETE FROM entries WHERE widget = ?", (widget,))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+        if self.path:
+            with self._db() as db:
+                db.execute("DELETE FROM entries")
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, entries=len(self._entries))
+
+    def _remember(self, key, expires, generation, value):
+        with self._lock:
+            self._entries[key] = (expires, generation, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def _generation(self, widget):
+        if not self.path:
+            return 0
+
+        row = (
+            self._db()
+            .execute("SELECT generation FROM generations WHERE widget = ?", (widget,))
+            .fetchone()
+        )
+        return row[0] if row else 0
+
+    def _db(self):
+        # SQLite connections can not be shared between threads or carried over a
+        # fork, so each thread of each process opens its own
+        db = getattr(self._local, "db", None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=5)
+            db.execute("PRAGMA journal_mode=WAL")
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
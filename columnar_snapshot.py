@@ -0,0 +1,358 @@
+import fcntl
+import itertools
+import os
+import shutil
+import sys
+import threading
+import time
+
+import pandas as pd
+
+from export_utils import parquet_stream
+from mysql_utils import MySQL
+from mongodb_utils import MongoDB
+import figures
+
+# Rows written to the snapshot at a time, so that a table is never held in memory
+BATCH_SIZE = 50000
+
+# The MySQL tables behind the Top Universities and Top Faculty widgets, with their
+# columns as (name, type) pairs in the type names of export_utils
+MYSQL_TABLES = {
+    "university": [("id", "int64"), ("name", "string")],
+    "faculty": [("id", "int64"), ("name", "string"), ("university_id", "int64")],
+    "keyword": [("id", "int64"), ("name", "string")],
+    "publication": [("id", "int64"), ("year", "int64")],
+    "faculty_publication": [("faculty_id", "int64"), ("publication_id", "int64")],
+    "publication_keyword": [("publication_id", "int64"), ("keyword_id", "int64")],
+}
+
+# The university_stats collection behind the Total Research widget
+UNIVERSITY_STATS_COLUMNS = [("university", "string")] + [
+    (column, "int64") for column in figures.COUNT_COLUMNS
+]
+
+# The same results as the MySQL queries of queries.py
+UNIVERSITY_YEAR_COUNTS_QUERY = (
+    "SELECT u.name, p.year, COUNT(DISTINCT p.id) c "
+    "FROM university u "
+    "JOIN faculty f ON f.university_id = u.id "
+    "JOIN faculty_publication fp ON f.id = fp.faculty_id "
+    "JOIN publication p ON p.id = fp.publication_id "
+    "JOIN publication_keyword pk ON pk.publication_id = p.id "
+    "JOIN keyword k ON k.id = pk.keyword_id "
+    "WHERE k.name IN (SELECT UNNEST(?)) AND p.year > 0 "
+    "GROUP BY u.id, u.name, p.year"
+)
+
+FACULTY_YEAR_COUNTS_QUERY = (
+    "SELECT f.name, p.year, COUNT(DISTINCT p.id) c "
+    "FROM faculty f "
+    "JOIN faculty_publication fp ON f.id = fp.faculty_id "
+    "JOIN publication p ON p.id = fp.publication_id "
+    "JOIN publication_keyword pk ON pk.publication_id = p.id "
+    "JOIN keyword k ON k.id = pk.keyword_id "
+    "WHERE k.name IN (SELECT UNNEST(?)) AND p.year > 0 "
+    "GROUP BY f.id, f.name, p.year"
+)
+
+DUCKDB_TYPES = {"string": "VARCHAR", "int64": "BIGINT"}
+
+
+class DuckDBEngine:
+    # The snapshot as one DuckDB database file, queried with the SQL of the
+    # widgets. Each query runs on its own cursor of a read-only connection.
+    def write(self, path, tables):
+        import duckdb
+
+        with duckdb.connect(path) as con:
+            for name, (columns, rows) in tables.items():
+                names = [column for column, _ in columns]
+                con.execute(
+                    f"CREATE TABLE {name} ("
+                    + ", ".join(f"{c} {DUCKDB_TYPES[t]}" for c, t in columns)
+                    + ")"
+                )
+                rows = iter(rows)
+                while batch := list(itertools.islice(rows, BATCH_SIZE)):
+                    # Nullable integers, so that a missing year stays NULL
+                    df = pd.DataFrame.from_records(batch, columns=names).astype(
+                        {c: "Int64" for c, t in columns if t == "int64"}
+                    )
+                    con.register("batch", df)
+                    con.execute(f"INSERT INTO {name} SELECT * FROM batch")
+                    con.unregister("batch")
+
+    def open(self, path):
+        import duckdb
+
+        self.con = duckdb.connect(path, read_only=True)
+        return self
+
+    def university_year_counts(self, selection):
+        return self._rows(UNIVERSITY_YEAR_COUNTS_QUERY, [list(selection)])
+
+    def faculty_year_counts(self, selection):
+        return self._rows(FACULTY_YEAR_COUNTS_QUERY, [list(selection)])
+
+    def university_summary(self, universities=None):
+        query = "SELECT * FROM university_stats"
+        params = []
+        if universities:
+            query += " WHERE university IN (SELECT UNNEST(?))"
+            params.append(list(universities))
+        return self._rows(query + " ORDER BY uniqueKeywordsCount DESC", params)
+
+    def _rows(self, query, params):
+        with self.con.cursor() as cursor:
+            return cursor.execute(query, params).fetchall()
+
+
+class ParquetEngine:
+    # The snapshot as a directory with one Parquet file per table, which are
+    # memory mapped and queried with the vectorized compute functions, joins and
+    # group bys of pyarrow. The joins are inner joins, like those of the SQL,
+    # rather than pyarrow's default left outer joins.
+    def write(self, path, tables):
+        os.makedirs(path)
+        for name, (columns, rows) in tables.items():
+            with open(os.path.join(path, f"{name}.parquet"), "wb") as f:
+                for chunk in parquet_stream(columns, rows, BATCH_SIZE):
+                    f.write(chunk)
+
+    def open(self, path):
+        import pyarrow.parquet as pq
+
+        self.tables = {
+            name: pq.read_table(os.path.join(path, f"{name}.parquet"), memory_map=True)
+            for name in list(MYSQL_TABLES) + ["university_stats"]
+        }
+        return self
+
+    def university_year_counts(self, selection):
+        authorships = self._authorships(selection)
+        universities = self.tables["university"].rename_columns(["uid", "uname"])
+        rows = authorships.join(universities, "university_id", "uid", join_type="inner")
+        return self._year_counts(rows, ["university_id", "uname"])
+
+    def faculty_year_counts(self, selection):
+        return self._year_counts(self._authorships(selection), ["faculty_id", "name"])
+
+    def university_summary(self, universities=None):
+        import pyarrow as pa
+        import pyarrow.compute as pc
+
+        stats = self.tables["university_stats"]
+        if universities:
+            stats = stats.filter(
+                pc.is_in(stats["university"], value_set=pa.array(universities))
+            )
+        stats = stats.sort_by([("uniqueKeywordsCount", "descending")])
+        return list(zip(*(stats[c].to_pylist() for c, _ in UNIVERSITY_STATS_COLUMNS)))
+
+    def _authorships(self, selection):
+        # (faculty_id, publication_id, year, name, university_id) of the
+        # publications in the selected keywords with a year
+        import pyarrow as pa
+        import pyarrow.compute as pc
+
+        def where(table, column, values):
+            return table.filter(pc.is_in(table[column], value_set=values))
+
+        keywords = where(self.tables["keyword"], "name", pa.array(list(selection)))
+        labels = where(
+            self.tables["publication_keyword"],
+            "keyword_id",
+            keywords["id"].combine_chunks(),
+        )
+        publications = where(
+            self.tables["publication"],
+            "id",
+            pc.unique(labels["publication_id"].combine_chunks()),
+        )
+        publications = publications.filter(pc.greater(publications["year"], 0))
+
+        authors = where(
+            self.tables["faculty_publication"],
+            "publication_id",
+            publications["id"].combine_chunks(),
+        )
+        rows = authors.join(publications, "publication_id", "id", join_type="inner")
+        return rows.join(self.tables["faculty"], "faculty_id", "id", join_type="inner")
+
+    def _year_counts(self, rows, keys):
+        counts = rows.group_by(keys + ["year"]).aggregate(
+            [("publication_id", "count_distinct")]
+        )
+        return list(
+            zip(
+                counts[keys[1]].to_pylist(),
+                counts["year"].to_pylist(),
+                counts["publication_id_count_distinct"].to_pylist(),
+            )
+        )
+
+
+ENGINES = {"duckdb": DuckDBEngine, "parquet": ParquetEngine}
+
+
+class ColumnarSnapshot:
+    # Local columnar copy of the tables behind the Top Universities, Top Faculty
+    # and Total Research widgets, which answers their group bys instead of the
+    # stores that also serve the writes. The engine, "duckdb" or "parquet", holds
+    # the copy at path and runs the queries; both are optional dependencies.
+    #
+    # A refresh exports the tables next to the snapshot and then swaps it in, so
+    # that readers never see a partial copy. Every process reopens the snapshot
+    # once it sees that it was replaced, also by another worker process. The
+    # engine it had open is left to the queries still running on it, and closed
+    # once they drop it.
+    def __init__(self, path, mysql, mongo, engine="duckdb"):
+        self.path = path
+        self.mysql = mysql
+        self.mongo = mongo
+        self.engine_name = engine
+        self.engine = None
+        self._version = None
+        self._lock = threading.Lock()
+        self._refresher = None
+
+    def age(self):
+        # Seconds since the last refresh, or None when there is no snapshot
+        try:
+            return time.time() - os.stat(self.path).st_mtime
+        except FileNotFoundError:
+            return None
+
+    def tables(self):
+        # name -> (columns, rows), with the rows read from the stores as they are
+        # written to the snapshot
+        tables = {
+            name: (
+                columns,
+                self.mysql.stream(
+                    f"SELECT {', '.join(c for c, _ in columns)} FROM {name}"
+                ),
+            )
+            for name, columns in MYSQL_TABLES.items()
+        }
+        docs = self.mongo.stream(
+            "university_stats",
+            projection={"_id": 0, **{c: 1 for c, _ in UNIVERSITY_STATS_COLUMNS}},
+        )
+        tables["university_stats"] = (
+            UNIVERSITY_STATS_COLUMNS,
+            ([doc.get(c) for c, _ in UNIVERSITY_STATS_COLUMNS] for doc in docs),
+        )
+        return tables
+
+    def refresh(self, max_age=None):
+        # Exports the snapshot again, or with max_age only if it is missing or
+        # older than that many seconds. Worker processes take turns through a
+        # lock file next to the snapshot, so that one of them exports it while
+        # the others wait and then find it fresh. Returns whether it exported.
+        with open(f"{self.path}.lock", "a") as lock:
+            # Released when the file is closed
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            age = self.age()
+            if max_age is not None and age is not None and age < max_age:
+                return False
+            self._export()
+        return True
+
+    def refresh_every(self, max_age):
+        # Refreshes the snapshot now if it is missing or older than max_age
+        # seconds, and then keeps it younger than that from a background thread
+        self.refresh(max_age)
+
+        if self._refresher is None:
+            self._refresher = threading.Thread(
+                target=self._refresh_loop, args=(max_age,), daemon=True
+            )
+            self._refresher.start()
+
+    def university_year_counts(self, selection):
+        return self._engine().university_year_counts(selection)
+
+    def faculty_year_counts(self, selection):
+        return self._engine().faculty_year_counts(selection)
+
+    def university_summary(self, universities=None):
+        return self._engine().university_summary(universities)
+
+    def _export(self):
+        scratch = f"{self.path}.{os.getpid()}.tmp"
+        _remove(scratch)
+        ENGINES[self.engine_name]().write(scratch, self.tables())
+
+        if os.path.isdir(scratch):
+            # A directory can not replace another one atomically, so each export
+            # is kept in a directory of its own and path is a symlink to the
+            # current one, which os.replace() swaps in one step. The previous
+            # export is removed afterwards; processes that have it open keep
+            # their memory maps.
+            version = f"{self.path}.{time.time_ns()}"
+            os.replace(scratch, version)
+            link = f"{self.path}.{os.getpid()}.link"
+            _remove(link)
+            os.symlink(os.path.basename(version), link)
+
+            previous = None
+            if os.path.islink(self.path):
+                previous = os.path.realpath(self.path)
+            else:
+                # A snapshot written before the symlinks, removed once
+                _remove(self.path)
+            os.replace(link, self.path)
+            if previous:
+                _remove(previous)
+        else:
+            os.replace(scratch, self.path)
+
+    def _engine(self):
+        # Reopened after a refresh, by any process, and in a forked worker. When
+        # a refresh of another process removes the snapshot while it is opened,
+        # the engine that is open keeps answering until the next query.
+        try:
+            stat = os.stat(self.path)
+            version = (os.getpid(), stat.st_ino, stat.st_mtime_ns)
+            if version != self._version:
+                with self._lock:
+                    if version != self._version:
+                        self.engine = ENGINES[self.engine_name]().open(self.path)
+                        self._version = version
+        except FileNotFoundError:
+            if self.engine is None:
+                raise
+        return self.engine
+
+    def _refresh_loop(self, max_age):
+        while True:
+            time.sleep(max(max_age - (self.age() or 0), 1))
+            try:
+                self.refresh(max_age)
+            except Exception as err:
+                print(f"The analytics snapshot could not be refreshed: {err}")
+
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    # python3 columnar_snapshot.py PATH [duckdb|parquet]
+    mysql = MySQL()
+    mysql.connect()
+    mongo = MongoDB()
+    mongo.connect()
+
+    path = sys.argv[1] if len(sys.argv) > 1 else "analytics.duckdb"
+    engine = sys.argv[2] if len(sys.argv) > 2 else "duckdb"
+    ColumnarSnapshot(path, mysql, mongo, engine).refresh()
+    print(f"Refreshed the {engine} snapshot at {path}")
+
+    mysql.close()
+    mongo.close()
@@ -0,0 +1,133 @@
+import csv
+import io
+import itertools
+from collections import namedtuple
+from urllib.parse import urlencode
+
+import flask
+
+# Route the exports are served from by serve_exports(), as
+# /export/<name>.<format>
+EXPORT_ROUTE = "/export"
+
+FORMATS = {"csv": "text/csv", "parquet": "application/vnd.apache.parquet"}
+
+# An export is its columns, as (name, type) pairs with a pyarrow type name such as
+# "string" or "int64", and a function from the request arguments to an iterator
+# over its rows. The function raises ExportError for arguments it can not use.
+Export = namedtuple("Export", ["columns", "rows"])
+
+
+class ExportError(Exception):
+    pass
+
+
+def export_url(name, fmt="csv", **params):
+    # The href of a link to an export. Lists are given as repeated arguments.
+    query = urlencode({k: v for k, v in params.items() if v}, doseq=True)
+    return f"{EXPORT_ROUTE}/{name}.{fmt}" + (f"?{query}" if query else "")
+
+
+def csv_stream(columns, rows, chunk_size=64 * 1024):
+    # Yields the rows as CSV, chunk_size bytes or so at a time
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(name for name, _ in columns)
+    for row in rows:
+        writer.writerow(row)
+        if buffer.tell() >= chunk_size:
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode()
+
+
+def parquet_stream(columns, rows, row_group_size=10000):
+    # Yields the rows as a Parquet file, one row group of row_group_size rows at a
+    # time, so that only one row group is held in memory. pyarrow is only needed
+    # for this format.
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([(name, getattr(pa, kind)()) for name, kind in columns])
+    sink = _Chunks()
+    with pq.ParquetWriter(sink, schema) as writer:
+        rows = iter(rows)
+        while batch := list(itertools.islice(rows, row_group_size)):
+            writer.write_table(
+                pa.Table.from_pylist(
+                    [dict(zip(schema.names, row)) for row in batch], schema=schema
+                )
+            )
+            yield sink.take()
+    # The footer is written when the writer is closed
+    yield sink.take()
+
+
+class _Chunks(io.RawIOBase):
+    # Write-only file that keeps what was written until it is taken
+    def __init__(self):
+        self.written = bytearray()
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.written += data
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def take(self):
+        data = bytes(self.written)
+        self.written.clear()
+        return data
+
+
+def serve_exports(app, exports):
+    # Serves the full results of the exports, name -> Export, as CSV or Parquet on
+    # EXPORT_ROUTE of the Dash app's Flask server. The rows are written out as
+    # they are read from the store, so an export of any size takes about the
+    # memory of one chunk.
+    @app.server.route(f"{EXPORT_ROUTE}/<name>.<fmt>")
+    def serve_export(name, fmt):
+        export = exports.get(name)
+        if export is None or fmt not in FORMATS:
+            flask.abort(404)
+
+        if fmt == "parquet":
+            try:
+                import pyarrow.parquet  # noqa: F401
+            except ImportError:
+                flask.abort(501, "Parquet exports need pyarrow to be installed")
+
+        try:
+            rows = export.rows(flask.request.args)
+        except ExportError as err:
+            flask.abort(400, str(err))
+
+        stream = parquet_stream if fmt == "parquet" else csv_stream
+        chunks = stream(export.columns, rows)
+
+        # The query runs for the first chunk, so that an error is still answered
+        # with a 500 instead of a response cut short
+        first = next(chunks)
+
+        def body():
+            # Closed by the server when the client goes away, which closes the
+            # cursor of the rows straight away
+            try:
+                yield first
+                yield from chunks
+            finally:
+                chunks.close()
+                if hasattr(rows, "close"):
+                    rows.close()
+
+        response = flask.Response(body(), mimetype=FORMATS[fmt])
+        response.headers["Content-Disposition"] = f'attachment; filename="{name}.{fmt}"'
+        response.headers["Cache-Control"] = "no-store"
+        return response
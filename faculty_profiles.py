@@ -0,0 +1,261 @@
+import sys
+import threading
+import uuid
+
+import pymongo
+from pymongo import DeleteMany, ReplaceOne
+
+from mysql_utils import MySQL, in_placeholders
+from mongodb_utils import MongoDB, Record, find_records
+from neo4j_utils import Neo4j
+
+# Publication left out of the most cited lists, as it is credited to the wrong
+# faculty members in the dataset
+IGNORED_PUBLICATION = (
+    "A shape-based approach to the segmentation of medical imagery using level sets"
+)
+
+# Number of most cited publications and of keywords kept in a profile
+TOP_CITED = 10
+TOP_KEYWORDS = 10
+
+# Faculty members whose profiles are built together, with one query to each store
+BATCH_SIZE = 500
+
+PROFILE_FIELDS = ("name", "position", "researchInterest", "email", "phone", "photoUrl")
+
+
+class FacultyDocumentRecord(Record):
+    # The fields of a faculty document that go into its profile, without its
+    # publications and keywords
+    __slots__ = ("_id", "id", *PROFILE_FIELDS, "university")
+    paths = {"university": "affiliation.name"}
+
+
+FACULTY_QUERY = (
+    "SELECT f.id, f.name, f.position, f.research_interest, f.email, f.phone, "
+    "f.photo_url, u.name "
+    "FROM faculty f LEFT JOIN university u ON u.id = f.university_id "
+    "WHERE f.id IN ({})"
+)
+
+TOP_CITED_QUERY = (
+    "SELECT faculty_id, title, num_citations FROM ("
+    "SELECT fp.faculty_id, p.title, p.num_citations, ROW_NUMBER() OVER ("
+    "PARTITION BY fp.faculty_id ORDER BY p.num_citations DESC) AS n "
+    "FROM faculty_publication fp "
+    "JOIN publication p ON p.id = fp.publication_id "
+    "WHERE fp.faculty_id IN ({}) AND p.title != %s"
+    ") ranked WHERE n <= %s ORDER BY faculty_id, n"
+)
+
+# KRC of each keyword of a faculty member over all years, the sum the Highest
+# Impact widget ranks faculty members by for the selected keywords
+KEYWORD_KRC_QUERY = (
+    "UNWIND $ids AS id "
+    "MATCH (f:FACULTY {id: id})--(p:PUBLICATION)-[l:LABEL_BY]-(k:KEYWORD) "
+    "WITH f, k, SUM(DISTINCT p.numCitations * l.score) AS krc "
+    "ORDER BY krc DESC "
+    "WITH f, collect({keyword: k.name, krc: krc})[..$limit] AS keywords "
+    "RETURN f.id AS id, keywords"
+)
+
+
+def neo4j_ids(ids):
+    # Graphs imported from the Academic World dump give faculty nodes an id with
+    # an "f" prefix, and graphs written by loader.py the plain MySQL id
+    return list(ids) + [f"f{i}" for i in ids]
+
+
+def reconciled_id(value):
+    if isinstance(value, str):
+        return int(value.lstrip("f"))
+    return value
+
+
+class FacultyProfiles:
+    # Read model of the faculty details, joined from the three stores into one
+    # document per faculty member so that the Faculty Information and Most Cited
+    # Publications widgets are a single indexed lookup. The documents are keyed
+    # by the MySQL faculty id, which the MongoDB documents carry as "id" and the
+    # Neo4j nodes as their id property, and they list the stores a faculty
+    # member was found in. Profile fields missing from MongoDB are taken from
+    # MySQL.
+    def __init__(self, db, mysql, neo, collection="faculty_profiles", metrics=None):
+        self.db = db
+        self.metrics = metrics
+        self.mysql = mysql
+        self.neo = neo
+        self.name = collection
+        self._watcher = None
+
+    @property
+    def collection(self):
+        # Looked up on every use, so that a forked worker uses its own client
+        return self.db[self.name]
+
+    def ensure_index(self, collection=None):
+        collection = collection or self.collection
+        collection.create_index("name")
+        collection.create_index("mongoId")
+
+    def is_empty(self):
+        return self.collection.estimated_document_count() == 0
+
+    def find(self, name):
+        return self.collection.find_one({"name": name})
+
+    def rebuild(self):
+        # Builds every profile into a scratch collection, which then replaces the
+        # read model at once. The scratch collection is named for this rebuild, so
+        # that rebuilds running at the same time do not write into each other's.
+        ids = {row[0] for row in self.mysql.execute_query("SELECT id FROM faculty")}
+        ids.update(i for i in self.db["faculty"].distinct("id") if i is not None)
+        ids = sorted(ids)
+
+        scratch = self.db[f"{self.name}_rebuild_{uuid.uuid4().hex}"]
+        try:
+            for start in range(0, len(ids), BATCH_SIZE):
+                profiles = self.build(ids[start : start + BATCH_SIZE])
+                if profiles:
+                    scratch.insert_many(profiles)
+
+            self.ensure_index(scratch)
+            if ids:
+                scratch.rename(self.name, dropTarget=True)
+        finally:
+            # Nothing is left behind when the rebuild failed or found no faculty.
+            # After the rename, this drops nothing.
+            scratch.drop()
+        return len(ids)
+
+    def refresh(self, ids):
+        # Rebuilds the given profiles only. Faculty members that are no longer in
+        # any store are removed.
+        ids = sorted(set(ids))
+        if not ids:
+            return
+
+        profiles = self.build(ids)
+        found = {profile["_id"] for profile in profiles}
+
+        requests = [
+            ReplaceOne({"_id": profile["_id"]}, profile, upsert=True)
+            for profile in profiles
+        ]
+        missing = [i for i in ids if i not in found]
+        if missing:
+            requests.append(DeleteMany({"_id": {"$in": missing}}))
+
+        self.collection.bulk_write(requests, ordered=False)
+
+    def build(self, ids):
+        # The profiles of the given faculty ids, from one query to each store
+        placeholders, params = in_placeholders(ids)
+        rows = self.mysql.execute_query(FACULTY_QUERY.format(placeholders), params)
+        cited = self.mysql.execute_query(
+            TOP_CITED_QUERY.format(placeholders),
+            params + (IGNORED_PUBLICATION, TOP_CITED),
+        )
+        docs = find_records(
+            self.db["faculty"],
+            {"id": {"$in": ids}},
+            FacultyDocumentRecord,
+            self.metrics,
+        )
+        records = self.neo.read(
+            KEYWORD_KRC_QUERY, ids=neo4j_ids(ids), limit=TOP_KEYWORDS
+        )
+
+        profiles = {}
+
+        def profile(faculty_id):
+            if faculty_id not in profiles:
+                profiles[faculty_id] = {
+                    "_id": faculty_id,
+                    "mongoId": None,
+                    "topCited": [],
+                    "keywordKrc": [],
+                    "sources": [],
+                }
+            return profiles[faculty_id]
+
+        for row in rows or []:
+            doc = profile(row[0])
+            doc.update(zip(PROFILE_FIELDS, row[1:7]))
+            doc["university"] = row[7]
+            doc["sources"].append("mysql")
+
+        for row in cited or []:
+            profile(row[0])["topCited"].append(
+                {"title": row[1], "numCitations": row[2]}
+            )
+
+        for faculty in docs:
+            doc = profile(faculty.id)
+            doc.update(
+                (field, getattr(faculty, field))
+                for field in PROFILE_FIELDS
+                if getattr(faculty, field) is not None
+            )
+            if faculty.university is not None:
+                doc["university"] = faculty.university
+            doc["mongoId"] = faculty._id
+            doc["sources"].append("mongodb")
+
+        for record in records:
+            doc = profile(reconciled_id(record["id"]))
+            doc["keywordKrc"] = record["keywords"]
+            doc["sources"].append("neo4j")
+
+        # Cited publications or keywords alone do not make a faculty member
+        return [doc for doc in profiles.values() if "name" in doc]
+
+    def watch(self):
+        # Keeps the profiles current with the faculty documents by following
+        # their change stream in a background thread. Change streams need MongoDB
+        # to run as a replica set. Changes to MySQL and Neo4j are picked up by
+        # `python3 faculty_profiles.py refresh ID...` or a rebuild.
+        if self._watcher is None:
+            self._watcher = threading.Thread(target=self._follow_changes, daemon=True)
+            self._watcher.start()
+
+    def _follow_changes(self):
+        try:
+            with self.db["faculty"].watch(full_document="updateLookup") as stream:
+                for change in stream:
+                    self._apply(change)
+        except pymongo.errors.PyMongoError as err:
+            print(f"Faculty profiles are no longer refreshed: {err}")
+
+    def _apply(self, change):
+        doc = change.get("fullDocument") or {}
+        ids = {doc.get("id")}
+
+        # A deleted document, or one whose id changed, is found by the profile
+        # that points at it
+        mongo_id = change.get("documentKey", {}).get("_id")
+        ids.update(
+            profile["_id"]
+            for profile in self.collection.find({"mongoId": mongo_id}, {"_id": 1})
+        )
+        self.refresh(i for i in ids if i is not None)
+
+
+if __name__ == "__main__":
+    mysql = MySQL()
+    mysql.connect()
+    mongo = MongoDB()
+    mongo.connect()
+    neo = Neo4j()
+
+    profiles = FacultyProfiles(mongo.db, mysql, neo)
+    if sys.argv[1:2] == ["refresh"]:
+        profiles.refresh(int(i) for i in sys.argv[2:])
+        print(f"Refreshed {len(sys.argv) - 2} faculty profiles")
+    else:
+        print(f"Rebuilt {profiles.rebuild()} faculty profiles")
+
+    mysql.close()
+    mongo.close()
+    neo.close()
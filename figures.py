@@ -0,0 +1,158 @@
+import numpy as np
+import pandas as pd
+import plotly.express as px
+from dash import Patch
+
+# Scatter plots with more points than this are drawn with WebGL
+WEBGL_THRESHOLD = 1000
+
+# Label of the bar that sums everything outside the top K, which is added in
+# assets/year_histogram.js
+OTHERS_LABEL = "Others"
+
+# Largest marker size in the Total Research scatter, as in plotly express
+SIZE_MAX = 20
+
+COUNT_COLUMNS = ["uniqueKeywordsCount", "facultyCount", "distinctPublicationsCount"]
+
+# The figures are created once with their template and layout, and the callbacks
+# then only send the data arrays that changed as a Patch
+
+
+def _style(fig):
+    fig.update_layout(
+        plot_bgcolor="rgba(0,0,0,0)",
+        paper_bgcolor="#222",
+    )
+    return fig
+
+
+def empty_bar(x_label, y_label="Publication Count"):
+    fig = px.bar(
+        pd.DataFrame(columns=[x_label, y_label]),
+        x=x_label,
+        y=y_label,
+        labels={y_label: y_label, x_label: x_label},
+        template="plotly_dark",
+    )
+    return _style(fig)
+
+
+def year_histogram(rows, limit=None):
+    # Encodes (name, year, count) rows for the bar charts of the keyword widgets,
+    # which are ranked and drawn in the browser by assets/year_histogram.js for
+    # whatever year range is selected. Each name's years are stored sorted with
+    # a running count (CSR, names[i] owns years[ptr[i]:ptr[i + 1]]), so the count
+    # of any range is the difference of two prefix sums. Names are ordered by
+    # their total count, and at most limit of them are drawn. With a limit, only
+    # the names drawn for at least one year range are sent.
+    by_name = {}
+    for name, year, count in rows:
+        by_name.setdefault(name, []).append((int(year), int(count)))
+
+    totals = {name: sum(c for _, c in entries) for name, entries in by_name.items()}
+    names = sorted(by_name, key=totals.get, reverse=True)
+    if limit and len(names) > limit:
+        names = _drawn(names, by_name, limit)
+
+    ptr = [0]
+    years = []
+    cumulative = []
+    for name in names:
+        total = 0
+        for year, count in sorted(by_name[name]):
+            total += count
+            years.append(year)
+            cumulative.append(total)
+        ptr.append(len(years))
+
+    return {
+        "names": names,
+        "ptr": ptr,
+        "years": years,
+        "cumulative": cumulative,
+        "limit": limit,
+    }
+
+
+def _drawn(names, by_name, limit):
+    # The names of year_histogram() that are among the limit drawn for some
+    # range of years, in the same order. For each range, the names are ranked
+    # as in the browser: by their count in the range, names with equal counts
+    # in their order here, and names without publications in it left out.
+    years = sorted({year for entries in by_name.values() for year, _ in entries})
+    row = {year: i + 1 for i, year in enumerate(years)}
+    counts = np.zeros((len(years) + 1, len(names)), dtype=np.int64)
+    for i, name in enumerate(names):
+        for year, count in by_name[name]:
+            counts[row[year], i] += count
+    cumulative = counts.cumsum(axis=0)
+
+    # Ranking keys that are unique, with the earlier name first on equal counts
+    order = np.arange(len(names), 0, -1)
+    drawn = np.zeros(len(names), dtype=bool)
+    for start in range(len(years)):
+        # Counts of the ranges from this year to each later one, one per row
+        in_range = cumulative[start + 1 :] - cumulative[start]
+        keys = in_range * (len(names) + 1) + order
+        top = np.argpartition(-keys, limit - 1, axis=1)[:, :limit]
+        drawn[top[np.take_along_axis(in_range, top, axis=1) > 0]] = True
+    return [name for name, kept in zip(names, drawn) if kept]
+
+
+def empty_pie():
+    fig = px.pie(names=[], values=[], template="plotly_dark")
+    fig.update_traces(
+        textposition="inside", textinfo="percent+label", hoverinfo="value"
+    )
+    return _style(fig)
+
+
+def patch_pie(records):
+    labels = []
+    values = []
+
+    for name, krc in records:
+        if krc > 0:
+            labels.append(name)
+            values.append(krc)
+
+    patch = Patch()
+    patch["data"][0]["labels"] = labels
+    patch["data"][0]["values"] = values
+    return patch
+
+
+def render_mode(df):
+    return "webgl" if len(df) > WEBGL_THRESHOLD else "svg"
+
+
+def research_scatter(df):
+    df = df.astype({column: "int64" for column in COUNT_COLUMNS})
+    scatter = px.scatter(
+        df,
+        x="distinctPublicationsCount",
+        y="facultyCount",
+        size="uniqueKeywordsCount",
+        hover_data=["university"],
+        log_x=True,
+        size_max=SIZE_MAX,
+        render_mode=render_mode(df),
+        template="plotly_dark",
+    )
+    scatter.update_xaxes(title_text="Total Publications")
+    scatter.update_yaxes(title_text="Faculty Members")
+    return _style(scatter)
+
+
+def patch_research_scatter(df):
+    # Mirrors what plotly express puts in the trace for research_scatter()
+    patch = Patch()
+    patch["data"][0]["x"] = df["distinctPublicationsCount"].tolist()
+    patch["data"][0]["y"] = df["facultyCount"].tolist()
+    patch["data"][0]["marker"]["size"] = df["uniqueKeywordsCount"].tolist()
+    patch["data"][0]["marker"]["sizeref"] = (
+        float(df["uniqueKeywordsCount"].max()) / SIZE_MAX**2 if len(df) else 1
+    )
+    patch["data"][0]["customdata"] = [[name] for name in df["university"]]
+    return patch
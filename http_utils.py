@@ -0,0 +1,130 @@
+import gzip
+import hashlib
+import threading
+from collections import OrderedDict
+
+import flask
+
+# Responses of other types, such as the photos, are not compressed
+COMPRESSIBLE_TYPES = (
+    "text/",
+    "application/json",
+    "application/javascript",
+    "image/svg+xml",
+)
+
+# GET routes of the Dash app that are given an ETag, so that the browser is
+# answered with 304 Not Modified while they have not changed: the index page,
+# the layout with its dropdowns and the callback list, and the component bundles
+VALIDATED_ROUTES = ("/", "/_dash-layout", "/_dash-dependencies")
+VALIDATED_PREFIXES = ("/_dash-component-suites/",)
+
+
+class ResponseCompressor:
+    # Compresses the responses of the Flask server with brotli, when the brotli
+    # package is installed and the browser accepts it, or else with gzip. Only
+    # bodies of at least min_bytes are compressed.
+    #
+    # Compressed bodies are kept by the hash of the uncompressed body, up to
+    # cache_bytes, so that the bundles and the callback responses that come out
+    # the same for every user (a popular keyword selection, the same figure) are
+    # only compressed once.
+    def __init__(
+        self, min_bytes=1024, gzip_level=6, brotli_quality=5, cache_bytes=64 << 20
+    ):
+        self.min_bytes = min_bytes
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.cache_bytes = cache_bytes
+
+        try:
+            import brotli
+
+            self._brotli = brotli
+        except ImportError:
+            self._brotli = None
+
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._cache_size = 0
+        self._lock = threading.Lock()
+
+    def encoding(self, accept_encodings):
+        # The encoding to answer with, from the Accept-Encoding of the request
+        if self._brotli is not None and accept_encodings["br"]:
+            return "br"
+        if accept_encodings["gzip"]:
+            return "gzip"
+        return None
+
+    def compress(self, body, digest, encoding):
+        key = (digest, encoding)
+        with self._lock:
+            compressed = self._cache.get(key)
+            if compressed is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return compressed
+            self.misses += 1
+
+        if encoding == "br":
+            compressed = self._brotli.compress(body, quality=self.brotli_quality)
+        else:
+            # Without a timestamp, the same body is always compressed the same
+            compressed = gzip.compress(body, self.gzip_level, mtime=0)
+
+        with self._lock:
+            if key not in self._cache:
+                self._cache[key] = compressed
+                self._cache_size += len(compressed)
+            while self._cache_size > self.cache_bytes:
+                _, evicted = self._cache.popitem(last=False)
+                self._cache_size -= len(evicted)
+        return compressed
+
+    def process(self, request, response):
+        # Streamed responses, such as the exports and the photos, are left as
+        # they are
+        if (
+            response.status_code != 200
+            or response.is_streamed
+            or response.direct_passthrough
+            or "Content-Encoding" in response.headers
+            or not (response.mimetype or "").startswith(COMPRESSIBLE_TYPES)
+        ):
+            return response
+
+        body = response.get_data()
+        digest = hashlib.sha256(body).hexdigest()
+        encoding = None
+        if len(body) >= self.min_bytes:
+            encoding = self.encoding(request.accept_encodings)
+        response.vary.add("Accept-Encoding")
+
+        if request.method == "GET" and (
+            request.path in VALIDATED_ROUTES
+            or request.path.startswith(VALIDATED_PREFIXES)
+        ):
+            # Each encoding of a body is a representation with its own ETag
+            response.set_etag(digest[:32] + (f"-{encoding}" if encoding else ""))
+            if response.cache_control.max_age is None:
+                # Asked for again on every load, and answered with 304
+                response.cache_control.no_cache = True
+            response.make_conditional(request)
+            if response.status_code == 304:
+                return response
+
+        if encoding is not None:
+            response.set_data(self.compress(body, digest, encoding))
+            response.headers["Content-Encoding"] = encoding
+        return response
+
+
+def compress_responses(app, compressor):
+    # Compresses and validates the responses of the Dash app's Flask server.
+    # Registered after instrument(), it runs before its hook, so that the
+    # callback payload sizes in the metrics are the bytes sent.
+    @app.server.after_request
+    def compress_response(response):
+        return compressor.process(flask.request, response)
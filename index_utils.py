@@ -0,0 +1,216 @@
+import sys
+
+from mysql.connector import errors
+
+from mysql_utils import MySQL
+from mongodb_utils import MongoDB
+from neo4j_utils import Neo4j
+
+# Indexes the hot lookups rely on, as (table or collection or label, column)
+MYSQL_INDEXES = [
+    ("keyword", "name"),
+    ("faculty", "name"),
+    ("university", "name"),
+    ("publication", "year"),
+    ("faculty", "university_id"),
+    ("faculty_publication", "faculty_id"),
+    ("faculty_publication", "publication_id"),
+    ("publication_keyword", "publication_id"),
+    ("publication_keyword", "keyword_id"),
+]
+
+MONGO_INDEXES = [
+    ("faculty", "name"),
+    ("faculty", "affiliation.name"),
+    ("faculty", "id"),
+    ("faculty_profiles", "name"),
+    ("university_stats", "university"),
+    ("reviews", "faculty_id"),
+]
+
+NEO4J_INDEXES = [
+    ("INSTITUTE", "name"),
+    ("KEYWORD", "name"),
+    ("FACULTY", "name"),
+    ("FACULTY", "id"),
+]
+
+# Plan operators that mean every row, document or node is looked at
+MYSQL_SCANS = ("ALL", "index")
+MONGO_SCANS = ("COLLSCAN",)
+NEO4J_SCANS = ("AllNodesScan", "NodeByLabelScan")
+
+
+def ensure_indexes(mysql, mongo, neo, create=True):
+    # Creates the declared indexes that are missing (unless create is False) and
+    # then checks with the query planner of each store that an equality lookup
+    # on each of them does not scan. A store given as None is skipped. Returns a
+    # list of problems, empty when all indexes are in place and used.
+    problems = []
+    checks = [
+        ("MySQL", MYSQL_INDEXES, mysql and _MySQLIndexes(mysql)),
+        ("MongoDB", MONGO_INDEXES, mongo and _MongoIndexes(mongo)),
+        ("Neo4j", NEO4J_INDEXES, neo and _Neo4jIndexes(neo)),
+    ]
+
+    for store, declared, indexes in checks:
+        if indexes is None:
+            continue
+        for target, field in declared:
+            name = f"{store} {target}.{field}"
+            try:
+                if not indexes.exists(target, field):
+                    if not create:
+                        problems.append(f"{name}: index is missing")
+                        continue
+                    indexes.create(target, field)
+                    print(f"Created index on {name}")
+
+                plan = indexes.explain(target, field)
+                if plan:
+                    problems.append(f"{name}: lookup falls back to a scan ({plan})")
+            except Exception as err:
+                problems.append(f"{name}: could not be checked ({err})")
+
+    return problems
+
+
+def report(problems):
+    if not problems:
+        print("All required indexes are present and used.")
+        return
+
+    print("=" * 80, file=sys.stderr)
+    print(
+        "WARNING: some hot queries will scan instead of using an index", file=sys.stderr
+    )
+    for problem in problems:
+        print(f"  - {problem}", file=sys.stderr)
+    print(
+        "Run `python3 index_utils.py` to create the missing indexes.", file=sys.stderr
+    )
+    print("=" * 80, file=sys.stderr)
+
+
+class _MySQLIndexes:
+    def __init__(self, mysql):
+        self.mysql = mysql
+
+    def exists(self, table, column):
+        rows = self.mysql.execute_query(
+            "SELECT 1 FROM information_schema.statistics "
+            "WHERE table_schema = DATABASE() AND table_name = %s "
+            "AND column_name = %s AND seq_in_index = 1",
+            (table, column),
+        )
+        return bool(rows)
+
+    def create(self, table, column):
+        try:
+            self._create(table, column, column)
+        except errors.Error as err:
+            # Text columns can only be indexed on a prefix
+            if err.errno != 1170:
+                raise
+            self._create(table, column, f"{column}(191)")
+
+    def _create(self, table, column, key):
+        try:
+            self.mysql.execute_query(
+                f"CREATE INDEX idx_{table}_{column} ON {table} ({key})"
+            )
+        except errors.Error as err:
+            # Duplicate key name: another process created it since exists()
+            if err.errno != 1061:
+                raise
+
+    def explain(self, table, column):
+        with self.mysql.session() as cursor:
+            cursor.execute(f"EXPLAIN SELECT * FROM {table} WHERE {column} = %s", ("",))
+            columns = [c[0] for c in cursor.description]
+            rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+        for row in rows:
+            if row["type"] in MYSQL_SCANS:
+                return f"type {row['type']}"
+        return None
+
+
+class _MongoIndexes:
+    def __init__(self, mongo):
+        self.db = mongo.db
+
+    def exists(self, collection, field):
+        indexes = self.db[collection].index_information().values()
+        return any(index["key"][0][0] == field for index in indexes)
+
+    def create(self, collection, field):
+        self.db[collection].create_index(field)
+
+    def explain(self, collection, field):
+        plan = self.db[collection].find({field: ""}).explain()
+        stages = _find_values(plan["queryPlanner"]["winningPlan"], "stage")
+        scans = [stage for stage in stages if stage in MONGO_SCANS]
+        return scans[0] if scans else None
+
+
+class _Neo4jIndexes:
+    def __init__(self, neo):
+        self.neo = neo
+
+    def exists(self, label, prop):
+        records = self.neo.read(
+            "SHOW INDEXES YIELD entityType, labelsOrTypes, properties "
+            "WHERE entityType = 'NODE' AND $label IN labelsOrTypes "
+            "AND properties[0] = $prop RETURN count(*) AS n",
+            label=label,
+            prop=prop,
+        )
+        return records[0]["n"] > 0
+
+    def create(self, label, prop):
+        self.neo.write(
+            f"CREATE INDEX {label.lower()}_{prop} IF NOT EXISTS "
+            f"FOR (n:{label}) ON (n.{prop})"
+        )
+
+    def explain(self, label, prop):
+        _, summary, _ = self.neo.driver.execute_query(
+            f"EXPLAIN MATCH (n:{label}) WHERE n.{prop} = $value RETURN n",
+            value="",
+            database_=self.neo.database,
+        )
+        operators = _find_values(summary.plan, "operatorType")
+        scans = [op for op in operators if op.split("@")[0] in NEO4J_SCANS]
+        return scans[0] if scans else None
+
+
+def _find_values(tree, key):
+    # Collects every value of key in a nested query plan
+    if isinstance(tree, dict):
+        values = [tree[key]] if key in tree else []
+        for value in tree.values():
+            values += _find_values(value, key)
+        return values
+    if isinstance(tree, list):
+        return [v for item in tree for v in _find_values(item, key)]
+    return []
+
+
+if __name__ == "__main__":
+    create = "--check" not in sys.argv[1:]
+
+    mysql = MySQL()
+    mysql.connect()
+    mongo = MongoDB()
+    mongo.connect()
+    neo = Neo4j()
+
+    problems = ensure_indexes(mysql, mongo, neo, create=create)
+    report(problems)
+
+    mysql.close()
+    mongo.close()
+    neo.close()
+
+    sys.exit(1 if problems else 0)
@@ -0,0 +1,182 @@
+import multiprocessing
+import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor, ThreadPoolExecutor
+
+# What a job is doing. progress is an estimate in percent from the earlier jobs of
+# the same widget, or None before any has finished, and error is set when the job
+# failed. An "unknown" job is not queued here, because it finished, failed long
+# ago, or was submitted to another worker process.
+JobStatus = namedtuple("JobStatus", ["state", "progress", "error"])
+
+# Target of each job queue by id. Worker processes are forked from the process that
+# created the queue, so they find the target here without it being pickled.
+_targets = {}
+
+# Set while a job queue forks its worker processes, which inherit it, so that the
+# fork handler of the queue leaves them alone
+_forking = False
+
+
+class _Job:
+    def __init__(self):
+        self.future = None
+        self.owners = 1
+        self.submitted = time.monotonic()
+
+
+class JobQueue:
+    # Runs slow queries away from the request threads. A job calls a method of the
+    # target, and is identified by the result cache key of its result: the result
+    # is put in the cache when the job finishes, which is where the callbacks
+    # polling for it look, from any worker process.
+    #
+    # A job that is queued or running for a key is shared by every request that
+    # submits that key. Each of them releases it once it no longer needs the
+    # result, and a job still waiting in the queue is cancelled when the last one
+    # does. A running job is left to finish, and its result is still cached.
+    #
+    # The worker processes are forked when the queue is created, which should be
+    # before the process starts threads of its own: a child forked while another
+    # thread holds a lock, of logging or of a connection pool, may wait for it
+    # forever. A process forked from this one, such as a WSGI server worker after
+    # a preload, forks its own workers at once, while it has a single thread.
+    def __init__(self, target, cache, max_workers=2, processes=True, failure_ttl=60):
+        self.target = target
+        self.cache = cache
+        self.max_workers = max_workers
+        self.processes = processes
+        self.failure_ttl = failure_ttl
+
+        self.pool = None
+        self._pid = os.getpid()
+        self._jobs = {}
+        self._failed = {}
+        self._durations = {}
+        self._lock = threading.Lock()
+        _targets[id(self)] = target
+
+        if processes:
+            self._pool()
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def submit(self, key, method, *args):
+        with self._lock:
+            self._check_fork()
+            self._failed.pop(key, None)
+            job = self._jobs.get(key)
+            if job is not None:
+                job.owners += 1
+                return
+
+            job = _Job()
+            try:
+                job.future = self._pool().submit(_run, id(self), method, args)
+            except BrokenExecutor:
+                # A worker process died, which breaks the whole pool
+                self.pool = None
+                job.future = self._pool().submit(_run, id(self), method, args)
+            self._jobs[key] = job
+
+        job.future.add_done_callback(lambda future: self._finish(key, job, future))
+
+    def status(self, key):
+        with self._lock:
+            self._check_fork()
+            job = self._jobs.get(key)
+            if job is None:
+                error, failed = self._failed.get(key, (None, 0))
+                if error is not None and time.monotonic() - failed < self.failure_ttl:
+                    return JobStatus("failed", 100, error)
+                return JobStatus("unknown", None, None)
+
+            state = "running" if job.future.running() else "queued"
+            expected = self._durations.get(key[0])
+            if expected is None:
+                return JobStatus(state, None, None)
+            elapsed = time.monotonic() - job.submitted
+            return JobStatus(state, min(95, int(100 * elapsed / expected)), None)
+
+    def release(self, key):
+        with self._lock:
+            self._check_fork()
+            job = self._jobs.get(key)
+            if job is None:
+                return
+            job.owners -= 1
+            if job.owners > 0:
+                return
+
+        # Cancelling runs the done callback, which takes the lock
+        job.future.cancel()
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+
+    def _finish(self, key, job, future):
+        seconds = time.monotonic() - job.submitted
+        error = None if future.cancelled() else future.exception()
+        if not future.cancelled() and error is None:
+            self.cache.put(key, future.result())
+
+        with self._lock:
+            if self._jobs.get(key) is job:
+                del self._jobs[key]
+            if error is not None:
+                self._failed[key] = (error, time.monotonic())
+            elif not future.cancelled():
+                # Moving average of how long the jobs of a widget take, from
+                # submission, for the progress estimates
+                previous = self._durations.get(key[0], seconds)
+                self._durations[key[0]] = 0.8 * previous + 0.2 * seconds
+
+    def _pool(self):
+        if self.pool is None:
+            if self.processes:
+                self.pool = self._fork_workers()
+            else:
+                self.pool = ThreadPoolExecutor(
+                    self.max_workers, thread_name_prefix="job"
+                )
+        return self.pool
+
+    def _fork_workers(self):
+        # Workers are forked, so that they inherit the target. Its connections
+        # open again in the worker the first time they are used there. One job
+        # per worker starts them all now rather than on later submits, which
+        # could come from any request thread. Only a pool broken by a dying
+        # worker is forked again later.
+        global _forking
+        pool = ProcessPoolExecutor(
+            self.max_workers, mp_context=multiprocessing.get_context("fork")
+        )
+        _forking = True
+        try:
+            for future in [pool.submit(int) for _ in range(self.max_workers)]:
+                future.result()
+        finally:
+            _forking = False
+        return pool
+
+    def _after_fork(self):
+        # In a process forked from this one, other than the queue's own workers
+        if _forking:
+            return
+        self._lock = threading.Lock()
+        self._check_fork()
+        self.pool = self._fork_workers()
+
+    def _check_fork(self):
+        # The jobs and pool of the parent are of no use in a forked process
+        if self._pid != os.getpid():
+            self.pool = None
+            self._jobs = {}
+            self._failed = {}
+            self._pid = os.getpid()
+
+
+def _run(queue_id, method, args):
+    return getattr(_targets[queue_id], method)(*args)
@@ -0,0 +1,166 @@
+import numpy as np
+
+# Years are below this, which is used to pack (position, year) into one integer
+YEAR_LIMIT = 10000
+
+
+class KeywordIndex:
+    # In-memory copy of the MySQL tables behind the Top Universities and Top
+    # Faculty widgets. Publications, faculty and universities are renumbered to
+    # dense positions so that every lookup is an array index:
+    #   keyword -> sorted publication positions (CSR)
+    #   publication -> year
+    #   publication -> faculty positions (CSR)
+    #   faculty -> university position (-1 when unaffiliated)
+    def __init__(self):
+        self.keyword_ids = {}
+        self.keyword_ptr = np.zeros(1, dtype=np.int64)
+        self.keyword_pubs = np.zeros(0, dtype=np.int32)
+        self.pub_year = np.zeros(0, dtype=np.int32)
+        self.pub_ptr = np.zeros(1, dtype=np.int64)
+        self.pub_faculty = np.zeros(0, dtype=np.int32)
+        self.faculty_names = []
+        self.faculty_university = np.zeros(0, dtype=np.int32)
+        self.university_names = []
+
+    def load(self, mysql):
+        publications = mysql.execute_query("SELECT id, year FROM publication")
+        pub_pos = {pub_id: i for i, (pub_id, _) in enumerate(publications)}
+        self.pub_year = np.array(
+            [year if year is not None else -1 for _, year in publications],
+            dtype=np.int32,
+        )
+
+        universities = mysql.execute_query("SELECT id, name FROM university")
+        uni_pos = {uni_id: i for i, (uni_id, _) in enumerate(universities)}
+        self.university_names = [name for _, name in universities]
+
+        faculty = mysql.execute_query("SELECT id, name, university_id FROM faculty")
+        fac_pos = {fac_id: i for i, (fac_id, _, _) in enumerate(faculty)}
+        self.faculty_names = [name for _, name, _ in faculty]
+        self.faculty_university = np.array(
+            [uni_pos.get(uni_id, -1) for _, _, uni_id in faculty], dtype=np.int32
+        )
+
+        keywords = mysql.execute_query("SELECT id, name FROM keyword")
+        kw_pos = {kw_id: i for i, (kw_id, _) in enumerate(keywords)}
+        self.keyword_ids = {name: kw_pos[kw_id] for kw_id, name in keywords}
+
+        rows = mysql.execute_query(
+            "SELECT keyword_id, publication_id FROM publication_keyword"
+        )
+        self.keyword_ptr, self.keyword_pubs = _csr(
+            [kw_pos.get(kw_id, -1) for kw_id, _ in rows],
+            [pub_pos.get(pub_id, -1) for _, pub_id in rows],
+            len(keywords),
+        )
+
+        rows = mysql.execute_query(
+            "SELECT publication_id, faculty_id FROM faculty_publication"
+        )
+        self.pub_ptr, self.pub_faculty = _csr(
+            [pub_pos.get(pub_id, -1) for pub_id, _ in rows],
+            [fac_pos.get(fac_id, -1) for _, fac_id in rows],
+            len(publications),
+        )
+
+        return self
+
+    def publications(self, keywords, min_year, max_year):
+        # Union of the keywords' publication lists, restricted to the year range
+        lists = [
+            self.keyword_pubs[self.keyword_ptr[i] : self.keyword_ptr[i + 1]]
+            for i in (self.keyword_ids.get(k) for k in keywords)
+            if i is not None
+        ]
+        if not lists:
+            return np.zeros(0, dtype=np.int32)
+
+        pubs = np.unique(np.concatenate(lists))
+        years = self.pub_year[pubs]
+        return pubs[(years >= min_year) & (years <= max_year)]
+
+    def top_universities(self, keywords, min_year, max_year):
+        pubs, faculty = self._authorships(keywords, min_year, max_year)
+        universities = self.faculty_university[faculty]
+        known = universities >= 0
+
+        # A publication counts once per university, however many of its authors
+        # work there, which matches COUNT(DISTINCT p.id)
+        pairs = np.unique(
+            pubs[known].astype(np.int64) * len(self.university_names)
+            + universities[known]
+        )
+        counts = np.bincount(
+            pairs % len(self.university_names), minlength=len(self.university_names)
+        )
+        return self._ranked(counts, self.university_names)
+
+    def top_faculty(self, keywords, min_year, max_year, limit=100):
+        # Every author is counted, also without a university, as MySQL only
+        # joins the faculty with their publications here
+        _, faculty = self._authorships(keywords, min_year, max_year)
+        counts = np.bincount(faculty, minlength=len(self.faculty_names))
+        return self._ranked(counts, self.faculty_names)[:limit]
+
+    def university_year_counts(self, keywords):
+        # (university, year, publication count) for every year, counted like
+        # top_universities()
+        pubs, faculty = self._authorships(keywords, 1, YEAR_LIMIT - 1)
+        universities = self.faculty_university[faculty]
+        known = universities >= 0
+
+        pairs = np.unique(
+            pubs[known].astype(np.int64) * len(self.university_names)
+            + universities[known]
+        )
+        pubs, universities = np.divmod(pairs, len(self.university_names))
+        return self._by_year(universities, pubs, self.university_names)
+
+    def faculty_year_counts(self, keywords):
+        # (faculty, year, publication count) for every year, counted like
+        # top_faculty()
+        pubs, faculty = self._authorships(keywords, 1, YEAR_LIMIT - 1)
+        return self._by_year(faculty, pubs, self.faculty_names)
+
+    def _by_year(self, positions, pubs, names):
+        keys, counts = np.unique(
+            positions.astype(np.int64) * YEAR_LIMIT + self.pub_year[pubs],
+            return_counts=True,
+        )
+        positions, years = np.divmod(keys, YEAR_LIMIT)
+        return [
+            (names[i], int(year), int(count))
+            for i, year, count in zip(positions, years, counts)
+        ]
+
+    def _authorships(self, keywords, min_year, max_year):
+        # Expands the matching publications into (publication, faculty) pairs
+        pubs = self.publications(keywords, min_year, max_year)
+        starts = self.pub_ptr[pubs]
+        lengths = self.pub_ptr[pubs + 1] - starts
+
+        offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        positions = offsets + np.arange(lengths.sum())
+        return np.repeat(pubs, lengths), self.pub_faculty[positions]
+
+    def _ranked(self, counts, names):
+        order = np.argsort(-counts, kind="stable")
+        order = order[counts[order] > 0]
+        return [(names[i], int(counts[i])) for i in order]
+
+
+def _csr(rows, cols, n_rows):
+    # Builds CSR arrays with each row's columns sorted and deduplicated. Pairs
+    # that refer to a missing row or column are dropped.
+    rows = np.array(rows, dtype=np.int64)
+    cols = np.array(cols, dtype=np.int64)
+    keep = (rows >= 0) & (cols >= 0)
+    width = cols.max(initial=0) + 1
+
+    pairs = np.unique(rows[keep] * width + cols[keep])
+    rows, cols = np.divmod(pairs, width)
+
+    ptr = np.zeros(n_rows + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=n_rows), out=ptr[1:])
+    return ptr, cols.astype(np.int32)
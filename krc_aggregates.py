@@ -0,0 +1,116 @@
+import sys
+
+from neo4j_utils import Neo4j
+
+# Faculty members whose aggregates are rebuilt in one write transaction
+BATCH_SIZE = 200
+
+# The KRC query of queries.py sums the distinct values of numCitations * score
+# over all the publications of a faculty member in the selected keywords and
+# years, so a value that comes up for two publications, or for one publication in
+# two selected keywords, is only counted once. For the same results, the
+# aggregates keep the values themselves rather than their sums: each
+# (FACULTY)-[:KRC]->(KEYWORD) relationship holds two parallel lists, the years in
+# order and the distinct numCitations * score of each year, and the values are
+# only summed once they are deduplicated across the selected keywords.
+REBUILD_QUERY = (
+    "UNWIND $ids AS id "
+    "MATCH (f:FACULTY) WHERE elementId(f) = id "
+    "OPTIONAL MATCH (f)-[old:KRC]->(:KEYWORD) "
+    "DELETE old "
+    "WITH DISTINCT f "
+    "MATCH (f)--(p:PUBLICATION)-[l:LABEL_BY]-(k:KEYWORD) "
+    "WHERE p.year IS NOT NULL "
+    "WITH DISTINCT f, k, p.year AS year, "
+    "coalesce(p.numCitations, 0) * coalesce(l.score, 0) AS value "
+    "ORDER BY year "
+    "WITH f, k, collect(year) AS years, collect(value) AS krc "
+    "CREATE (f)-[:KRC {years: years, krc: krc, version: $version}]->(k)"
+)
+
+# Same results as KRC_QUERY in queries.py, read from the aggregates of the
+# selected keywords instead of from every publication labelled with them. A
+# missing numCitations or score is kept as 0, which adds nothing to the sum, like
+# the null that KRC_QUERY skips.
+TOP_FACULTY_QUERY = (
+    "MATCH (f:FACULTY)-[r:KRC]->(k:KEYWORD) "
+    "WHERE k.name IN $selected_keywords "
+    "UNWIND range(0, size(r.years) - 1) AS i "
+    "WITH f, r, i "
+    "WHERE r.years[i] >= $min_year AND r.years[i] <= $max_year "
+    "RETURN f.name, sum(DISTINCT r.krc[i]) AS KRC "
+    "ORDER BY KRC DESC "
+    "LIMIT 10"
+)
+
+FACULTY_QUERY = "MATCH (f:FACULTY) RETURN elementId(f) AS id"
+
+PUBLICATION_FACULTY_QUERY = (
+    "MATCH (p:PUBLICATION)--(f:FACULTY) WHERE p.id IN $ids "
+    "RETURN DISTINCT elementId(f) AS id"
+)
+
+# Aggregates written before they kept the distinct values, which are marked with
+# the version, count as empty so that they are rebuilt
+AGGREGATES_VERSION = 2
+
+IS_EMPTY_QUERY = (
+    "MATCH (:FACULTY)-[r:KRC]->(:KEYWORD) "
+    "WHERE r.version = $version "
+    "RETURN count(r) > 0 AS built"
+)
+
+
+class KrcAggregates:
+    # KRC per faculty member, keyword and year, precomputed in Neo4j so that the
+    # Highest Impact widget sums a few lists per selected keyword instead of
+    # walking every publication labelled with it
+    def __init__(self, neo):
+        self.neo = neo
+
+    def is_empty(self):
+        return not self.neo.read(IS_EMPTY_QUERY, version=AGGREGATES_VERSION)[0]["built"]
+
+    def rebuild(self):
+        ids = [record["id"] for record in self.neo.read(FACULTY_QUERY)]
+        self.refresh_faculty(ids)
+        return len(ids)
+
+    def refresh_faculty(self, ids):
+        # Recomputes every aggregate of the given faculty members, by element id
+        ids = list(ids)
+        for start in range(0, len(ids), BATCH_SIZE):
+            self.neo.write(
+                REBUILD_QUERY,
+                ids=ids[start : start + BATCH_SIZE],
+                version=AGGREGATES_VERSION,
+            )
+
+    def refresh(self, publication_ids):
+        # Recomputes the aggregates of the authors of the given publications,
+        # after their citations, years or keyword labels changed
+        records = self.neo.read(PUBLICATION_FACULTY_QUERY, ids=list(publication_ids))
+        self.refresh_faculty(record["id"] for record in records)
+        return len(records)
+
+    def top_faculty(self, selection, year_range):
+        return self.neo.read(
+            TOP_FACULTY_QUERY,
+            selected_keywords=selection,
+            min_year=year_range[0],
+            max_year=year_range[1],
+        )
+
+
+if __name__ == "__main__":
+    neo = Neo4j()
+    aggregates = KrcAggregates(neo)
+
+    if sys.argv[1:2] == ["refresh"]:
+        # Publication ids as stored in the graph, numbers or strings
+        ids = [int(i) if i.isdigit() else i for i in sys.argv[2:]]
+        print(f"Refreshed the KRC aggregates of {aggregates.refresh(ids)} faculty")
+    else:
+        print(f"Rebuilt the KRC aggregates of {aggregates.rebuild()} faculty")
+
+    neo.close()
@@ -0,0 +1,554 @@
+import argparse
+import csv
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from collections import defaultdict
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from mysql_utils import MySQL
+from mongodb_utils import MongoDB
+from neo4j_utils import Neo4j
+from index_utils import ensure_indexes, report
+from university_stats import UniversityStats
+from faculty_profiles import FacultyProfiles
+from krc_aggregates import KrcAggregates
+
+# Loads the Academic World dataset into MySQL, MongoDB and Neo4j. The source is a
+# directory with one CSV file per MySQL table, named after the table and with a
+# header row, for example as exported from an existing MySQL database:
+#
+#   python3 loader.py path/to/academicworld
+#
+# The files are read once, in the order below, and each batch of rows is written
+# to the three stores in parallel. Progress is saved in a state file after every
+# batch, so an interrupted load continues where it stopped when run again. The
+# indexes the application needs are only built once all data is loaded.
+TABLES = [
+    ("university", ["id", "name", "photo_url"]),
+    ("keyword", ["id", "name"]),
+    ("publication", ["id", "title", "venue", "year", "num_citations"]),
+    (
+        "faculty",
+        [
+            "id",
+            "name",
+            "position",
+            "research_interest",
+            "email",
+            "phone",
+            "photo_url",
+            "university_id",
+        ],
+    ),
+    ("publication_keyword", ["publication_id", "keyword_id", "score"]),
+    ("faculty_keyword", ["faculty_id", "keyword_id", "score"]),
+    ("faculty_publication", ["faculty_id", "publication_id"]),
+]
+
+INT_COLUMNS = {
+    "id",
+    "year",
+    "num_citations",
+    "university_id",
+    "publication_id",
+    "keyword_id",
+    "faculty_id",
+}
+FLOAT_COLUMNS = {"score"}
+
+STORES = ["mysql", "mongodb", "neo4j"]
+
+BATCH_SIZE = 5000
+
+# Batches read ahead of the slowest store
+QUEUE_BATCHES = 8
+
+
+def read_batches(source, batch_size):
+    # Yields (table, first row number, rows) with the rows as tuples in the
+    # column order of TABLES
+    for table, columns in TABLES:
+        path = os.path.join(source, f"{table}.csv")
+        with open(path, newline="", encoding="utf-8") as f:
+            reader = csv.reader(f)
+            header = next(reader)
+            missing = [c for c in columns if c not in header]
+            if missing:
+                raise ValueError(f"{path} has no column {', '.join(missing)}")
+
+            positions = [header.index(c) for c in columns]
+            converters = [_converter(c) for c in columns]
+
+            start = 0
+            batch = []
+            for row in reader:
+                batch.append(
+                    tuple(conv(row[i]) for conv, i in zip(converters, positions))
+                )
+                if len(batch) == batch_size:
+                    yield table, start, batch
+                    start += len(batch)
+                    batch = []
+            if batch:
+                yield table, start, batch
+
+
+def _converter(column):
+    if column in INT_COLUMNS:
+        return lambda value: int(value) if value not in ("", "NULL", "\\N") else None
+    if column in FLOAT_COLUMNS:
+        return lambda value: float(value) if value not in ("", "NULL", "\\N") else None
+    return lambda value: value if value not in ("NULL", "\\N") else None
+
+
+class Checkpoint:
+    # Number of rows of each table written to each store, kept in a JSON file
+    # that is replaced atomically after every batch
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.state = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.state = json.load(f)
+
+    def rows(self, store, table):
+        with self._lock:
+            return self.state.get(store, {}).get(table, 0)
+
+    def advance(self, store, table, rows):
+        with self._lock:
+            self.state.setdefault(store, {})[table] = rows
+            tmp = f"{self.path}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(self.state, f, indent=2)
+            os.replace(tmp, self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class Progress:
+    def __init__(self, stores):
+        self.start = time.monotonic()
+        self.rows = {store: 0 for store in stores}
+        self.tables = {store: "waiting" for store in stores}
+        self._lock = threading.Lock()
+
+    def add(self, store, table, rows):
+        with self._lock:
+            self.rows[store] += rows
+            self.tables[store] = table
+
+    def line(self):
+        elapsed = max(time.monotonic() - self.start, 1e-9)
+        with self._lock:
+            return " | ".join(
+                f"{store}: {self.tables[store]} {rows:,} rows ({rows / elapsed:,.0f}/s)"
+                for store, rows in self.rows.items()
+            )
+
+
+class MySQLWriter:
+    name = "mysql"
+
+    # Tables are created with their primary keys only. Rows already present are
+    # skipped, so the batch that was being written when a load was interrupted
+    # can be written again.
+    SCHEMA = {
+        "university": "id INT PRIMARY KEY, name VARCHAR(512), photo_url VARCHAR(512)",
+        "keyword": "id INT PRIMARY KEY, name VARCHAR(512)",
+        "publication": "id INT PRIMARY KEY, title VARCHAR(512), venue VARCHAR(512), "
+        "year INT, num_citations INT",
+        "faculty": "id INT PRIMARY KEY, name VARCHAR(512), position VARCHAR(512), "
+        "research_interest VARCHAR(512), email VARCHAR(512), phone VARCHAR(512), "
+        "photo_url VARCHAR(512), university_id INT",
+        "publication_keyword": "publication_id INT, keyword_id INT, score FLOAT, "
+        "PRIMARY KEY (publication_id, keyword_id)",
+        "faculty_keyword": "faculty_id INT, keyword_id INT, score FLOAT, "
+        "PRIMARY KEY (faculty_id, keyword_id)",
+        "faculty_publication": "faculty_id INT, publication_id INT, "
+        "PRIMARY KEY (faculty_id, publication_id)",
+    }
+
+    def __init__(self, mysql):
+        self.mysql = mysql
+        self.inserts = {
+            table: f"INSERT IGNORE INTO {table} ({', '.join(columns)}) "
+            f"VALUES ({', '.join(['%s'] * len(columns))})"
+            for table, columns in TABLES
+        }
+
+    def drop(self):
+        for table, _ in reversed(TABLES):
+            self.mysql.execute_query(f"DROP TABLE IF EXISTS {table}")
+
+    def setup(self):
+        for table, _ in TABLES:
+            self.mysql.execute_query(
+                f"CREATE TABLE IF NOT EXISTS {table} ({self.SCHEMA[table]})"
+            )
+
+    def remember(self, table, rows):
+        pass
+
+    def write(self, table, rows):
+        self.mysql.execute_many(self.inserts[table], rows)
+
+    def finish(self):
+        pass
+
+
+class MongoWriter:
+    name = "mongodb"
+
+    # Faculty and publication documents are inserted first and their keywords
+    # and publications are added as the link tables are read. $addToSet keeps a
+    # batch that is written twice from adding its entries twice.
+    def __init__(self, mongo):
+        self.db = mongo.db
+        self.universities = {}
+        self.keywords = {}
+
+    def drop(self):
+        self.db["faculty"].drop()
+        self.db["publications"].drop()
+
+    def setup(self):
+        pass
+
+    def remember(self, table, rows):
+        # Universities and keywords are embedded by name in later documents, so
+        # they are kept even when their rows were already written
+        if table == "university":
+            for uni_id, name, photo_url in rows:
+                self.universities[uni_id] = {
+                    "id": uni_id,
+                    "name": name,
+                    "photoUrl": photo_url,
+                }
+        elif table == "keyword":
+            self.keywords.update(rows)
+
+    def write(self, table, rows):
+        if table == "publication":
+            self._insert(
+                "publications",
+                [
+                    {
+                        "_id": pub_id,
+                        "id": pub_id,
+                        "title": title,
+                        "venue": venue,
+                        "year": year,
+                        "numCitations": citations,
+                        "keywords": [],
+                    }
+                    for pub_id, title, venue, year, citations in rows
+                ],
+            )
+        elif table == "faculty":
+            self._insert(
+                "faculty",
+                [
+                    {
+                        "_id": row[0],
+                        "id": row[0],
+                        "name": row[1],
+                        "position": row[2],
+                        "researchInterest": row[3],
+                        "email": row[4],
+                        "phone": row[5],
+                        "photoUrl": row[6],
+                        "affiliation": self.universities.get(row[7]),
+                        "keywords": [],
+                        "publications": [],
+                    }
+                    for row in rows
+                ],
+            )
+        elif table == "publication_keyword":
+            self._add_to_set("publications", "keywords", rows, self._keyword)
+        elif table == "faculty_keyword":
+            self._add_to_set("faculty", "keywords", rows, self._keyword)
+        elif table == "faculty_publication":
+            self._add_to_set("faculty", "publications", rows, lambda row: row[1])
+
+    def finish(self):
+        # The Total Research summary is computed from the faculty documents
+        UniversityStats(self.db).rebuild()
+
+    def _keyword(self, row):
+        return {"id": row[1], "name": self.keywords.get(row[1]), "score": row[2]}
+
+    def _insert(self, collection, docs):
+        try:
+            self.db[collection].insert_many(docs, ordered=False)
+        except BulkWriteError as err:
+            # Documents written before an interruption are already there
+            if any(e["code"] != 11000 for e in err.details["writeErrors"]):
+                raise
+
+    def _add_to_set(self, collection, field, rows, value):
+        grouped = defaultdict(list)
+        for row in rows:
+            grouped[row[0]].append(value(row))
+
+        self.db[collection].bulk_write(
+            [
+                UpdateOne({"_id": _id}, {"$addToSet": {field: {"$each": values}}})
+                for _id, values in grouped.items()
+            ],
+            ordered=False,
+        )
+
+
+class Neo4jWriter:
+    name = "neo4j"
+
+    # Nodes and relationships are merged on the id, so a batch that is written
+    # twice does not duplicate them. The id constraints are created before the
+    # load because every relationship looks its nodes up by id.
+    LABELS = {
+        "university": "INSTITUTE",
+        "keyword": "KEYWORD",
+        "publication": "PUBLICATION",
+        "faculty": "FACULTY",
+    }
+
+    QUERIES = {
+        "university": "UNWIND $rows AS row "
+        "MERGE (n:INSTITUTE {id: row.id}) "
+        "SET n.name = row.name, n.photoUrl = row.photo_url",
+        "keyword": "UNWIND $rows AS row "
+        "MERGE (n:KEYWORD {id: row.id}) SET n.name = row.name",
+        "publication": "UNWIND $rows AS row "
+        "MERGE (n:PUBLICATION {id: row.id}) "
+        "SET n.title = row.title, n.venue = row.venue, n.year = row.year, "
+        "n.numCitations = row.num_citations",
+        "faculty": "UNWIND $rows AS row "
+        "MERGE (f:FACULTY {id: row.id}) "
+        "SET f.name = row.name, f.position = row.position, "
+        "f.researchInterest = row.research_interest, f.email = row.email, "
+        "f.phone = row.phone, f.photoUrl = row.photo_url "
+        "WITH f, row MATCH (i:INSTITUTE {id: row.university_id}) "
+        "MERGE (f)-[:AFFILIATION_WITH]->(i)",
+        "publication_keyword": "UNWIND $rows AS row "
+        "MATCH (p:PUBLICATION {id: row.publication_id}) "
+        "MATCH (k:KEYWORD {id: row.keyword_id}) "
+        "MERGE (p)-[l:LABEL_BY]->(k) SET l.score = row.score",
+        "faculty_keyword": "UNWIND $rows AS row "
+        "MATCH (f:FACULTY {id: row.faculty_id}) "
+        "MATCH (k:KEYWORD {id: row.keyword_id}) "
+        "MERGE (f)-[i:INTERESTED_IN]->(k) SET i.score = row.score",
+        "faculty_publication": "UNWIND $rows AS row "
+        "MATCH (f:FACULTY {id: row.faculty_id}) "
+        "MATCH (p:PUBLICATION {id: row.publication_id}) "
+        "MERGE (f)-[:PUBLISH]->(p)",
+    }
+
+    def __init__(self, neo):
+        self.neo = neo
+        self.columns = dict(TABLES)
+
+    def drop(self):
+        while self.neo.write(
+            "MATCH (n) WITH n LIMIT 10000 DETACH DELETE n RETURN count(*) AS n"
+        )[0]["n"]:
+            pass
+
+    def setup(self):
+        for label in self.LABELS.values():
+            self.neo.write(
+                f"CREATE CONSTRAINT {label.lower()}_id IF NOT EXISTS "
+                f"FOR (n:{label}) REQUIRE n.id IS UNIQUE"
+            )
+        self.neo.write("CALL db.awaitIndexes(300)")
+
+    def remember(self, table, rows):
+        pass
+
+    def write(self, table, rows):
+        columns = self.columns[table]
+        self.neo.write(
+            self.QUERIES[table], rows=[dict(zip(columns, row)) for row in rows]
+        )
+
+    def finish(self):
+        # Universities added in the app must not reuse an existing name
+        self.neo.write(
+            "CREATE CONSTRAINT institute_name IF NOT EXISTS "
+            "FOR (i:INSTITUTE) REQUIRE i.name IS UNIQUE"
+        )
+
+
+class _WriterThread(threading.Thread):
+    def __init__(self, writer, checkpoint, progress):
+        super().__init__(name=f"load-{writer.name}", daemon=True)
+        self.writer = writer
+        self.checkpoint = checkpoint
+        self.progress = progress
+        self.batches = queue.Queue(maxsize=QUEUE_BATCHES)
+        self.error = None
+
+        # Only set once the whole source was read, so that an interrupted load
+        # does not build the summaries from part of the data
+        self.complete = False
+
+    def run(self):
+        try:
+            self.writer.setup()
+            while True:
+                item = self.batches.get()
+                if item is None:
+                    break
+                self._write(*item)
+            if self.complete:
+                self.writer.finish()
+        except Exception as err:
+            self.error = err
+
+    def put(self, item):
+        # Waits for room in the queue unless this writer has stopped
+        while self.is_alive():
+            try:
+                self.batches.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def _write(self, table, start, rows):
+        self.writer.remember(table, rows)
+
+        end = start + len(rows)
+        done = self.checkpoint.rows(self.writer.name, table)
+        if end <= done:
+            return
+
+        rows = rows[max(done - start, 0) :]
+        self.writer.write(table, rows)
+        self.checkpoint.advance(self.writer.name, table, end)
+        self.progress.add(self.writer.name, table, len(rows))
+
+
+def load(
+    source,
+    writers,
+    checkpoint,
+    batch_size=BATCH_SIZE,
+    progress_interval=5,
+):
+    # Streams the source once into every writer, each on its own thread. Returns
+    # the writers that failed with their errors.
+    progress = Progress([writer.name for writer in writers])
+    threads = [_WriterThread(writer, checkpoint, progress) for writer in writers]
+    for thread in threads:
+        thread.start()
+
+    done = threading.Event()
+
+    def report_progress():
+        while not done.wait(progress_interval):
+            print(progress.line(), file=sys.stderr)
+
+    reporter = threading.Thread(target=report_progress, daemon=True)
+    reporter.start()
+
+    try:
+        for item in read_batches(source, batch_size):
+            if not any(thread.is_alive() for thread in threads):
+                break
+            for thread in threads:
+                thread.put(item)
+        else:
+            for thread in threads:
+                thread.complete = True
+    finally:
+        for thread in threads:
+            thread.put(None)
+        for thread in threads:
+            thread.join()
+        done.set()
+
+    print(progress.line(), file=sys.stderr)
+    return {thread.writer.name: thread.error for thread in threads if thread.error}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Load the Academic World CSV files into MySQL, MongoDB and Neo4j"
+    )
+    parser.add_argument("source", help="directory with one CSV file per table")
+    parser.add_argument("--stores", nargs="+", choices=STORES, default=STORES)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument(
+        "--state",
+        default="load_state.json",
+        help="progress file used to resume an interrupted load",
+    )
+    parser.add_argument(
+        "--restart",
+        action="store_true",
+        help="discard the progress of an earlier load and empty the stores first",
+    )
+    args = parser.parse_args()
+
+    checkpoint = Checkpoint(args.state)
+
+    mysql = mongo = neo = None
+    writers = []
+    if "mysql" in args.stores:
+        mysql = MySQL()
+        if not mysql.connect():
+            sys.exit("Could not connect to MySQL")
+        writers.append(MySQLWriter(mysql))
+    if "mongodb" in args.stores:
+        mongo = MongoDB()
+        mongo.connect()
+        writers.append(MongoWriter(mongo))
+    if "neo4j" in args.stores:
+        neo = Neo4j()
+        writers.append(Neo4jWriter(neo))
+
+    if args.restart:
+        checkpoint.remove()
+        checkpoint = Checkpoint(args.state)
+        for writer in writers:
+            print(f"Emptying {writer.name}", file=sys.stderr)
+            writer.drop()
+
+    start = time.monotonic()
+    errors = load(args.source, writers, checkpoint, batch_size=args.batch_size)
+    print(f"Loaded in {time.monotonic() - start:.1f}s", file=sys.stderr)
+
+    if errors:
+        for store, err in errors.items():
+            print(f"Loading {store} failed: {err!r}", file=sys.stderr)
+        print("Run the loader again to resume.", file=sys.stderr)
+        sys.exit(1)
+
+    # Indexes are built once, on the loaded data, instead of being updated for
+    # every inserted row
+    report(ensure_indexes(mysql, mongo, neo))
+    checkpoint.remove()
+
+    if neo:
+        count = KrcAggregates(neo).rebuild()
+        print(f"Rebuilt the KRC aggregates of {count} faculty", file=sys.stderr)
+
+    # The faculty profiles join all three stores, so they are only rebuilt once
+    # every store has been loaded
+    if mysql and mongo and neo:
+        count = FacultyProfiles(mongo.db, mysql, neo).rebuild()
+        print(f"Rebuilt {count} faculty profiles", file=sys.stderr)
+
+    for store in (mysql, mongo, neo):
+        if store is not None:
+            store.close()
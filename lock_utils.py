@@ -0,0 +1,18 @@
+import fcntl
+import os
+import tempfile
+from contextlib import contextmanager
+
+# Directory of the lock files. Processes on one host that lock the same name wait
+# for each other, such as the worker processes of a deployment.
+LOCK_DIR = tempfile.gettempdir()
+
+
+@contextmanager
+def process_lock(name, directory=LOCK_DIR):
+    # Holds an exclusive lock named name for the block, waiting until no other
+    # process holds it. The lock is released by the operating system if the
+    # process dies, so a crashed worker never leaves it taken.
+    with open(os.path.join(directory, f"{name}.lock"), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield
@@ -0,0 +1,376 @@
+import json
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+
+import flask
+from pymongo import monitoring
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Longest query text and parameters written to the slow query log
+SLOW_QUERY_TEXT_LIMIT = 2000
+
+# Mongo commands sent by the driver itself, which are not queries of the app
+MONGO_IGNORED_COMMANDS = {"endSessions", "hello", "isMaster", "ping", "saslStart"}
+
+
+class _Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+
+class QueryTimer:
+    # Handed to the caller while a query is timed, so that it can record how
+    # many rows came back
+    def __init__(self):
+        self.rows = 0
+
+
+class Metrics:
+    # Latency histograms and counters per callback and per store, exposed in the
+    # Prometheus text format by render(). Queries slower than slow_query_seconds
+    # are written with their text and parameters to the slow query log, a file
+    # when slow_query_log is set and the "slow_queries" logger otherwise.
+    def __init__(
+        self,
+        slow_query_seconds=0.5,
+        slow_query_log=None,
+        buckets=LATENCY_BUCKETS,
+        prefix="academicworld",
+    ):
+        self.slow_query_seconds = slow_query_seconds
+        self.buckets = buckets
+        self.prefix = prefix
+
+        self._lock = threading.Lock()
+        self._callback_seconds = defaultdict(lambda: _Histogram(self.buckets))
+        self._callback_bytes = defaultdict(int)
+        self._callback_errors = defaultdict(int)
+        self._query_seconds = defaultdict(lambda: _Histogram(self.buckets))
+        self._query_rows = defaultdict(int)
+        self._query_bytes = defaultdict(int)
+        self._query_errors = defaultdict(int)
+        self._slow_queries = defaultdict(int)
+
+        self.slow_log = logging.getLogger("slow_queries")
+        if slow_query_log:
+            handler = logging.FileHandler(slow_query_log)
+            handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+            self.slow_log.addHandler(handler)
+            self.slow_log.setLevel(logging.INFO)
+            self.slow_log.propagate = False
+
+    def observe_callback(self, callback, seconds, payload_bytes, error=False):
+        with self._lock:
+            self._callback_seconds[callback].observe(seconds)
+            self._callback_bytes[callback] += payload_bytes
+            if error:
+                self._callback_errors[callback] += 1
+
+    def observe_query(
+        self, store, operation, query, params, seconds, rows=0, error=False
+    ):
+        key = (store, operation)
+        slow = (
+            self.slow_query_seconds is not None and seconds >= self.slow_query_seconds
+        )
+        with self._lock:
+            self._query_seconds[key].observe(seconds)
+            self._query_rows[key] += rows
+            if error:
+                self._query_errors[key] += 1
+            if slow:
+                self._slow_queries[key] += 1
+
+        if slow:
+            self.slow_log.warning(
+                "%s %s %.1fms rows=%d%s query=%s params=%s",
+                store,
+                operation,
+                seconds * 1000,
+                rows,
+                " error" if error else "",
+                _truncate(query),
+                _truncate(params),
+            )
+
+    def observe_bytes(self, store, operation, size):
+        # Bytes of the results read from a store, for the reads that know them
+        with self._lock:
+            self._query_bytes[(store, operation)] += size
+
+    @contextmanager
+    def query(self, store, operation, query, params=None):
+        timer = QueryTimer()
+        error = False
+        start = time.perf_counter()
+        try:
+            yield timer
+        except Exception:
+            error = True
+            raise
+        finally:
+            self.observe_query(
+                store,
+                operation,
+                query,
+                params,
+                time.perf_counter() - start,
+                timer.rows,
+                error,
+            )
+
+    def render(self):
+        name = self.prefix
+        with self._lock:
+            lines = []
+            _histograms(
+                lines,
+                f"{name}_callback_seconds",
+                "Latency of the Dash callbacks",
+                {(("callback", c),): h for c, h in self._callback_seconds.items()},
+            )
+            _counters(
+                lines,
+                f"{name}_callback_payload_bytes_total",
+                "Bytes of the callback responses",
+                {(("callback", c),): v for c, v in self._callback_bytes.items()},
+            )
+            _counters(
+                lines,
+                f"{name}_callback_errors_total",
+                "Callbacks that failed",
+                {(("callback", c),): v for c, v in self._callback_errors.items()},
+            )
+
+            def labels(key):
+                return (("store", key[0]), ("operation", key[1]))
+
+            _histograms(
+                lines,
+                f"{name}_query_seconds",
+                "Latency of the queries to each store",
+                {labels(k): h for k, h in self._query_seconds.items()},
+            )
+            _counters(
+                lines,
+                f"{name}_query_rows_total",
+                "Rows, documents or records returned by the queries",
+                {labels(k): v for k, v in self._query_rows.items()},
+            )
+            _counters(
+                lines,
+                f"{name}_query_bytes_total",
+                "Bytes of the documents read into records",
+                {labels(k): v for k, v in self._query_bytes.items()},
+            )
+            _counters(
+                lines,
+                f"{name}_query_errors_total",
+                "Queries that failed",
+                {labels(k): v for k, v in self._query_errors.items()},
+            )
+            _counters(
+                lines,
+                f"{name}_slow_queries_total",
+                "Queries slower than the slow query threshold",
+                {labels(k): v for k, v in self._slow_queries.items()},
+            )
+        return "\n".join(lines) + "\n"
+
+
+def query_timer(metrics, store, operation, query, params=None):
+    # Times a query when the store was given a Metrics, and does nothing otherwise
+    if metrics is None:
+        return nullcontext(QueryTimer())
+    return metrics.query(store, operation, query, params)
+
+
+class TimedCursor:
+    # Wraps a DB-API cursor so that every execute() is timed. The row count is
+    # the one the driver reports after executing, which is -1 for unbuffered
+    # results and statements that return nothing.
+    def __init__(self, cursor, metrics, store):
+        self._cursor = cursor
+        self._metrics = metrics
+        self._store = store
+
+    def execute(self, query, params=None):
+        with self._metrics.query(self._store, "execute", query, params) as timer:
+            result = self._cursor.execute(query, params)
+            timer.rows = max(self._cursor.rowcount, 0)
+        return result
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class MongoListener(monitoring.CommandListener):
+    # Times every command the MongoDB client sends, which includes the queries
+    # run directly on collections and not through MongoDB.execute_query.
+    #
+    # The getMore commands of change streams and other awaitData cursors are not
+    # timed. Each one waits on the server for new changes, up to a second or so,
+    # which is not the latency of a query.
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self._started = {}
+        self._lock = threading.Lock()
+
+        # Ids of the open awaitData cursors, and the requests opening them
+        self._awaited = set()
+        self._opening = set()
+
+    def started(self, event):
+        if event.command_name in MONGO_IGNORED_COMMANDS:
+            return
+
+        key = (event.connection_id, event.request_id)
+        if event.command_name == "getMore":
+            with self._lock:
+                if event.command["getMore"] in self._awaited:
+                    return
+        elif event.command_name == "killCursors":
+            with self._lock:
+                self._awaited.difference_update(event.command.get("cursors", []))
+        elif _awaits_data(event.command):
+            with self._lock:
+                self._opening.add(key)
+
+        command = {
+            key: value
+            for key, value in event.command.items()
+            if key in (event.command_name, "filter", "pipeline", "sort", "updates")
+        }
+        with self._lock:
+            self._started[(event.connection_id, event.request_id)] = command
+
+    def succeeded(self, event):
+        key = (event.connection_id, event.request_id)
+        with self._lock:
+            if key in self._opening:
+                self._opening.discard(key)
+                cursor_id = event.reply.get("cursor", {}).get("id")
+                if cursor_id:
+                    self._awaited.add(cursor_id)
+        self._finish(event, _mongo_rows(event.reply), False)
+
+    def failed(self, event):
+        with self._lock:
+            self._opening.discard((event.connection_id, event.request_id))
+        self._finish(event, 0, True)
+
+    def _finish(self, event, rows, error):
+        with self._lock:
+            command = self._started.pop((event.connection_id, event.request_id), None)
+        if command is None:
+            return
+        self.metrics.observe_query(
+            "mongodb",
+            event.command_name,
+            command,
+            None,
+            event.duration_micros / 1e6,
+            rows,
+            error,
+        )
+
+
+def _awaits_data(command):
+    # Whether the command opens a cursor whose getMores wait for new data: a
+    # change stream, or a tailable find with awaitData
+    pipeline = command.get("pipeline") or []
+    if pipeline and "$changeStream" in pipeline[0]:
+        return True
+    return bool(command.get("tailable") and command.get("awaitData"))
+
+
+def _mongo_rows(reply):
+    cursor = reply.get("cursor")
+    if cursor:
+        return len(cursor.get("firstBatch", cursor.get("nextBatch", [])))
+    return reply.get("n", 0)
+
+
+def instrument(app, metrics):
+    # Times every callback request of the Dash app and serves the metrics on
+    # /metrics of its Flask server
+    server = app.server
+
+    @server.before_request
+    def start_timer():
+        flask.g.metrics_start = time.perf_counter()
+
+    @server.after_request
+    def observe_callback(response):
+        start = flask.g.pop("metrics_start", None)
+        if start is None or not flask.request.path.endswith("_dash-update-component"):
+            return response
+
+        body = flask.request.get_json(silent=True) or {}
+        callback = app.callback_map.get(body.get("output"), {}).get("callback")
+        metrics.observe_callback(
+            getattr(callback, "__name__", body.get("output", "unknown")),
+            time.perf_counter() - start,
+            response.calculate_content_length() or 0,
+            response.status_code >= 500,
+        )
+        return response
+
+    @server.route("/metrics")
+    def serve_metrics():
+        return flask.Response(
+            metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8"
+        )
+
+
+def _truncate(value):
+    text = value if isinstance(value, str) else json.dumps(value, default=str)
+    if len(text) > SLOW_QUERY_TEXT_LIMIT:
+        return text[:SLOW_QUERY_TEXT_LIMIT] + "..."
+    return text
+
+
+def _format_labels(labels):
+    escaped = [
+        (key, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for key, value in labels
+    ]
+    return ",".join(f'{key}="{value}"' for key, value in escaped)
+
+
+def _histograms(lines, name, help_text, histograms):
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} histogram")
+    for labels, histogram in sorted(histograms.items()):
+        cumulative = 0
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            cumulative += count
+            bucket = _format_labels(labels + (("le", bound),))
+            lines.append(f"{name}_bucket{{{bucket}}} {cumulative}")
+        bucket = _format_labels(labels + (("le", "+Inf"),))
+        lines.append(f"{name}_bucket{{{bucket}}} {histogram.count}")
+        lines.append(f"{name}_sum{{{_format_labels(labels)}}} {histogram.sum}")
+        lines.append(f"{name}_count{{{_format_labels(labels)}}} {histogram.count}")
+
+
+def _counters(lines, name, help_text, values):
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} counter")
+    for labels, value in sorted(values.items()):
+        lines.append(f"{name}{{{_format_labels(labels)}}} {value}")
@@ -1,25 +1,193 @@
+import os
+
+from bson import ObjectId, json_util
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+import pymongo
 from pymongo import MongoClient
 
+from metrics_utils import MongoListener
+
+# Documents read into records are kept as the BSON the server sent, and only the
+# fields of the record are decoded from it. Its length is the bytes transferred.
+RAW_BSON = CodecOptions(document_class=RawBSONDocument)
+
+
+class Record:
+    # Base of the compact records that MongoDB.find_records() returns instead of
+    # dicts. A subclass lists its fields in __slots__, which are the only fields
+    # fetched, and gives the dotted path of fields taken from embedded documents
+    # in paths. Missing fields are None. Records iterate over their fields in
+    # order, like a tuple.
+    __slots__ = ()
+    paths = {}
+
+    def __init__(self, doc):
+        for field in self.__slots__:
+            value = doc
+            for key in self.paths.get(field, field).split("."):
+                value = value.get(key) if value is not None else None
+            setattr(self, field, value)
+
+    @classmethod
+    def projection(cls):
+        projection = {cls.paths.get(field, field): 1 for field in cls.__slots__}
+        projection.setdefault("_id", 0)
+        return projection
+
+    def __iter__(self):
+        return (getattr(self, field) for field in self.__slots__)
+
+    def __repr__(self):
+        fields = ", ".join(f"{f}={getattr(self, f)!r}" for f in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+
+def find_records(collection, query, record_type, metrics=None, **kwargs):
+    # The matching documents of a collection as record_type records, with only
+    # their fields fetched and decoded. Keyword arguments, such as sort and
+    # limit, are passed on to find().
+    return list(
+        _records(
+            _raw_find(collection, query, record_type, **kwargs), record_type, metrics
+        )
+    )
+
+
+def _raw_find(collection, query, record_type, **kwargs):
+    collection = collection.with_options(codec_options=RAW_BSON)
+    return collection.find(query or {}, record_type.projection(), **kwargs)
+
+
+def _records(cursor, record_type, metrics=None):
+    # The size of the documents is counted in the metrics as they are read
+    size = 0
+    try:
+        for doc in cursor:
+            size += len(doc.raw)
+            yield record_type(doc)
+    finally:
+        if metrics:
+            metrics.observe_bytes("mongodb", "find", size)
+
 
 class MongoDB:
-    def __init__(self, database="academicworld", host="localhost", port=27017):
+    def __init__(
+        self, database="academicworld", host="localhost", port=27017, metrics=None
+    ):
         self.database = database
         self.host = host
         self.port = port
         self.client = None
         self.db = None
+        self._db = None
+        self._pid = None
 
-        # Use to store last accessed collection
-        self.collection = "faculty"
+        # Every command sent by the client is timed in this metrics_utils.Metrics,
+        # if given
+        self.metrics = metrics
 
     def connect(self):
-        self.client = MongoClient(host=self.host, port=self.port)
-        self.db = self.client[self.database]
+        listeners = [MongoListener(self.metrics)] if self.metrics else []
+        self.client = MongoClient(
+            host=self.host, port=self.port, event_listeners=listeners
+        )
+        self._db = self.client[self.database]
+        self._pid = os.getpid()
+
+        # db stays the same object after a reconnect, so the collections can be
+        # looked up through it by code that keeps a reference to it
+        if self.db is None:
+            self.db = _Database(self)
+
+    def current_db(self):
+        # A client must not be used in a process forked after it was created. A
+        # forked worker opens its own client, and leaves the parent's alone.
+        if self._pid != os.getpid():
+            self.connect()
+        return self._db
 
     def execute_query(self, collection_name, query):
-        collection = self.db[collection_name]
-        self.collection = collection
-        return collection.find(query)
+        return self.db[collection_name].find(query)
+
+    def find_records(self, collection_name, query, record_type, sort=None, limit=0):
+        # The matching documents as record_type records, with only their fields
+        # fetched and decoded
+        return find_records(
+            self.db[collection_name],
+            query,
+            record_type,
+            self.metrics,
+            sort=sort,
+            limit=limit,
+        )
+
+    def stream(
+        self,
+        collection_name,
+        query=None,
+        projection=None,
+        sort=None,
+        batch_size=1000,
+        record_type=None,
+    ):
+        # Yields the matching documents with only the projected fields, or
+        # record_type records, fetched batch_size at a time from the server. The
+        # server cursor is closed as soon as the generator is, also when it is
+        # not exhausted.
+        if record_type is None:
+            cursor = self.db[collection_name].find(
+                query or {}, projection, sort=sort, batch_size=batch_size
+            )
+            docs = cursor
+        else:
+            cursor = _raw_find(
+                self.db[collection_name],
+                query,
+                record_type,
+                sort=sort,
+                batch_size=batch_size,
+            )
+            docs = _records(cursor, record_type, self.metrics)
+        try:
+            yield from docs
+        finally:
+            cursor.close()
+
+    def time_limit(self, seconds):
+        # Operations run by this thread in the block are given the time that is
+        # left as maxTimeMS, so the server stops them once seconds have passed
+        return pymongo.timeout(seconds)
 
     def close(self):
         self.client.close()
+
+
+class _Database:
+    # The database of the client of the current process
+    def __init__(self, mongo):
+        self._mongo = mongo
+
+    def __getitem__(self, name):
+        return self._mongo.current_db()[name]
+
+    def __getattr__(self, name):
+        return getattr(self._mongo.current_db(), name)
+
+
+def encode_id(_id):
+    # Document ids as a string that can be kept in the browser, in a dcc.Store
+    return json_util.dumps(_id)
+
+
+def decode_id(value):
+    # The id kept by encode_id(), or None when the browser sent anything else.
+    # The value comes from the client, and JSON such as {"$ne": null} would
+    # otherwise reach the queries as an operator instead of an id.
+    try:
+        _id = json_util.loads(value)
+    except (TypeError, ValueError):
+        return None
+    if isinstance(_id, ObjectId) or type(_id) is int:
+        return _id
+    return None
@@ -1,9 +1,42 @@
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
 import mysql.connector
+from mysql.connector import pooling
+
+from metrics_utils import TimedCursor, query_timer
+
+
+def in_placeholders(values):
+    # Builds the placeholders for an IN (...) list. The list is padded to the next
+    # power of two by repeating the last value, so that selections of a similar
+    # size share one prepared statement instead of each getting their own.
+    values = list(values)
+    size = 1
+    while size < len(values):
+        size *= 2
+
+    values += values[-1:] * (size - len(values))
+    return ", ".join(["%s"] * size), tuple(values)
 
 
 class MySQL:
     def __init__(
-        self, user="shane", password="", database="academicworld", host="localhost"
+        self,
+        user="shane",
+        password="",
+        database="academicworld",
+        host="localhost",
+        pool_size=0,
+        pool_timeout=10,
+        health_check_interval=30,
+        statement_cache_size=32,
+        stream_connections=4,
+        metrics=None,
     ):
         self.user = user
         self.password = password
@@ -12,30 +45,352 @@ class MySQL:
         self.cnx = None
         self.cursor = None
 
+        # Queries are timed and counted in this metrics_utils.Metrics, if given
+        self.metrics = metrics
+
+        # A pool_size of 0 keeps the single shared connection and cursor
+        self.pool_size = pool_size
+        self.pool_timeout = pool_timeout
+        self.health_check_interval = health_check_interval
+        self.pool = None
+
+        # stream() reads on connections of its own, at most this many at a time
+        self.stream_connections = stream_connections
+        self._streams = threading.BoundedSemaphore(stream_connections)
+
+        # Server side limit on the statements run in a time_limit() block, and the
+        # limit each connection's session was last given, in milliseconds
+        self._limits = threading.local()
+        self._execution_times = {}
+
+        # Binary protocol prepared statements, cached per connection by query text
+        self.statement_cache_size = statement_cache_size
+        self._statements = {}
+
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._pid = os.getpid()
+        self._slots = None
+        self._last_used = {}
+        self._stats = {
+            "checkouts": 0,
+            "in_use": 0,
+            "peak_in_use": 0,
+            "wait_seconds": 0.0,
+            "timeouts": 0,
+            "reconnects": 0,
+            "statement_hits": 0,
+            "statement_misses": 0,
+            "statement_evictions": 0,
+        }
+
     def connect(self):
+        self._pid = os.getpid()
         try:
-            self.cnx = mysql.connector.connect(
-                user=self.user,
-                password=self.password,
-                database=self.database,
-                host=self.host,
-            )
-            self.cursor = self.cnx.cursor()
+            if self.pool_size:
+                self.pool = pooling.MySQLConnectionPool(
+                    pool_size=self.pool_size,
+                    pool_reset_session=False,
+                    user=self.user,
+                    password=self.password,
+                    database=self.database,
+                    host=self.host,
+                )
+                self._slots = threading.BoundedSemaphore(self.pool_size)
+            else:
+                self.cnx = self._open()
+                self.cursor = self.cnx.cursor()
         except mysql.connector.Error as err:
             print(err)
             return False
         else:
             return True
 
-    def execute_query(self, query):
-        if self.cursor:
-            self.cursor.execute(query)
-            return self.cursor.fetchall()
+    @contextmanager
+    def session(self):
+        # Yields a cursor that stays on one connection for the whole block, so
+        # that session variables can be used by the statements run on it
+        with self._session() as cursor:
+            if self.metrics is None:
+                yield cursor
+            else:
+                yield TimedCursor(cursor, self.metrics, "mysql")
+
+    def execute_query(self, query, params=None):
+        if self.pool is None and not self.cursor:
+            return None
+
+        with query_timer(self.metrics, "mysql", "execute_query", query, params) as t:
+            with self._session() as cursor:
+                cursor.execute(query, params)
+                rows = cursor.fetchall() if cursor.with_rows else []
+            t.rows = len(rows)
+        return rows
+
+    def stream(self, query, params=None, batch_size=1000, timeout=None):
+        # Yields the rows of the query as they arrive, fetched batch_size at a time
+        # from an unbuffered cursor, so that a large result is never held in
+        # memory. The rows are read on a connection of their own, not one of the
+        # pool or the shared one, so that a consumer that reads slowly, such as an
+        # export to a slow client, holds up no other query. With timeout, the
+        # stream fails once it has been open that many seconds.
+        if self.pool is None and not self.cursor:
+            return
+
+        with query_timer(self.metrics, "mysql", "stream", query, params) as t:
+            if not self._streams.acquire(timeout=self.pool_timeout):
+                raise mysql.connector.errors.PoolError(
+                    f"No stream connection available after {self.pool_timeout}s"
+                )
+            cnx = None
+            try:
+                deadline = timeout and time.monotonic() + timeout
+                cnx = self._open()
+                cursor = cnx.cursor(buffered=False)
+                cursor.execute(query, params)
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    t.rows += len(rows)
+                    yield from rows
+                    if deadline and time.monotonic() > deadline:
+                        raise TimeoutError(f"Stream still open after {timeout}s")
+            finally:
+                # A result left unread, by a generator closed early, is dropped
+                # with the connection rather than read off to the end
+                if cnx is not None:
+                    if cnx.unread_result:
+                        cnx.shutdown()
+                    else:
+                        cnx.close()
+                self._streams.release()
+
+    def execute_prepared(self, query, params=()):
+        # Runs the query as a binary protocol prepared statement with bound
+        # parameters. Each distinct query text is only parsed and planned once
+        # per connection, so callers should keep the text stable and pass all
+        # values through params.
+        if self.pool is None and not self.cursor:
+            return None
+
+        with query_timer(self.metrics, "mysql", "execute_prepared", query, params) as t:
+            with self._connection() as cnx:
+                cursor, query = self._statement(cnx, query)
+                cursor.execute(query, params)
+                rows = cursor.fetchall()
+            t.rows = len(rows)
+        return rows
+
+    def execute_many(self, query, rows):
+        # Runs a statement for every row in one call and commits them together.
+        # The connector sends an INSERT for many rows as a single statement.
+        if self.pool is None and not self.cursor:
+            return None
+
+        with query_timer(self.metrics, "mysql", "execute_many", query) as t:
+            with self._connection() as cnx:
+                cursor = cnx.cursor()
+                try:
+                    cursor.executemany(query, rows)
+                    cnx.commit()
+                finally:
+                    cursor.close()
+            t.rows = len(rows)
+        return len(rows)
+
+    @contextmanager
+    def _session(self):
+        with self._connection() as cnx:
+            if self.pool is None:
+                yield self.cursor
+                return
+
+            cursor = cnx.cursor(buffered=True)
+            try:
+                yield cursor
+            finally:
+                cursor.close()
+
+    @contextmanager
+    def time_limit(self, seconds):
+        # SELECT statements run by this thread in the block are stopped by the
+        # server after seconds (MAX_EXECUTION_TIME), so that a query given up on
+        # does not keep its connection. It is rounded up to whole seconds, so that
+        # the sessions do not need a new limit for every query.
+        previous = getattr(self._limits, "ms", 0)
+        self._limits.ms = math.ceil(seconds) * 1000
+        try:
+            yield
+        finally:
+            self._limits.ms = previous
+
+    def _limit_execution_time(self, cnx):
+        # Each connection's session is only changed when the limit differs from
+        # the one it was last given
+        ms = getattr(self._limits, "ms", 0)
+        if self._execution_times.get(cnx.connection_id, 0) == ms:
+            return
+
+        cursor = cnx.cursor()
+        try:
+            cursor.execute("SET SESSION MAX_EXECUTION_TIME = %s", (ms,))
+        finally:
+            cursor.close()
+        self._execution_times[cnx.connection_id] = ms
+
+    def statement_stats(self):
+        with self._stats_lock:
+            return {
+                "hits": self._stats["statement_hits"],
+                "misses": self._stats["statement_misses"],
+                "evictions": self._stats["statement_evictions"],
+                "cached": sum(len(s) for s in list(self._statements.values())),
+            }
+
+    def pool_stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+
+        stats["pool_size"] = self.pool_size
+        stats["available"] = self.pool_size - stats["in_use"]
+        return stats
+
+    def _open(self):
+        return mysql.connector.connect(
+            user=self.user,
+            password=self.password,
+            database=self.database,
+            host=self.host,
+        )
+
+    def _check_fork(self):
+        # Connections and locks inherited from the parent process can not be
+        # used in a forked worker. They are dropped without closing them, which
+        # would close the parent's sockets, and the worker connects again.
+        if self._pid == os.getpid():
+            return
+        if self.pool is None and self.cnx is None:
+            return
+
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._streams = threading.BoundedSemaphore(self.stream_connections)
+        self.cnx = None
+        self.cursor = None
+        self.pool = None
+        self._statements = {}
+        self._last_used = {}
+        self._execution_times = {}
+
+        self.connect()
+
+    @contextmanager
+    def _connection(self):
+        self._check_fork()
+        if self.pool is None:
+            with self._lock:
+                self._limit_execution_time(self.cnx)
+                yield self.cnx
+            return
+
+        cnx = self._checkout()
+        try:
+            self._limit_execution_time(cnx)
+            yield cnx
+        finally:
+            self._checkin(cnx)
+
+    def _statement(self, cnx, query):
+        # A connection is only used by one thread at a time, so its cache does not
+        # need a lock. The cached text is returned as well because the cursor only
+        # reuses its statement when given the exact same string object.
+        statements = self._statements.setdefault(cnx.connection_id, OrderedDict())
+
+        entry = statements.get(query)
+        if entry:
+            statements.move_to_end(query)
+            with self._stats_lock:
+                self._stats["statement_hits"] += 1
+            return entry
+
+        entry = (cnx.cursor(prepared=True), query)
+        statements[query] = entry
+
+        evicted = 0
+        while len(statements) > self.statement_cache_size:
+            _, (cursor, _) = statements.popitem(last=False)
+            cursor.close()
+            evicted += 1
+
+        with self._stats_lock:
+            self._stats["statement_misses"] += 1
+            self._stats["statement_evictions"] += evicted
+
+        return entry
+
+    def _checkout(self):
+        start = time.monotonic()
+        if not self._slots.acquire(timeout=self.pool_timeout):
+            with self._stats_lock:
+                self._stats["timeouts"] += 1
+            raise mysql.connector.errors.PoolError(
+                f"No pooled connection available after {self.pool_timeout}s"
+            )
+
+        try:
+            cnx = self.pool.get_connection()
+        except mysql.connector.Error:
+            self._slots.release()
+            raise
+
+        try:
+            self._check_health(cnx)
+        except mysql.connector.Error:
+            cnx.close()
+            self._slots.release()
+            raise
+
+        with self._stats_lock:
+            self._stats["checkouts"] += 1
+            self._stats["wait_seconds"] += time.monotonic() - start
+            self._stats["in_use"] += 1
+            self._stats["peak_in_use"] = max(
+                self._stats["peak_in_use"], self._stats["in_use"]
+            )
+
+        return cnx
+
+    def _checkin(self, cnx):
+        self._last_used[cnx.connection_id] = time.monotonic()
+        cnx.close()
+        self._slots.release()
+
+        with self._stats_lock:
+            self._stats["in_use"] -= 1
+
+    def _check_health(self, cnx):
+        # Connections idle for longer than the interval may have been dropped by
+        # the server (wait_timeout), so ping them and reconnect if needed
+        last_used = self._last_used.get(cnx.connection_id)
+        if last_used and time.monotonic() - last_used < self.health_check_interval:
+            return
+
+        connection_id = cnx.connection_id
+        cnx.ping(reconnect=True, attempts=2, delay=0)
 
-        return None
+        if cnx.connection_id != connection_id:
+            self._last_used.pop(connection_id, None)
+            self._statements.pop(connection_id, None)
+            self._execution_times.pop(connection_id, None)
+            with self._stats_lock:
+                self._stats["reconnects"] += 1
 
     def close(self):
         if self.cursor:
             self.cursor.close()
         if self.cnx:
             self.cnx.close()
+        if self.pool:
+            self.pool._remove_connections()
@@ -1,14 +1,156 @@
-from neo4j import GraphDatabase
+import os
+import threading
+from contextlib import contextmanager
+
+from neo4j import AsyncGraphDatabase, GraphDatabase, unit_of_work
+
+from metrics_utils import query_timer
+
 
 class Neo4j:
-    def __init__(self, uri="neo4j://localhost", auth=("neo4j", "password")):
-        with GraphDatabase.driver(uri=uri, auth=auth) as driver:
-            driver.verify_connectivity()
-        
-        self.uri=uri
+    def __init__(
+        self,
+        uri="neo4j://localhost",
+        auth=("neo4j", "password"),
+        database="academicworld",
+        max_connection_pool_size=100,
+        connection_acquisition_timeout=60,
+        metrics=None,
+    ):
+        self.uri = uri
         self.auth = auth
-        
-        self.driver = GraphDatabase.driver(self.uri, auth=self.auth)
-    
+        self.database = database
+
+        # Queries are timed and counted in this metrics_utils.Metrics, if given
+        self.metrics = metrics
+
+        self.max_connection_pool_size = max_connection_pool_size
+        self.connection_acquisition_timeout = connection_acquisition_timeout
+
+        # Transaction timeout of the reads and writes in a time_limit() block
+        self._limits = threading.local()
+        self._connect()
+
+    def _connect(self):
+        # The driver owns the connection pool. Callers that wait longer than the
+        # acquisition timeout for a free connection get an error instead.
+        self.driver = GraphDatabase.driver(
+            self.uri,
+            auth=self.auth,
+            max_connection_pool_size=self.max_connection_pool_size,
+            connection_acquisition_timeout=self.connection_acquisition_timeout,
+        )
+        self.driver.verify_connectivity()
+
+        self._pid = os.getpid()
+
+    def session(self):
+        # The driver's connections can not be shared with a forked worker
+        # process, which opens its own driver instead
+        if self._pid != os.getpid():
+            self._connect()
+
+        # A new session for each call, to be closed with a with block. Sessions
+        # are cheap, since the driver keeps the connections in its pool, and a
+        # session kept per thread would be left open by every request thread of
+        # the threaded server once the thread ends.
+        return self.driver.session(database=self.database)
+
+    def read(self, query, **params):
+        return self.read_many([(query, params)])[0]
+
+    def read_many(self, queries):
+        # Runs several (query, params) reads in one transaction, so related reads
+        # share one round trip to acquire a connection and see the same data
+        def work(tx):
+            return [self._run(tx, "read", q, p) for q, p in queries]
+
+        with self.session() as session:
+            return session.execute_read(self._limited(work))
+
+    def write(self, query, **params):
+        def work(tx):
+            return self._run(tx, "write", query, params)
+
+        with self.session() as session:
+            return session.execute_write(self._limited(work))
+
+    @contextmanager
+    def time_limit(self, seconds):
+        # Transactions run by this thread in the block are terminated by the
+        # server after seconds, so that a query given up on does not keep its
+        # connection
+        previous = getattr(self._limits, "seconds", None)
+        self._limits.seconds = seconds
+        try:
+            yield
+        finally:
+            self._limits.seconds = previous
+
+    def _limited(self, work):
+        seconds = getattr(self._limits, "seconds", None)
+        return work if seconds is None else unit_of_work(timeout=seconds)(work)
+
+    def _run(self, tx, operation, query, params):
+        with query_timer(self.metrics, "neo4j", operation, query, params) as timer:
+            records = [r.data() for r in tx.run(query, params)]
+            timer.rows = len(records)
+        return records
+
     def close(self):
-        self.driver.close()
\ No newline at end of file
+        self.driver.close()
+
+
+class AsyncNeo4j:
+    # Same interface as Neo4j for asyncio code, using the async driver. Async
+    # sessions can not be shared between tasks, so each call opens its own.
+    def __init__(
+        self,
+        uri="neo4j://localhost",
+        auth=("neo4j", "password"),
+        database="academicworld",
+        max_connection_pool_size=100,
+        connection_acquisition_timeout=60,
+        metrics=None,
+    ):
+        self.uri = uri
+        self.auth = auth
+        self.database = database
+        self.metrics = metrics
+
+        self.driver = AsyncGraphDatabase.driver(
+            self.uri,
+            auth=self.auth,
+            max_connection_pool_size=max_connection_pool_size,
+            connection_acquisition_timeout=connection_acquisition_timeout,
+        )
+
+    async def verify(self):
+        await self.driver.verify_connectivity()
+
+    async def read(self, query, **params):
+        return (await self.read_many([(query, params)]))[0]
+
+    async def read_many(self, queries):
+        async def work(tx):
+            return [await self._run(tx, "read", q, p) for q, p in queries]
+
+        async with self.driver.session(database=self.database) as session:
+            return await session.execute_read(work)
+
+    async def write(self, query, **params):
+        async def work(tx):
+            return await self._run(tx, "write", query, params)
+
+        async with self.driver.session(database=self.database) as session:
+            return await session.execute_write(work)
+
+    async def _run(self, tx, operation, query, params):
+        with query_timer(self.metrics, "neo4j", operation, query, params) as timer:
+            result = await tx.run(query, params)
+            records = [r.data() async for r in result]
+            timer.rows = len(records)
+        return records
+
+    async def close(self):
+        await self.driver.close()
@@ -0,0 +1,320 @@
+import hashlib
+import hmac
+import io
+import ipaddress
+import json
+import os
+import secrets
+import shutil
+import socket
+import tempfile
+import threading
+from contextlib import contextmanager
+from urllib.parse import urlencode, urljoin, urlsplit
+
+import flask
+import requests
+
+from lock_utils import process_lock
+
+# Route the photos are served from by serve_photos()
+PHOTO_ROUTE = "/photo"
+
+# Photo URLs are set by users through the Update University widget, so the
+# server only fetches them over these schemes, from public addresses, following
+# at most this many redirects that are each checked the same way
+PHOTO_SCHEMES = ("http", "https")
+MAX_REDIRECTS = 5
+
+
+class PhotoError(Exception):
+    pass
+
+
+class PhotoCache:
+    # University and faculty photos fetched once from their original URL and kept
+    # on disk with copies resized to the given widths. Each URL has a directory
+    # named after its hash, holding the files and a meta.json with their type
+    # and ETag. The least recently used directories are removed once the cache
+    # holds more than max_bytes. Files are written under a temporary name and
+    # renamed, so that several worker processes can share the directory.
+    def __init__(
+        self,
+        path,
+        widths=(400,),
+        max_bytes=256 * 1024 * 1024,
+        max_photo_bytes=10 * 1024 * 1024,
+        timeout=5,
+        max_age=3600,
+        secret=None,
+        allow_private=False,
+    ):
+        self.path = path
+        self.widths = widths
+        self.max_bytes = max_bytes
+        self.max_photo_bytes = max_photo_bytes
+        self.timeout = timeout
+        self.max_age = max_age
+
+        # Whether photos may be fetched from loopback, private and link-local
+        # addresses, which is only meant for photo servers on the same host in
+        # the benchmarks
+        self.allow_private = allow_private
+
+        # The route only fetches URLs signed with this secret, that is URLs the
+        # app put in a page itself. Worker processes share it through
+        # PHOTO_SECRET, or through a file in the cache directory.
+        os.makedirs(path, exist_ok=True)
+        secret = secret or os.environ.get("PHOTO_SECRET") or self._stored_secret()
+        self.secret = secret.encode()
+
+        # A lock per photo being fetched or resized, with the number of threads
+        # using it, removed when the last one is done
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+    def src(self, url, width=None):
+        # The src of an html.Img showing the photo through the cache
+        if not url:
+            return None
+        params = {"url": url, "sig": self.sign(url)}
+        if width:
+            params["w"] = width
+        return f"{PHOTO_ROUTE}?{urlencode(params)}"
+
+    def sign(self, url):
+        return hmac.new(self.secret, url.encode(), hashlib.sha256).hexdigest()[:32]
+
+    def verify(self, url, signature):
+        return hmac.compare_digest(self.sign(url), signature)
+
+    def photo(self, url, width=None):
+        # Returns (file path, mimetype, etag) of the photo, fetching it and
+        # resizing it first if needed. Raises PhotoError when it can not be
+        # fetched.
+        key = hashlib.sha256(url.encode()).hexdigest()
+        variant = str(width) if width else "original"
+
+        with self._lock(key):
+            meta = self._meta(key)
+            if meta is None:
+                meta = self._fetch(key, url)
+            if variant not in meta["variants"]:
+                self._resize(key, meta, width)
+
+            # The modification time of the directory orders the eviction
+            directory = os.path.join(self.path, key)
+            os.utime(directory)
+
+        found = meta["variants"][variant]
+        return os.path.join(directory, found["file"]), found["mimetype"], found["etag"]
+
+    def invalidate(self, url):
+        # Removes the cached copies of a URL, which is fetched again on its
+        # next use
+        if url:
+            key = hashlib.sha256(url.encode()).hexdigest()
+            with self._lock(key):
+                shutil.rmtree(os.path.join(self.path, key), ignore_errors=True)
+
+    @contextmanager
+    def _lock(self, key):
+        with self._locks_lock:
+            entry = self._locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._locks_lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[key]
+
+    def _stored_secret(self):
+        # The secret in the cache directory, made up by the first process to
+        # start with it. Processes sharing the directory sign the same URLs.
+        path = os.path.join(self.path, "secret")
+        with process_lock("secret", directory=self.path):
+            if not os.path.exists(path):
+                fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+                with os.fdopen(fd, "w") as f:
+                    f.write(secrets.token_hex(16))
+            with open(path) as f:
+                return f.read()
+
+    def _meta(self, key):
+        try:
+            with open(os.path.join(self.path, key, "meta.json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _fetch(self, key, url):
+        location = url
+        try:
+            for _ in range(MAX_REDIRECTS + 1):
+                self._check(location)
+                with requests.get(
+                    location, timeout=self.timeout, stream=True, allow_redirects=False
+                ) as response:
+                    if response.is_redirect:
+                        location = urljoin(location, response.headers["Location"])
+                        continue
+                    self._check_peer(location, response)
+                    response.raise_for_status()
+                    mimetype = response.headers.get("Content-Type", "").split(";")[0]
+                    if not mimetype.startswith("image/"):
+                        raise PhotoError(f"{url} is not an image ({mimetype})")
+
+                    content = io.BytesIO()
+                    for chunk in response.iter_content(64 * 1024):
+                        content.write(chunk)
+                        if content.tell() > self.max_photo_bytes:
+                            raise PhotoError(f"{url} is larger than the photo limit")
+                    break
+            else:
+                raise PhotoError(f"{url} redirects more than {MAX_REDIRECTS} times")
+        except requests.RequestException as err:
+            raise PhotoError(f"{url} could not be fetched: {err}") from err
+
+        os.makedirs(os.path.join(self.path, key), exist_ok=True)
+        meta = {"url": url, "variants": {}}
+        self._add(key, meta, "original", content.getvalue(), mimetype)
+        self._evict(keep=key)
+        return meta
+
+    def _check(self, url):
+        # Raises PhotoError unless the URL is http or https, and every address its
+        # host resolves to is public
+        parts = urlsplit(url)
+        if parts.scheme not in PHOTO_SCHEMES or not parts.hostname:
+            raise PhotoError(f"{url} is not an http or https URL")
+        if self.allow_private:
+            return
+
+        try:
+            port = parts.port or (443 if parts.scheme == "https" else 80)
+            addresses = socket.getaddrinfo(
+                parts.hostname, port, proto=socket.IPPROTO_TCP
+            )
+        except (socket.gaierror, ValueError) as err:
+            raise PhotoError(f"{url} could not be resolved: {err}") from err
+        for *_, address in addresses:
+            if not _public(address[0]):
+                raise PhotoError(f"{url} resolves to a non-public address")
+
+    def _check_peer(self, url, response):
+        # The address actually connected to is checked again, in case the host
+        # resolved to another one since _check(). Through a proxy, the peer is the
+        # proxy, which the proxy settings of the server vouch for.
+        if self.allow_private or requests.utils.get_environ_proxies(url):
+            return
+        sock = getattr(getattr(response.raw, "connection", None), "sock", None)
+        if sock is not None and not _public(sock.getpeername()[0]):
+            raise PhotoError(f"{url} connected to a non-public address")
+
+    def _resize(self, key, meta, width):
+        original = meta["variants"]["original"]
+        resized = _thumbnail(os.path.join(self.path, key, original["file"]), width)
+        if resized is None:
+            # Without Pillow, or for a photo it can not read, the original is
+            # served at every width
+            meta["variants"][str(width)] = original
+            self._write(key, "meta.json", json.dumps(meta).encode())
+            return
+
+        self._add(key, meta, str(width), *resized)
+        self._evict(keep=key)
+
+    def _add(self, key, meta, variant, content, mimetype):
+        self._write(key, variant, content)
+        meta["variants"][variant] = {
+            "file": variant,
+            "mimetype": mimetype,
+            "etag": hashlib.sha256(content).hexdigest()[:32],
+        }
+        self._write(key, "meta.json", json.dumps(meta).encode())
+
+    def _write(self, key, name, content):
+        directory = os.path.join(self.path, key)
+        fd, temporary = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+        os.replace(temporary, os.path.join(directory, name))
+
+    def _evict(self, keep):
+        entries = []
+        total = 0
+        for entry in os.scandir(self.path):
+            try:
+                size = sum(f.stat().st_size for f in os.scandir(entry.path))
+                entries.append((entry.stat().st_mtime, size, entry.name))
+            except (NotADirectoryError, FileNotFoundError):
+                # Not a photo, or removed by another worker process meanwhile
+                continue
+            total += size
+
+        for _, size, key in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if key != keep:
+                shutil.rmtree(os.path.join(self.path, key), ignore_errors=True)
+                total -= size
+
+
+def _thumbnail(path, width):
+    # Returns (content, mimetype) of the image resized to width, or None when
+    # Pillow is missing or the image can not be read. Images of more pixels than
+    # Pillow's MAX_IMAGE_PIXELS are refused as decompression bombs.
+    try:
+        # Pillow is only needed for the resized copies
+        from PIL import Image
+    except ImportError:
+        return None
+
+    try:
+        with Image.open(path) as image:
+            image.thumbnail((width, width * 4))
+            output = io.BytesIO()
+            if image.mode in ("RGBA", "LA", "P"):
+                image.save(output, "PNG", optimize=True)
+                return output.getvalue(), "image/png"
+            image.convert("RGB").save(output, "JPEG", quality=85)
+            return output.getvalue(), "image/jpeg"
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+
+
+def _public(address):
+    # Whether an IP address, as given by getaddrinfo(), is reachable on the
+    # internet, which excludes loopback, private, link-local, reserved and
+    # multicast addresses
+    address = ipaddress.ip_address(address.split("%")[0])
+    return address.is_global and not address.is_multicast
+
+
+def serve_photos(app, photos):
+    # Serves the photos of the cache on PHOTO_ROUTE of the Dash app's Flask
+    # server. Browsers keep them for max_age seconds, and then ask again with
+    # the ETag, which is answered with 304 Not Modified while it still matches.
+    @app.server.route(PHOTO_ROUTE)
+    def serve_photo():
+        url = flask.request.args.get("url", "")
+        if not url or not photos.verify(url, flask.request.args.get("sig", "")):
+            flask.abort(403)
+
+        width = flask.request.args.get("w", type=int)
+        if width is not None and width not in photos.widths:
+            flask.abort(400)
+
+        try:
+            path, mimetype, etag = photos.photo(url, width)
+        except PhotoError as err:
+            response = flask.Response(str(err), status=502, mimetype="text/plain")
+            response.headers["Cache-Control"] = "no-store"
+            return response
+
+        return flask.send_file(
+            path, mimetype=mimetype, etag=etag, max_age=photos.max_age, conditional=True
+        )
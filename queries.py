@@ -0,0 +1,226 @@
+import pandas as pd
+
+from mysql_utils import in_placeholders
+from faculty_profiles import FacultyProfiles
+from reviews import Reviews
+from university_stats import UniversityStats, UniversitySummaryRecord
+import figures
+
+KRC_QUERY = (
+    "WITH $selected_keywords AS keywords "
+    "MATCH (f:FACULTY)--(p:PUBLICATION)-[l:LABEL_BY]-(k:KEYWORD) "
+    "WHERE k.name IN keywords "
+    "AND p.year >= $min_year AND p.year <= $max_year "
+    "RETURN f.name, SUM(DISTINCT p.numCitations * l.score) as KRC "
+    "ORDER BY KRC DESC "
+    "LIMIT 10"
+)
+
+# The photo and the faculty count are read in one round trip
+UNIVERSITY_INFO_QUERY = (
+    "MATCH (i:INSTITUTE {name: $name}) "
+    "OPTIONAL MATCH (f:FACULTY)--(i) "
+    "RETURN i.photoUrl AS photoUrl, count(f) AS facultyCount"
+)
+
+UPDATE_UNIVERSITY_QUERY = (
+    "MATCH (i:INSTITUTE {name: $name}) SET i.photoUrl = $url RETURN i"
+)
+
+CREATE_UNIVERSITY_QUERY = "CREATE (i:INSTITUTE {name: $name, photoUrl: $url}) RETURN i"
+
+
+class Queries:
+    # The reads and writes behind the callbacks, kept apart from the layout so
+    # that the same code paths can be run against other stores, as the
+    # benchmarks do. Results are plain rows and records, the callbacks turn
+    # them into figures and components.
+    def __init__(
+        self,
+        mysql,
+        mongo,
+        neo,
+        keyword_index=None,
+        krc_aggregates=None,
+        snapshot=None,
+        export_timeout=None,
+    ):
+        self.mysql = mysql
+        self.mongo = mongo
+        self.neo = neo
+        self.keyword_index = keyword_index
+        self.krc_aggregates = krc_aggregates
+        self.snapshot = snapshot
+
+        # Seconds an export may keep reading from MySQL, however slowly it is
+        # downloaded
+        self.export_timeout = export_timeout
+
+        self.university_stats = UniversityStats(mongo.db, metrics=mongo.metrics)
+        self.faculty_profiles = FacultyProfiles(
+            mongo.db, mysql, neo, metrics=mongo.metrics
+        )
+        self.reviews = Reviews(mongo.db)
+
+    def names(self, table):
+        return [
+            item[0] for item in self.mysql.execute_query(f"SELECT name FROM {table}")
+        ]
+
+    def year_range(self):
+        # Note that this is removing publications with a missing year.
+        min_year, max_year = self.mysql.execute_query(
+            "SELECT MIN(year), MAX(year) FROM publication WHERE year > 0"
+        )[0]
+        return int(min_year), int(max_year)
+
+    def university_year_counts(self, selection):
+        # Publications per university and year in the selected keywords, from
+        # which the Top Universities bars are drawn for any year range
+        if self.keyword_index:
+            return self.keyword_index.university_year_counts(selection)
+        if self.snapshot:
+            return self.snapshot.university_year_counts(selection)
+
+        # The keywords are bound as parameters, so the query text only depends
+        # on the number of keywords and its prepared statement is reused
+        keyword_in, keyword_params = in_placeholders(selection)
+
+        # Query for university publication count
+        query_university = " ".join(
+            [
+                "SELECT u.name, p.year, COUNT(DISTINCT p.id) c",
+                "FROM university u",
+                "JOIN faculty f on f.university_id = u.id",
+                "JOIN faculty_publication fp on f.id = fp.faculty_id",
+                "JOIN publication p ON p.id = fp.publication_id",
+                "JOIN publication_keyword pk ON pk.publication_id = p.id",
+                "JOIN keyword k ON k.id = pk.keyword_id",
+                f"WHERE k.name IN ({keyword_in})",
+                "AND p.year > 0",
+                "GROUP BY u.id, p.year",
+            ]
+        )
+        return self.mysql.execute_prepared(query_university, keyword_params)
+
+    def faculty_year_counts(self, selection):
+        # Publications per faculty member and year in the selected keywords
+        if self.keyword_index:
+            return self.keyword_index.faculty_year_counts(selection)
+        if self.snapshot:
+            return self.snapshot.faculty_year_counts(selection)
+
+        keyword_in, keyword_params = in_placeholders(selection)
+
+        # Query for faculty publication count
+        query_faculty = " ".join(
+            [
+                "SELECT f.name, p.year, COUNT(DISTINCT p.id) c",
+                "FROM faculty f",
+                "JOIN faculty_publication fp ON f.id = fp.faculty_id",
+                "JOIN publication p ON p.id = fp.publication_id",
+                "JOIN publication_keyword pk ON pk.publication_id = p.id",
+                "JOIN keyword k ON k.id = pk.keyword_id",
+                f"WHERE k.name IN ({keyword_in})",
+                "AND p.year > 0",
+                "GROUP BY f.id, p.year",
+            ]
+        )
+        return self.mysql.execute_prepared(query_faculty, keyword_params)
+
+    def stream_university_counts(self, selection, year_range):
+        # Every university with its publications in the selected keywords and
+        # years, most first, read from MySQL while it is written out. This is the
+        # full ranking that the Top Universities widget shows the top of.
+        keyword_in, keyword_params = in_placeholders(selection)
+        query = " ".join(
+            [
+                "SELECT u.name, COUNT(DISTINCT p.id) c",
+                "FROM university u",
+                "JOIN faculty f on f.university_id = u.id",
+                "JOIN faculty_publication fp on f.id = fp.faculty_id",
+                "JOIN publication p ON p.id = fp.publication_id",
+                "JOIN publication_keyword pk ON pk.publication_id = p.id",
+                "JOIN keyword k ON k.id = pk.keyword_id",
+                f"WHERE k.name IN ({keyword_in})",
+                "AND p.year BETWEEN %s AND %s",
+                "GROUP BY u.id, u.name",
+                "ORDER BY c DESC",
+            ]
+        )
+        return self.mysql.stream(
+            query, keyword_params + tuple(year_range), timeout=self.export_timeout
+        )
+
+    def stream_faculty_counts(self, selection, year_range):
+        # The same for the faculty members of the Top Faculty widget
+        keyword_in, keyword_params = in_placeholders(selection)
+        query = " ".join(
+            [
+                "SELECT f.name, COUNT(DISTINCT p.id) c",
+                "FROM faculty f",
+                "JOIN faculty_publication fp ON f.id = fp.faculty_id",
+                "JOIN publication p ON p.id = fp.publication_id",
+                "JOIN publication_keyword pk ON pk.publication_id = p.id",
+                "JOIN keyword k ON k.id = pk.keyword_id",
+                f"WHERE k.name IN ({keyword_in})",
+                "AND p.year BETWEEN %s AND %s",
+                "GROUP BY f.id, f.name",
+                "ORDER BY c DESC",
+            ]
+        )
+        return self.mysql.stream(
+            query, keyword_params + tuple(year_range), timeout=self.export_timeout
+        )
+
+    def stream_university_summary(self, universities=None):
+        # The Total Research rows of the given universities, or of all of them,
+        # as (university, keyword count, faculty count, publication count)
+        query = {"university": {"$in": universities}} if universities else {}
+        return self.mongo.stream(
+            self.university_stats.name,
+            query,
+            sort=[("uniqueKeywordsCount", -1)],
+            record_type=UniversitySummaryRecord,
+        )
+
+    def highest_impact(self, selection, year_range):
+        if self.krc_aggregates:
+            records = self.krc_aggregates.top_faculty(selection, year_range)
+        else:
+            records = self.neo.read(
+                KRC_QUERY,
+                selected_keywords=selection,
+                min_year=year_range[0],
+                max_year=year_range[1],
+            )
+        return [(r["f.name"], r["KRC"]) for r in records]
+
+    def university_info(self, name):
+        # Returns (photo url, faculty count), or None for an unknown university
+        records = self.neo.read(UNIVERSITY_INFO_QUERY, name=name)
+        if not records:
+            return None
+
+        return records[0]["photoUrl"], records[0]["facultyCount"]
+
+    def update_university(self, name, url):
+        self.neo.write(UPDATE_UNIVERSITY_QUERY, name=name, url=url)
+
+    def create_university(self, name, url):
+        self.neo.write(CREATE_UNIVERSITY_QUERY, name=name, url=url)
+
+    def university_summary(self, universities):
+        # Read from the materialized summary instead of aggregating every faculty
+        if self.snapshot:
+            result = self.snapshot.university_summary(universities)
+        else:
+            result = [tuple(r) for r in self.university_stats.find(universities)]
+        return pd.DataFrame(result, columns=["university"] + figures.COUNT_COLUMNS)
+
+    def faculty_profile(self, name):
+        # The details of a faculty member from all three stores, in one lookup
+        return self.faculty_profiles.find(name)
+
+    def review_page(self, faculty_id, page):
+        return self.reviews.page(faculty_id, page)
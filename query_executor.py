@@ -0,0 +1,78 @@
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from contextlib import ExitStack
+
+# The outcome of one branch. Exactly one of value and error is set, and seconds
+# is how long the branch ran (or how long it was waited for when it timed out).
+Branch = namedtuple("Branch", ["value", "error", "seconds"])
+
+
+class QueryExecutor:
+    # Runs independent queries, possibly against different stores, on a shared
+    # thread pool so that a callback waits for the slowest query rather than the
+    # sum of all of them.
+    def __init__(self, max_workers=16, limits=()):
+        self.max_workers = max_workers
+
+        # Each branch runs inside limit(seconds) of every one of these, such as
+        # the time_limit() of the stores, with the seconds left until its
+        # deadline. The servers then stop the queries of a branch that is given
+        # up on, instead of leaving them to hold a thread and a connection.
+        self.limits = limits
+        self.pool = None
+        self._pid = None
+
+    def _pool(self):
+        # Threads do not survive a fork, so a forked worker process starts its
+        # own pool instead of waiting on the parent's threads
+        if self.pool is None or self._pid != os.getpid():
+            self.pool = ThreadPoolExecutor(self.max_workers, thread_name_prefix="query")
+            self._pid = os.getpid()
+        return self.pool
+
+    def run(self, queries, timeout=10):
+        # queries maps a branch name to a function, or to a (function, timeout)
+        # pair to override the default timeout for that branch
+        pool = self._pool()
+        start = time.monotonic()
+        futures = {}
+        for name, query in queries.items():
+            fn, branch_timeout = query if isinstance(query, tuple) else (query, timeout)
+            futures[name] = (
+                pool.submit(_timed, fn, self.limits, start + branch_timeout),
+                start + branch_timeout,
+            )
+
+        results = {}
+        for name, (future, deadline) in futures.items():
+            try:
+                results[name] = future.result(
+                    timeout=max(0, deadline - time.monotonic())
+                )
+            except TimeoutError:
+                future.cancel()
+                results[name] = Branch(
+                    None,
+                    TimeoutError(f"{name} did not finish in time"),
+                    time.monotonic() - start,
+                )
+
+        return results
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _timed(fn, limits=(), deadline=None):
+    start = time.monotonic()
+    try:
+        with ExitStack() as stack:
+            for limit in limits:
+                stack.enter_context(limit(max(0.001, deadline - start)))
+            value = fn()
+    except Exception as err:
+        return Branch(None, err, time.monotonic() - start)
+    return Branch(value, None, time.monotonic() - start)
@@ -0,0 +1,163 @@
+import datetime
+import sys
+
+import pymongo
+
+from mongodb_utils import MongoDB
+
+
+class Reviews:
+    # Reviews live in their own collection, indexed by faculty and time, instead
+    # of an array inside the faculty document. A summary document per faculty
+    # keeps the count and rating total, so the average is not recomputed from all
+    # reviews on every read.
+    def __init__(self, db, page_size=10):
+        self.db = db
+        self.page_size = page_size
+
+    # The collections are looked up on every use, so that a forked worker uses
+    # its own client
+    @property
+    def reviews(self):
+        return self.db["reviews"]
+
+    @property
+    def summaries(self):
+        return self.db["review_summary"]
+
+    def ensure_indexes(self):
+        self.reviews.create_index(
+            [("faculty_id", pymongo.ASCENDING), ("created", pymongo.DESCENDING)]
+        )
+
+    def add(self, faculty_id, text, rating):
+        # The summary is counted again from the reviews after each one, rather
+        # than incremented, so that it never stays off when the process dies
+        # between the two writes. A summary written from the reviews read before
+        # a concurrent review is set right again by the next review.
+        self.reviews.insert_one(
+            {
+                "faculty_id": faculty_id,
+                "text": text,
+                "rating": rating,
+                "created": datetime.datetime.now(datetime.timezone.utc),
+            }
+        )
+        self._summarize(faculty_id)
+
+    def page(self, faculty_id, page=0):
+        # Returns the summary and one page of the newest reviews in one round
+        # trip. One extra review is read to tell whether there is a next page.
+        result = list(
+            self.summaries.aggregate(
+                [
+                    {"$match": {"_id": faculty_id}},
+                    {
+                        "$lookup": {
+                            "from": self.reviews.name,
+                            "pipeline": [
+                                {"$match": {"faculty_id": faculty_id}},
+                                {"$sort": {"created": -1}},
+                                {"$skip": page * self.page_size},
+                                {"$limit": self.page_size + 1},
+                                {"$project": {"_id": 0, "text": 1, "rating": 1}},
+                            ],
+                            "as": "reviews",
+                        }
+                    },
+                ]
+            )
+        )
+
+        if not result:
+            return {"count": 0, "average": None, "reviews": [], "has_next": False}
+
+        summary = result[0]
+        return {
+            "count": summary["count"],
+            "average": summary["total"] / summary["count"],
+            "reviews": summary["reviews"][: self.page_size],
+            "has_next": len(summary["reviews"]) > self.page_size,
+        }
+
+    def migrate(self):
+        # Moves reviews that are still embedded in faculty documents into the
+        # reviews collection and removes the arrays. It can be run again after
+        # being interrupted: each moved review gets an _id made of the faculty
+        # id and its position in the array, so it is only inserted once, and the
+        # summary is counted again from the reviews collection. It is meant to
+        # run before the app takes reviews.
+        #
+        # The embedded reviews were appended, so they are given creation times a
+        # millisecond apart in their order, ending when the migration started.
+        # Each page of reviews then sorts them the same way.
+        started = datetime.datetime.now(datetime.timezone.utc)
+        moved = 0
+        embedded = self.db["faculty"].find(
+            {"reviews.0": {"$exists": True}}, {"reviews": 1}
+        )
+        for faculty in embedded:
+            faculty_id = faculty["_id"]
+            count = len(faculty["reviews"])
+            for i, review in enumerate(faculty["reviews"]):
+                created = started - datetime.timedelta(milliseconds=count - 1 - i)
+                result = self.reviews.update_one(
+                    {"_id": f"{faculty_id}:{i}"},
+                    {
+                        "$setOnInsert": {
+                            "faculty_id": faculty_id,
+                            "text": review["review-text"],
+                            "rating": review["review-rating"],
+                            "created": created,
+                        }
+                    },
+                    upsert=True,
+                )
+                if result.upserted_id is not None:
+                    moved += 1
+
+            self._summarize(faculty_id)
+            self.db["faculty"].update_one(
+                {"_id": faculty_id}, {"$unset": {"reviews": ""}}
+            )
+
+        self.db["faculty"].update_many(
+            {"reviews": {"$size": 0}}, {"$unset": {"reviews": ""}}
+        )
+        return moved
+
+    def _summarize(self, faculty_id):
+        # Sets the summary of a faculty member from their reviews, on the server
+        self.reviews.aggregate(
+            [
+                {"$match": {"faculty_id": faculty_id}},
+                {
+                    "$group": {
+                        "_id": "$faculty_id",
+                        "count": {"$sum": 1},
+                        "total": {"$sum": "$rating"},
+                    }
+                },
+                {
+                    "$merge": {
+                        "into": self.summaries.name,
+                        "whenMatched": "replace",
+                        "whenNotMatched": "insert",
+                    }
+                },
+            ]
+        )
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["migrate"]:
+        sys.exit("Usage: python3 reviews.py migrate")
+
+    mongo = MongoDB()
+    mongo.connect()
+
+    reviews = Reviews(mongo.db)
+    reviews.ensure_indexes()
+    print(f"Moved {reviews.migrate()} reviews")
+
+    mongo.close()
@@ -0,0 +1,101 @@
+import bisect
+import threading
+from collections import defaultdict
+
+
+def _fold(text):
+    return " ".join(text.casefold().split())
+
+
+def _trigrams(text):
+    text = f"  {text} "
+    return {text[i : i + 3] for i in range(len(text) - 2)}
+
+
+class SearchIndex:
+    # Typeahead index over a list of names. Matches are ranked as exact match,
+    # then prefix of the whole name, then prefix of any word in the name, then by
+    # trigram overlap, which also catches small typos. The names are loaded by
+    # calling load() the first time the index is searched.
+    def __init__(self, load=None, min_similarity=0.5):
+        self.min_similarity = min_similarity
+        self.names = []
+
+        self._load = load
+        self._lock = threading.Lock()
+        self._seen = set()
+        self._prefixes = []
+        self._words = []
+        self._trigrams = defaultdict(set)
+
+    def add(self, name):
+        with self._lock:
+            self._add(name)
+
+    def search(self, text, limit=50):
+        self._ensure_loaded()
+
+        query = _fold(text or "")
+        if not query:
+            return []
+
+        ranks = {}
+
+        def rank(ids, tier):
+            for i in ids:
+                score = (tier, len(self.names[i]), self.names[i])
+                if i not in ranks or score < ranks[i]:
+                    ranks[i] = score
+
+        rank(self._starting_with(self._prefixes, query), 1)
+        rank(self._starting_with(self._words, query), 2)
+        rank([i for i in ranks if _fold(self.names[i]) == query], 0)
+
+        if len(ranks) < limit and len(query) >= 3:
+            grams = _trigrams(query)
+            shared = defaultdict(int)
+            for gram in grams:
+                for i in self._trigrams.get(gram, ()):
+                    shared[i] += 1
+
+            for i, count in shared.items():
+                similarity = count / len(grams)
+                if i not in ranks and similarity >= self.min_similarity:
+                    ranks[i] = (3, -similarity, self.names[i])
+
+        best = sorted(ranks, key=ranks.get)[:limit]
+        return [self.names[i] for i in best]
+
+    def _ensure_loaded(self):
+        if self._load is None:
+            return
+
+        with self._lock:
+            if self._load is not None:
+                for name in self._load():
+                    self._add(name)
+                self._load = None
+
+    def _add(self, name):
+        if not name or name in self._seen:
+            return
+
+        i = len(self.names)
+        self.names.append(name)
+        self._seen.add(name)
+
+        folded = _fold(name)
+        bisect.insort(self._prefixes, (folded, i))
+        for word in folded.split()[1:]:
+            bisect.insort(self._words, (word, i))
+        for gram in _trigrams(folded):
+            self._trigrams[gram].add(i)
+
+    def _starting_with(self, entries, prefix):
+        start = bisect.bisect_left(entries, (prefix, -1))
+        ids = []
+        for text, i in entries[start:]:
+            if not text.startswith(prefix):
+                break
+            ids.append(i)
+        return ids
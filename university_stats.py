@@ -0,0 +1,155 @@
+import threading
+
+import pymongo
+from pymongo import DeleteMany, ReplaceOne
+
+from mongodb_utils import MongoDB, Record, find_records
+import figures
+
+# Faculty fields that the summary is computed from. Updates that only touch
+# other fields (such as reviews) do not need a refresh.
+SOURCE_FIELDS = ("affiliation", "keywords", "publications")
+
+
+class UniversitySummaryRecord(Record):
+    __slots__ = ("university", *figures.COUNT_COLUMNS)
+
+
+def summary_pipeline(universities=None):
+    # Faculty count, unique keyword count and publication count per university.
+    # This is the aggregation the Total Research widget used to run on every
+    # change of its filter.
+    pipeline = [
+        {"$unwind": "$keywords"},
+        {
+            "$group": {
+                "_id": {"university": "$affiliation.name", "faculty_id": "$_id"},
+                "uniqueKeywords": {"$addToSet": "$keywords.name"},
+                "publications": {"$first": "$publications"},
+            }
+        },
+        {
+            "$group": {
+                "_id": "$_id.university",
+                "facultyCount": {"$sum": 1},
+                "uniqueKeywordsCount": {"$sum": {"$size": "$uniqueKeywords"}},
+                "distinctPublicationsCount": {"$sum": {"$size": "$publications"}},
+            }
+        },
+        {
+            "$project": {
+                "_id": 0,
+                "university": "$_id",
+                "uniqueKeywordsCount": 1,
+                "facultyCount": 1,
+                "distinctPublicationsCount": 1,
+            }
+        },
+    ]
+
+    if universities is not None:
+        pipeline.insert(0, {"$match": {"affiliation.name": {"$in": universities}}})
+
+    return pipeline
+
+
+class UniversityStats:
+    # Materialized copy of summary_pipeline() in its own collection, indexed on
+    # the university name, so that the Total Research widget is an index lookup
+    def __init__(self, db, collection="university_stats", metrics=None):
+        self.db = db
+        self.name = collection
+        self.metrics = metrics
+        self._watcher = None
+
+    @property
+    def collection(self):
+        # Looked up on every use, so that a forked worker uses its own client
+        return self.db[self.name]
+
+    def ensure_index(self):
+        self.collection.create_index("university", unique=True)
+
+    def is_empty(self):
+        return self.collection.estimated_document_count() == 0
+
+    def rebuild(self):
+        # $out swaps in the new collection atomically and keeps its indexes
+        self.db["faculty"].aggregate(summary_pipeline() + [{"$out": self.name}])
+        self.ensure_index()
+
+    def refresh(self, universities):
+        # Recomputes the given universities only. Universities that no longer
+        # have any faculty with keywords are removed.
+        universities = list(set(universities))
+        if not universities:
+            return
+
+        docs = list(self.db["faculty"].aggregate(summary_pipeline(universities)))
+        found = {doc["university"] for doc in docs}
+
+        requests = [
+            ReplaceOne({"university": doc["university"]}, doc, upsert=True)
+            for doc in docs
+        ]
+        missing = [name for name in universities if name not in found]
+        if missing:
+            requests.append(DeleteMany({"university": {"$in": missing}}))
+
+        self.collection.bulk_write(requests, ordered=False)
+
+    def find(self, universities=None):
+        # The summaries as UniversitySummaryRecord records, most keywords first
+        query = {"university": {"$in": universities}} if universities else {}
+        return find_records(
+            self.collection,
+            query,
+            UniversitySummaryRecord,
+            self.metrics,
+            sort=[("uniqueKeywordsCount", pymongo.DESCENDING)],
+        )
+
+    def watch(self):
+        # Keeps the summary current by following the faculty change stream in a
+        # background thread. Change streams need MongoDB to run as a replica set.
+        if self._watcher is None:
+            self._watcher = threading.Thread(target=self._follow_changes, daemon=True)
+            self._watcher.start()
+
+    def _follow_changes(self):
+        try:
+            with self.db["faculty"].watch(full_document="updateLookup") as stream:
+                for change in stream:
+                    self._apply(change)
+        except pymongo.errors.PyMongoError as err:
+            print(f"University stats are no longer refreshed: {err}")
+
+    def _apply(self, change):
+        operation = change["operationType"]
+        doc = change.get("fullDocument") or {}
+        university = doc.get("affiliation", {}).get("name")
+
+        if operation == "insert":
+            self.refresh([university])
+        elif operation == "update":
+            fields = change["updateDescription"]["updatedFields"].keys()
+            fields = set(fields) | set(change["updateDescription"]["removedFields"])
+            touched = {field.split(".")[0] for field in fields}
+
+            if "affiliation" in touched:
+                # The university it moved away from is not known anymore
+                self.rebuild()
+            elif touched & set(SOURCE_FIELDS):
+                self.refresh([university])
+        elif operation in ("replace", "delete"):
+            self.rebuild()
+
+
+if __name__ == "__main__":
+    mongo = MongoDB()
+    mongo.connect()
+
+    UniversityStats(mongo.db).rebuild()
+    print("Rebuilt university_stats")
+
+    mongo.close()